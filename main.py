@@ -1,83 +1,258 @@
 import argparse
 import json
-import neo4j
+from contextlib import nullcontext
+from typing import Callable, Optional
 
-from modules.attribute_assessment import assess_user_attributes
+from modules.adcs_index import AdcsIndex
+from modules.assessment import assess_target, assess_user
+from modules.choke_points import ChokePointReport, analyze_choke_points
+from modules.detail_sink import ColumnarDetailSink
+from modules.converters import convert_to_timestamp
+from modules.cypher_compiler import get_matching_node_ids
+from modules.edge_aggregation import AggregatedUserAssessment, assess_user_aggregated
+from modules.event_ingestion import DEFAULT_MIN_COVERAGE, DEFAULT_WINDOW, ingest_event_logs, monitored_event_ids
+from modules.group_expansion import GroupPermissionIndex
+from modules.impact_index import build_impact_index
 from modules.logging_base import Logging
-from modules.neo4j_utils import vertify_connection
-from models.neo4j import Path, UserPaths, User
+from modules.multi_source import GraphSource, assess_sources, parse_graph_sources
+from modules.neo4j_utils import get_nodes_by_ids, get_user_names
+from modules.permission_assessment import DEZ_TO_QV_MAPPING
+from modules.pipeline import AssessmentPipeline
+from modules.profiling import is_profiling, profile_stage, profiling
+from modules.query_cache import QueryCache
+from modules.risk_ranking import TopRiskReport
+from modules.rule_cache import load_rules
 from modules.rule_engine import RuleEngine
-from modules.permission_assessment import assess_permissions
+from modules.sampling import estimate_risk_distribution
 
 logger = Logging().getLogger()
 
 
-def get_direct_user_paths(session: neo4j.Session, username: str) -> list[neo4j.Record]:
-    result = session.run("MATCH p=(n: User {name: $username})-[r]->() RETURN p", username=username)
-    return list(result)
+def main(graph_sources: list[GraphSource], name: str, attributes_rules_dir_path: str,
+         permission_rules_dir_path: str, event_monitoring_config: dict, target_mode: bool = False,
+         rules_cache_dir: Optional[str] = None, estimate_mode: bool = False,
+         sample_size: Optional[int] = None, error_bound: float = 0.05, details_path: Optional[str] = None,
+         inherited: bool = False, all_users: bool = False, adcs: bool = False, aggregate: bool = False,
+         event_logs: Optional[list[str]] = None, event_window: str = DEFAULT_WINDOW,
+         event_coverage: float = DEFAULT_MIN_COVERAGE, event_hosts: Optional[list[str]] = None,
+         query_cache: Optional[QueryCache] = None, rule_name: Optional[str] = None,
+         rule_packs: Optional[dict[str, str]] = None, choke_points: Optional[int] = None):
+    # Rules are loaded once and shared by all graph sources
+    with profile_stage("load_rules", snapshot=True):
+        attribute_rule_engine, permission_rules = load_rules(
+            attributes_rules_dir_path, permission_rules_dir_path, rules_cache_dir, rule_packs=rule_packs)
 
+    if event_logs:
+        with profile_stage("ingest_events"):
+            coverage = ingest_event_logs(event_logs, monitored_event_ids(permission_rules, event_monitoring_config),
+                                         convert_to_timestamp(event_window), event_hosts)
+        coverage.log()
+        event_monitoring_config = {**event_monitoring_config, **coverage.monitoring_config(event_coverage)}
+        logger.info(f"Derived EventMonitoringConfig: {json.dumps(event_monitoring_config, indent=4)}")
+        if name is None and not (estimate_mode or all_users or rule_name or choke_points):
+            return
 
-def get_user(session: neo4j.Session, username: str) -> neo4j.Record:
-    result = session.run(
-        "MATCH (n: User {name: $username}) RETURN n LIMIT 1", username=username).single()
-    if result is None:
-        return None
-    return result[0]
+    if rule_name is not None:
+        try:
+            attribute_rule_engine.get_rule(rule_name)
+        except KeyError as e:
+            logger.error(e)
+            return
 
+        def task(session, engine, source):
+            records = get_nodes_by_ids(session, get_matching_node_ids(session, engine, rule_name))
+            return sorted(record["n"].get("name") or record["n"].element_id for record in records)
+    elif choke_points is not None:
+        def task(session, engine, source):
+            return analyze_choke_points(session, permission_rules, engine, event_monitoring_config, choke_points)
+    elif estimate_mode:
+        def task(session, engine, source):
+            return estimate_risk_distribution(session, engine, permission_rules, event_monitoring_config,
+                                              sample_size, error_bound)
+    elif target_mode:
+        def task(session, engine, source):
+            return assess_target(session, name, engine, permission_rules, event_monitoring_config)
+    elif all_users:
+        def task(session, engine, source):
+            group_index = GroupPermissionIndex.from_session(session, list(permission_rules)) if inherited else None
+            adcs_index = AdcsIndex.from_session(session) if adcs else None
+            # Every target is classified once instead of once per path
+            impact_index = build_impact_index(session, engine, list(permission_rules))
+            pipeline = AssessmentPipeline(session, engine, permission_rules, event_monitoring_config,
+                                          _source_sink(details_sink, source), TopRiskReport(),
+                                          impact_index=impact_index, group_index=group_index, adcs_index=adcs_index)
+            for _ in pipeline.run(get_user_names(session)):
+                pass
+            return pipeline
+    elif aggregate:
+        if inherited or adcs:
+            logger.warning("Inherited rights and ADCS escalations are not assessed in aggregated mode")
 
-def main(neo4j_uri: str, neo4j_user: str, neo4j_password: str, name: str, attributes_rules_dir_path: str,
-         permission_rules_dir_path: str, event_monitoring_config: dict):
-    logger.debug(f"Initializing neo4j driver...")
-    driver = neo4j.GraphDatabase.driver(neo4j_uri, auth=(neo4j_user, neo4j_password))
-    logger.debug(f"Neo4j driver initialized")
+        def task(session, engine, source):
+            return assess_user_aggregated(session, name, engine, permission_rules, event_monitoring_config,
+                                          path_sink=_source_sink(details_sink, source))
+    else:
+        def task(session, engine, source):
+            group_index = GroupPermissionIndex.from_session(session, list(permission_rules)) if inherited else None
+            adcs_index = AdcsIndex.from_session(session) if adcs else None
+            return assess_user(session, name, engine, permission_rules, event_monitoring_config,
+                               _source_sink(details_sink, source),
+                               group_index=group_index, adcs_index=adcs_index)
 
-    attribute_rule_engine = RuleEngine()
-    attribute_rule_engine.load_rules_from_directory(attributes_rules_dir_path)
+    details_sink = None
+    if details_path is not None:
+        if estimate_mode or target_mode or rule_name is not None or choke_points is not None:
+            logger.warning("Path details are only written for user assessments")
+        else:
+            details_sink = ColumnarDetailSink(details_path)
+    try:
+        _run_assessment(graph_sources, name, attribute_rule_engine, task, estimate_mode, target_mode, all_users,
+                        query_cache, rule_name)
+    finally:
+        if details_sink is not None:
+            details_sink.close()
+    if query_cache is not None:
+        logger.info(f"Query cache: {query_cache.stats}")
 
-    user_paths: UserPaths
-    user: User
 
-    with driver.session() as session:
-        if not vertify_connection(session):
-            logger.error("Could not connect to Neo4j database. Please check your configuration.")
-            return
+def _source_sink(details_sink: Optional[ColumnarDetailSink], source: GraphSource):
+    return details_sink.for_source(source.name) if details_sink is not None else None
 
-        logger.debug(f"Fetching direct user paths for user: {name}")
-        paths = get_direct_user_paths(session, name)
 
-        if paths:
-            logger.info(f"Direct paths for user {name}:")
-            user_paths = UserPaths(paths)
-            user = user_paths.user
-        else:
-            user = get_user(session, name)
-            if user:
-                logger.info(f"User {name} found but has no direct paths.")
-                user = User(user)
-            else:
-                logger.error(f"User {name} not found in the database.")
-                return
-
-    logger.debug(f"User object: {user}")
-    adass_score = assess_user_attributes(user, attribute_rule_engine)
-    logger.info(f"Attribute Assessment: {adass_score}")
-
-    if paths:
-        cadra_score = assess_permissions(
-            user_paths.paths, permission_rules_dir_path, attribute_rule_engine, adass_score, event_monitoring_config)
-        logger.info(f"CADRA Score: {cadra_score}")
-    else:
-        logger.info("User has no direct paths, skipping permission assessment.")
+def _run_assessment(graph_sources: list[GraphSource], name: Optional[str], attribute_rule_engine: RuleEngine,
+                    task: Callable, estimate_mode: bool, target_mode: bool, all_users: bool = False,
+                    query_cache: Optional[QueryCache] = None, rule_name: Optional[str] = None):
+    # The profiler follows a single thread, so the sources are assessed one after another
+    max_workers = 1 if is_profiling() else None
+    for source_result in assess_sources(graph_sources, attribute_rule_engine, task, max_workers, query_cache):
+        if source_result.error is not None:
+            logger.error(f"[{source_result.source}] Could not assess {name or 'the domain'}: {source_result.error}")
+        elif rule_name is not None:
+            _log_rule_matches(source_result.source, rule_name, source_result.result)
+        elif estimate_mode:
+            _log_estimate(source_result.source, source_result.result)
+        elif target_mode:
+            _log_target_result(source_result.source, name, source_result.result)
+        elif all_users:
+            _log_pipeline(source_result.source, source_result.result)
+        elif isinstance(source_result.result, AggregatedUserAssessment):
+            _log_aggregated(source_result.source, source_result.result)
+        elif isinstance(source_result.result, ChokePointReport):
+            _log_choke_points(source_result.source, source_result.result)
+        elif source_result.result is not None:
+            assessment = source_result.result
+            logger.info(f"[{source_result.source}] {name}: Attribute Assessment {assessment.adass_score}, "
+                        f"CADRA Score {assessment.cadra_score}")
+
+
+def _log_estimate(source: str, estimate):
+    logger.info(f"[{source}] Estimated risk distribution of {estimate.population} principals "
+                f"from a sample of {estimate.sample_size}, {estimate.confidence:.0%} confidence intervals:")
+    for level in estimate.levels:
+        logger.info(f"[{source}]   {level}")
+
+
+def _log_rule_matches(source: str, rule_name: str, names: list[str]):
+    logger.info(f"[{source}] {len(names)} node(s) match the rule '{rule_name}':")
+    for name in names:
+        logger.info(f"[{source}]   {name}")
+
+
+def _log_aggregated(source: str, result: AggregatedUserAssessment):
+    assessment = result.assessment
+    logger.info(f"[{source}] {assessment.name}: Attribute Assessment {assessment.adass_score}, "
+                f"CADRA Score {assessment.cadra_score} over {assessment.path_count} paths")
+    for aggregate_assessment in result.aggregates:
+        logger.info(f"[{source}]   {aggregate_assessment.aggregate} => {DEZ_TO_QV_MAPPING[aggregate_assessment.risk]}")
+
+
+def _log_choke_points(source: str, report: ChokePointReport):
+    logger.info(f"[{source}] {report.principal_count} principals have a path to a scored target, "
+                f"top choke points by weighted risk:")
+    for node in report.nodes:
+        logger.info(f"[{source}]   ({node.name}): {node.principals:.1f} principal(s), "
+                    f"weighted risk {node.weighted_risk:.1f}")
+    for edge in report.edges:
+        logger.info(f"[{source}]   {edge}")
+
+
+def _log_pipeline(source: str, pipeline: AssessmentPipeline):
+    logger.info(f"[{source}] Assessed all enabled users:")
+    pipeline.report.log_report()
+    pipeline.stats.log()
+
+
+def _log_target_result(source: str, name: str, inbound_principals):
+    if inbound_principals is None:
+        return
+    if not inbound_principals:
+        logger.info(f"[{source}] No principals can reach {name}.")
+        return
+
+    logger.info(f"[{source}] Principals that can reach {name}:")
+    for inbound in inbound_principals:
+        logger.info(f"[{source}] {inbound.principal.name} ({inbound.principal.type}) via "
+                    f"{inbound.reaching_edge.edge_type}, {inbound.reaching_edge.depth} hop(s): "
+                    f"{inbound.risk} : {DEZ_TO_QV_MAPPING[inbound.risk]}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="CADRA - A tool for assessing risks inside Active Directory environments")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose logging")
-    parser.add_argument("name", type=str,
+    parser.add_argument("-t", "--target", action="store_true",
+                        help="Treat name as a target object and assess every principal that can reach it")
+    parser.add_argument("--profile", metavar="DIR", nargs="?", const="profiles",
+                        help="Write per-stage CPU profiles and collapsed stacks to DIR (default: profiles) "
+                             "and report the top allocation sites")
+    parser.add_argument("-e", "--estimate", action="store_true",
+                        help="Estimate the domain risk distribution from a stratified sample of principals")
+    parser.add_argument("--sample-size", type=int,
+                        help="Number of principals to sample with --estimate (default: derived from --error-bound)")
+    parser.add_argument("--error-bound", type=float, default=0.05,
+                        help="Largest acceptable confidence interval half width of a risk level's share "
+                             "with --estimate (default: 0.05)")
+    parser.add_argument("-a", "--all-users", action="store_true",
+                        help="Assess every enabled user in a fetch/model/score pipeline and report the riskiest ones")
+    parser.add_argument("-i", "--inherited", action="store_true",
+                        help="Also assess the rights a user inherits through nested group membership")
+    parser.add_argument("--adcs", action="store_true",
+                        help="Also assess certificate based escalations (ESC1, ESC3) from the ADCS templates and CAs")
+    parser.add_argument("--aggregate", action="store_true",
+                        help="Group the user's edges by edge type and target class in Neo4j and score the groups "
+                             "instead of every single path, for principals with a very high fan-out")
+    parser.add_argument("--details", metavar="FILE",
+                        help="Write every assessed path to FILE, a Parquet (.parquet) or Arrow IPC (.arrow) file")
+    parser.add_argument("--event-logs", metavar="FILE", nargs="+",
+                        help="Derive the EventMonitoringConfig from exported Windows event logs, JSON Lines "
+                             "(.json, .jsonl, .ndjson) or CSV (.csv), instead of trusting config.json")
+    parser.add_argument("--event-window", default=DEFAULT_WINDOW,
+                        help="Only events within this period before the newest logged event count with "
+                             f"--event-logs (default: {DEFAULT_WINDOW})")
+    parser.add_argument("--event-coverage", type=float, default=DEFAULT_MIN_COVERAGE,
+                        help="Share of the hosts that must have logged an event for it to count as monitored "
+                             f"with --event-logs (default: {DEFAULT_MIN_COVERAGE})")
+    parser.add_argument("--event-hosts", metavar="HOST", nargs="+",
+                        help="Hosts expected to log the events, e.g. all domain controllers "
+                             "(default: every host found in the event logs)")
+    parser.add_argument("-r", "--rule", metavar="RULE",
+                        help="List every node matching the attribute rule RULE, evaluated by Neo4j where the rule "
+                             "can be compiled to Cypher")
+    parser.add_argument("--choke-points", metavar="N", type=int, nargs="?", const=20,
+                        help="Report the N nodes and edges (default: 20) that carry the most high-risk shortest "
+                             "paths of all principals to Tier Zero, Tier One and privileged targets")
+    parser.add_argument("name", type=str, nargs="?",
                         help="The name of the user to analyze")
 
     args = parser.parse_args()
+    if args.name is None and not (args.estimate or args.all_users or args.event_logs or args.rule or
+                                  args.choke_points):
+        parser.error("name is required unless --estimate, --all-users, --event-logs, --rule or --choke-points "
+                     "is given")
+    if args.choke_points is not None and args.choke_points < 1:
+        parser.error("--choke-points must be at least 1")
+    if args.event_logs and not convert_to_timestamp(args.event_window):
+        parser.error("--event-window must be a period like '7 days' or '1 month'")
 
     # Read configuration from config file
     try:
@@ -86,6 +261,7 @@ if __name__ == "__main__":
             neo4j_config = config.get("Neo4jConfig", {})
             rules_config = config.get("RulesConfig", {})
             event_monitoring_config = config.get("EventMonitoringConfig", {})
+            query_cache_config = config.get("QueryCacheConfig")
     except FileNotFoundError:
         raise Exception("Configuration file 'config.json' not found.")
     except json.JSONDecodeError:
@@ -95,14 +271,31 @@ if __name__ == "__main__":
         Logging().set_console_log_level("DEBUG")
 
     logger.info("Starting CADRA...")
-    main(neo4j_uri=neo4j_config.get("uri"),
-         neo4j_user=neo4j_config.get("user"),
-         neo4j_password=neo4j_config.get("password"),
-         name=args.name,
-         attributes_rules_dir_path=rules_config.get(
-             "attributes_rules_dir_path", "rules/attributes"),
-         permission_rules_dir_path=rules_config.get(
-             "permissions_rules_dir_path", "rules/permissions"),
-         event_monitoring_config=event_monitoring_config
-         )
+    with profiling(args.profile) if args.profile else nullcontext():
+        main(graph_sources=parse_graph_sources(neo4j_config),
+             name=args.name,
+             attributes_rules_dir_path=rules_config.get(
+                 "attributes_rules_dir_path", "rules/attributes"),
+             permission_rules_dir_path=rules_config.get(
+                 "permissions_rules_dir_path", "rules/permissions"),
+             event_monitoring_config=event_monitoring_config,
+             target_mode=args.target,
+             rules_cache_dir=rules_config.get("cache_dir", ".cadra_cache"),
+             estimate_mode=args.estimate,
+             sample_size=args.sample_size,
+             error_bound=args.error_bound,
+             details_path=args.details,
+             inherited=args.inherited,
+             all_users=args.all_users,
+             adcs=args.adcs,
+             aggregate=args.aggregate,
+             event_logs=args.event_logs,
+             event_window=args.event_window,
+             event_coverage=args.event_coverage,
+             event_hosts=args.event_hosts,
+             query_cache=QueryCache.from_config(query_cache_config) if query_cache_config is not None else None,
+             rule_name=args.rule,
+             rule_packs=rules_config.get("rule_packs"),
+             choke_points=args.choke_points
+             )
     logger.info("CADRA finished.")
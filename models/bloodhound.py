@@ -17,11 +17,11 @@ NODE_TYPES = {node_type.name: node_type.value for node_type in NodeType}
 
 
 class EdgeType(Enum):
-    ADCSESC1 = "ADCSES1"
-    ADCSESC3 = "ADCSES3"
-    ADCSESC6A = "ADCSES6a"
-    ADCSESC9A = "ADCSES9a"
-    ADCSESC10A = "ADCSES10a"
+    ADCSESC1 = "ADCSESC1"
+    ADCSESC3 = "ADCSESC3"
+    ADCSESC6A = "ADCSESC6a"
+    ADCSESC9A = "ADCSESC9a"
+    ADCSESC10A = "ADCSESC10a"
     ADD_ALLOWED_TO_ACT = "AddAllowedToAct"
     ADD_KEY_CREDENTIAL_LINK = "AddKeyCredentialLink"
     ADD_MEMBER = "AddMember"
@@ -41,10 +41,12 @@ class EdgeType(Enum):
     MANAGE_CERTIFICATES = "ManageCertificates"
     MEMBER_OF = "MemberOf"
     OWNS = "Owns"
+    PUBLISHED_TO = "PublishedTo"
     READ_GMSA_PASSWORD = "ReadGMSAPassword"
     READ_LAPS_PASSWORD = "ReadLAPSPassword"
     SQL_ADMIN = "SQLAdmin"
     SYNC_LAPS_PASSWORD = "SyncLAPSPassword"
+    TRUSTED_FOR_NT_AUTH = "TrustedForNTAuth"
     WRITE_ACCOUNT_RESTRICTIONS = "WriteAccountRestrictions"
     WRITE_DACL = "WriteDacl"
     WRITE_OWNER = "WriteOwner"
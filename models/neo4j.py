@@ -1,51 +1,36 @@
 from dataclasses import dataclass
 from neo4j import Record
-from typing import Any, List
+from typing import Any, Iterable, Iterator, List, Optional
 
 from models.active_directory import UAC_FLAGS, GENERIC_PROPERTIES, PRINCIPAL_PROPERTIES
 from models.bloodhound import NODE_ATTRIBUTES, EdgeType
 from modules.logging_base import Logging
-from modules.neo4j_utils import get_node_type_from_labels, get_uac_flags_from_properties
+from modules.neo4j_utils import (DetachedNode, DetachedRelationship, get_node_type_from_labels,
+                                 get_uac_flags_from_properties)
 
 logger = Logging().getLogger()
 
 
-@dataclass
-class UserPaths:
-    def __init__(self, records: List[Record]) -> None:
-        self.user: User = None
-        self.paths: List[Path] = []
-        self._consume_paths(records)
-
-    def _consume_paths(self, records: List[Record]) -> None:
-        for record in records:
-            path = Path(record["p"])
-            if isinstance(path.start_node, User):
-                if self.user is None:
-                    self.user = path.start_node
-                elif self.user.id != path.start_node.id:
-                    logger.error("Inconsistent user in paths")
-                    return
-            else:
-                logger.error("Path does not start with a User node")
-                return
-            self.paths.append(path)
-            if path.relationship.type == EdgeType.MEMBER_OF.value:
-                self.user.memberof.append(path.end_node.samaccountname)
-            if path.relationship.type not in self.user.edges:
-                self.user.edges.append(path.relationship.type)
+def iter_user_paths(records: Iterable[Any], user: "User") -> Iterator["Path"]:
+    # Paths of a user streamed from its direct path records, every path shares the already built
+    # user as start node. The user's memberof and edges have to be known upfront, see neo4j_utils.get_user_summary
+    for record in records:
+        path = Path(record, start_node=user)
+        if path.start_node.id != user.id:
+            logger.error("Inconsistent user in paths")
+            return
+        yield path
 
 
 @dataclass
 class Path:
-    def __init__(self, record: Record) -> None:
+    def __init__(self, record: Record, start_node: Optional["Node"] = None) -> None:
         self.relationship = Edge(record.relationships[0])
-        self.start_node = Node(record.start_node)
-        if self.start_node.type == "User":
-            self.start_node = User(record.start_node)
-        self.end_node = Node(record.end_node)
-        if self.end_node.type == "User":
-            self.end_node = User(record.end_node)
+        if start_node is not None and start_node.id == record.start_node.element_id:
+            self.start_node = start_node
+        else:
+            self.start_node = node_from_record(record.start_node)
+        self.end_node = node_from_record(record.end_node)
 
         if not self.validate():
             logger.error("Path validation failed")
@@ -69,6 +54,79 @@ class Path:
             f" - [{r_type}] -> ({end_node_name}: {self.end_node.type})"
 
 
+class InheritedPath(Path):
+    """Single hop path of a group, inherited by a member of the group or of a nested group."""
+
+    def __init__(self, record: Record, start_node: "Node") -> None:
+        # record is the path of the group holding the right, start_node the principal inheriting it
+        self.relationship = Edge(record.relationships[0])
+        self.start_node = start_node
+        self.end_node = node_from_record(record.end_node)
+        self.granted_by_id = record.start_node.element_id
+        self.granted_by = record.start_node._properties.get('name')
+
+        if not self.validate():
+            logger.error("Path validation failed")
+
+    def validate(self) -> bool:
+        if self.granted_by_id != self.relationship.start_node_id:
+            logger.error(
+                f"Granting group ID '{self.granted_by_id}' does not match relationship start node ID '{self.relationship.start_node_id}'")
+            return False
+        if self.end_node.id != self.relationship.end_node_id:
+            logger.error(
+                f"End node ID '{self.end_node.id}' does not match relationship end node ID '{self.relationship.end_node_id}'")
+            return False
+        return True
+
+    def __str__(self):
+        start_node_name = self.start_node.properties.get('name')
+        end_node_name = self.end_node.properties.get('name')
+        return f"({start_node_name}: {self.start_node.type}) - [{EdgeType.MEMBER_OF.value}*] -> ({self.granted_by})" + \
+            f" - [{self.relationship.type}] -> ({end_node_name}: {self.end_node.type})"
+
+
+class EscalationPath(Path):
+    """Single hop path of an ADCS escalation the principal can perform, see modules.adcs_index."""
+
+    def __init__(self, record: Record, start_node: "Node", templates: List[str], cas: List[str]) -> None:
+        # record is a synthetic path from the principal to the domain, templates and cas are names
+        super().__init__(record, start_node)
+        self.templates = templates
+        self.cas = cas
+
+    def __str__(self):
+        start_node_name = self.start_node.properties.get('name')
+        end_node_name = self.end_node.properties.get('name')
+        return f"({start_node_name}: {self.start_node.type})" + \
+            f" - [{self.relationship.type} via {', '.join(self.templates)} @ {', '.join(self.cas)}]" + \
+            f" -> ({end_node_name}: {self.end_node.type})"
+
+
+class CompositePath(Path):
+    """Single hop path of a compound right, held through all of its component edges on the same target."""
+
+    def __init__(self, components: List[Path], edge_type: str) -> None:
+        # components share start and end node, the relationship is synthetic, see modules.composite_rules
+        self.components = components
+        self.start_node = components[0].start_node
+        self.end_node = components[0].end_node
+        start_node = DetachedNode(self.start_node.id, [self.start_node.type], self.start_node.properties)
+        end_node = DetachedNode(self.end_node.id, [self.end_node.type], self.end_node.properties)
+        self.relationship = Edge(DetachedRelationship(
+            "+".join(component.relationship.id for component in components), edge_type, start_node, end_node))
+
+        if not self.validate():
+            logger.error("Path validation failed")
+
+    def __str__(self):
+        start_node_name = self.start_node.properties.get('name')
+        end_node_name = self.end_node.properties.get('name')
+        component_types = " + ".join(component.relationship.type for component in self.components)
+        return f"({start_node_name}: {self.start_node.type})" + \
+            f" - [{component_types} => {self.relationship.type}] -> ({end_node_name}: {self.end_node.type})"
+
+
 @dataclass
 class Node:
     def __init__(self, record: Record) -> None:
@@ -105,13 +163,25 @@ class Node:
 @dataclass
 class Edge:
     def __init__(self, relationship) -> None:
-        self.id = relationship.id
+        self.id = relationship.element_id
         self.type = relationship.type
         self.start_node_id = relationship.start_node.element_id
-        self.start_name = relationship.start_node._properties.get('name')
         self.end_node_id = relationship.end_node.element_id
-        self.end_name = relationship.end_node._properties.get('name')
-        self.relationship_description = f"{self.start_name} -[{self.type}]-> {self.end_name}"
+        # Names are only needed for output, keep a reference instead of copying them for every edge
+        self._start_properties = relationship.start_node._properties
+        self._end_properties = relationship.end_node._properties
+
+    @property
+    def start_name(self) -> str:
+        return self._start_properties.get('name')
+
+    @property
+    def end_name(self) -> str:
+        return self._end_properties.get('name')
+
+    @property
+    def relationship_description(self) -> str:
+        return f"{self.start_name} -[{self.type}]-> {self.end_name}"
 
     def __str__(self):
         return f"Edge(type={self.type}, from={self.start_name}, to={self.end_name})"
@@ -149,3 +219,12 @@ class User(Node):
                 edges={self.edges}  
             )
         """
+
+
+def node_from_record(record: Record, memberof: Optional[List[str]] = None) -> Node:
+    # Builds a User for user nodes, memberof holds the names of the groups the user is a direct member of
+    if get_node_type_from_labels(record.labels) == "User":
+        user = User(record)
+        user.memberof = list(memberof or [])
+        return user
+    return Node(record)
@@ -0,0 +1,239 @@
+# Certificate based escalations (ESC1, ESC3) of every principal, precomputed once per graph.
+#
+# An escalation needs enrollment rights on one or two certificate templates, enrollment
+# rights on the Enterprise CAs publishing them and template flags that allow to
+# authenticate as someone else. Joining this per principal is expensive, so the
+# AdcsIndex loads templates, CAs, enrollment rights and all MemberOf edges once:
+#
+#   1. the candidate escalations follow from the templates and CAs alone,
+#   2. the enrollment rights of every principal are the union of its own rights and the
+#      rights of all its (nested) groups, computed once per strongly connected component
+#      of the membership graph,
+#   3. every principal is mapped to the candidates its rights cover. Principals with
+#      equal rights share one escalation tuple.
+#
+# The escalations are assessed like edges from the principal to the domain, typed with
+# the BloodHound edge type of the technique, so they need a permission rule of that name.
+
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+
+import neo4j
+
+from models.bloodhound import EdgeType, NodeType
+from models.neo4j import EscalationPath, Node
+from modules.logging_base import Logging
+from modules.neo4j_utils import DetachedNode, DetachedPath, DetachedRelationship
+from modules.utils import strongly_connected_components
+
+logger = Logging().getLogger()
+
+# Rights that allow to enroll on a template or a CA
+ENROLLMENT_RIGHTS = [EdgeType.ENROLL.value, EdgeType.GENERIC_ALL.value, EdgeType.ALL_EXTENDED_RIGHTS.value]
+
+CERTIFICATE_REQUEST_AGENT_EKU = "1.3.6.1.4.1.311.20.2.1"
+ANY_PURPOSE_EKU = "2.5.29.37.0"
+
+Rights = Tuple[FrozenSet[str], FrozenSet[str]]  # (template ids, CA ids) a principal can enroll on
+
+
+@dataclass(frozen=True)
+class AdcsEscalation:
+    technique: str               # edge type, e.g. ADCSESC1
+    domain_id: str
+    template_ids: Tuple[str, ...]  # ESC3: (enrollment agent template, target template)
+    ca_ids: Tuple[str, ...]
+
+
+class AdcsIndex:
+    def __init__(self, escalations: List[AdcsEscalation], principal_escalations: Dict[str, Tuple[AdcsEscalation, ...]],
+                 nodes: Dict[str, DetachedNode]) -> None:
+        self.escalations = escalations
+        self.principal_escalations = principal_escalations
+        # Templates, CAs and domains by element id, for the synthetic paths
+        self.nodes = nodes
+
+    def __len__(self):
+        return len(self.principal_escalations)
+
+    def get(self, principal_id: str) -> Tuple[AdcsEscalation, ...]:
+        return self.principal_escalations.get(principal_id, ())
+
+    @classmethod
+    def from_session(cls, session: neo4j.Session) -> "AdcsIndex":
+        nodes: Dict[str, DetachedNode] = {}
+        published: Dict[str, List[str]] = {}
+        for record in session.run(
+                f"MATCH (t:{NodeType.CERT_TEMPLATE.value}) "
+                "RETURN elementId(t) AS id, labels(t) AS labels, properties(t) AS properties, "
+                f"[(t)-[:{EdgeType.PUBLISHED_TO.value}]->(ca:{NodeType.ENTERPRISE_CA.value}) | elementId(ca)] AS cas"):
+            nodes[record["id"]] = DetachedNode(record["id"], record["labels"], record["properties"])
+            published[record["id"]] = list(record["cas"])
+
+        nt_auth_cas = set()
+        for record in session.run(
+                f"MATCH (ca:{NodeType.ENTERPRISE_CA.value}) "
+                "RETURN elementId(ca) AS id, labels(ca) AS labels, properties(ca) AS properties, "
+                f"EXISTS {{ (ca)-[:{EdgeType.TRUSTED_FOR_NT_AUTH.value}]->() }} AS nt_auth"):
+            nodes[record["id"]] = DetachedNode(record["id"], record["labels"], record["properties"])
+            if record["nt_auth"]:
+                nt_auth_cas.add(record["id"])
+
+        domains: Dict[str, str] = {}
+        for record in session.run(
+                f"MATCH (d:{NodeType.DOMAIN.value}) "
+                "RETURN elementId(d) AS id, labels(d) AS labels, properties(d) AS properties"):
+            nodes[record["id"]] = DetachedNode(record["id"], record["labels"], record["properties"])
+            if record["properties"].get('objectid'):
+                domains[record["properties"]['objectid']] = record["id"]
+
+        rights: Dict[str, Tuple[Set[str], Set[str]]] = {}
+        for record in session.run(
+                "MATCH (p)-[r]->(x) WHERE type(r) IN $rights AND "
+                f"(x:{NodeType.CERT_TEMPLATE.value} OR x:{NodeType.ENTERPRISE_CA.value}) "
+                f"RETURN elementId(p) AS principal_id, elementId(x) AS target_id",
+                rights=ENROLLMENT_RIGHTS):
+            templates, cas = rights.setdefault(record["principal_id"], (set(), set()))
+            (templates if record["target_id"] in published else cas).add(record["target_id"])
+
+        parents: Dict[str, List[str]] = {}
+        for record in session.run(
+                f"MATCH (n)-[:{EdgeType.MEMBER_OF.value}]->(g:{NodeType.GROUP.value}) "
+                "RETURN elementId(n) AS member_id, elementId(g) AS group_id"):
+            parents.setdefault(record["member_id"], []).append(record["group_id"])
+
+        escalations = candidate_escalations(nodes, published, nt_auth_cas, domains)
+        principal_escalations = map_principals(escalations, rights, parents)
+        logger.info(f"ADCS index: {len(escalations)} candidate escalations, "
+                    f"{len(principal_escalations)} principals can perform at least one")
+        return cls(escalations, principal_escalations, nodes)
+
+    def iter_escalation_paths(self, principal: Node, skip_techniques: Iterable[str] = ()) -> Iterator[EscalationPath]:
+        # skip_techniques are edge types the graph already has for the principal, e.g. from BloodHound's post-processing
+        skip_techniques = set(skip_techniques)
+        start_node = None
+        for escalation in self.get(principal.id):
+            if escalation.technique in skip_techniques:
+                continue
+            if start_node is None:
+                start_node = DetachedNode(principal.id, [principal.type], principal.properties)
+            relationship = DetachedRelationship(
+                f"{escalation.technique}:{':'.join(escalation.template_ids)}@{':'.join(escalation.ca_ids)}",
+                escalation.technique, start_node, self.nodes[escalation.domain_id])
+            yield EscalationPath(DetachedPath(start_node, relationship), principal,
+                                 [self._name(node_id) for node_id in escalation.template_ids],
+                                 [self._name(node_id) for node_id in escalation.ca_ids])
+
+    def _name(self, node_id: str) -> str:
+        return self.nodes[node_id]._properties.get('name', node_id)
+
+
+def candidate_escalations(nodes: Dict[str, DetachedNode], published: Dict[str, List[str]],
+                          nt_auth_cas: Set[str], domains: Dict[str, str]) -> List[AdcsEscalation]:
+    # published maps every template to the CAs publishing it, domains maps domain SIDs to element ids
+    escalations = []
+    ca_domains = {}
+    for ca_id in nt_auth_cas:
+        domain_id = domains.get(nodes[ca_id]._properties.get('domainsid'))
+        if domain_id is None:
+            logger.debug(f"No domain for CA {nodes[ca_id]._properties.get('name')}")
+            continue
+        ca_domains[ca_id] = domain_id
+
+    agent_templates = []
+    target_templates = []
+    for template_id, ca_ids in published.items():
+        properties = nodes[template_id]._properties
+        if properties.get('requiresmanagerapproval', False):
+            continue
+        if _is_esc1_template(properties):
+            for ca_id in ca_ids:
+                if ca_id in ca_domains:
+                    escalations.append(AdcsEscalation(EdgeType.ADCSESC1.value, ca_domains[ca_id],
+                                                      (template_id,), (ca_id,)))
+        if _is_enrollment_agent_template(properties):
+            agent_templates.append(template_id)
+        if _is_on_behalf_template(properties):
+            target_templates.append(template_id)
+
+    # ESC3: an enrollment agent certificate from any CA, then a certificate on behalf of someone else
+    for agent_template_id in agent_templates:
+        for agent_ca_id in published[agent_template_id]:
+            for target_template_id in target_templates:
+                for ca_id in published[target_template_id]:
+                    if ca_id in ca_domains:
+                        escalations.append(AdcsEscalation(
+                            EdgeType.ADCSESC3.value, ca_domains[ca_id],
+                            (agent_template_id, target_template_id), (agent_ca_id, ca_id)))
+    return escalations
+
+
+def map_principals(escalations: List[AdcsEscalation], rights: Dict[str, Tuple[Set[str], Set[str]]],
+                   parents: Dict[str, List[str]]) -> Dict[str, Tuple[AdcsEscalation, ...]]:
+    # rights holds the direct enrollment rights, parents the direct groups of every member
+    if not escalations:
+        return {}
+    empty: Rights = (frozenset(), frozenset())
+    effective: Dict[str, Rights] = {}
+    nodes = set(rights) | set(parents)
+    for component in strongly_connected_components(nodes, parents):
+        # Tarjan emits the groups of a member before the member, see GroupPermissionIndex.expand
+        templates: Set[str] = set()
+        cas: Set[str] = set()
+        members = set(component)
+        for node_id in component:
+            own_templates, own_cas = rights.get(node_id, empty)
+            templates.update(own_templates)
+            cas.update(own_cas)
+            for parent_id in parents.get(node_id, []):
+                if parent_id not in members:
+                    parent_templates, parent_cas = effective.get(parent_id, empty)
+                    templates.update(parent_templates)
+                    cas.update(parent_cas)
+        shared = (frozenset(templates), frozenset(cas))
+        for node_id in component:
+            effective[node_id] = shared
+
+    by_rights: Dict[Rights, Tuple[AdcsEscalation, ...]] = {}
+    principal_escalations = {}
+    for node_id, (templates, cas) in effective.items():
+        if not templates or not cas:
+            continue
+        key = (templates, cas)
+        if key not in by_rights:
+            by_rights[key] = tuple(escalation for escalation in escalations
+                                   if templates.issuperset(escalation.template_ids) and cas.issuperset(escalation.ca_ids))
+        if by_rights[key]:
+            principal_escalations[node_id] = by_rights[key]
+    return principal_escalations
+
+
+def _has_no_authorized_signatures(properties: dict) -> bool:
+    return properties.get('schemaversion', 1) <= 1 or properties.get('authorizedsignatures', 0) == 0
+
+
+def _effective_ekus(properties: dict) -> Optional[List[str]]:
+    # None if the template has no EKUs, i.e. any purpose
+    ekus = properties.get('effectiveekus')
+    return list(ekus) if ekus else None
+
+
+def _is_esc1_template(properties: dict) -> bool:
+    return bool(properties.get('enrolleesuppliessubject', False)) and \
+        bool(properties.get('authenticationenabled', False)) and _has_no_authorized_signatures(properties)
+
+
+def _is_enrollment_agent_template(properties: dict) -> bool:
+    ekus = _effective_ekus(properties)
+    return _has_no_authorized_signatures(properties) and \
+        (ekus is None or CERTIFICATE_REQUEST_AGENT_EKU in ekus or ANY_PURPOSE_EKU in ekus)
+
+
+def _is_on_behalf_template(properties: dict) -> bool:
+    # Schema version 1 templates accept any enrollment agent, later ones need exactly the agent's signature
+    if not properties.get('authenticationenabled', False):
+        return False
+    if properties.get('schemaversion', 1) <= 1:
+        return True
+    return properties.get('authorizedsignatures', 0) == 1 and \
+        CERTIFICATE_REQUEST_AGENT_EKU in (properties.get('applicationpolicies') or [])
@@ -0,0 +1,93 @@
+import itertools
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import neo4j
+
+from models.neo4j import User, iter_user_paths, node_from_record
+from modules.adcs_index import AdcsIndex
+from modules.attribute_assessment import assess_user_attributes
+from modules.group_expansion import GroupPermissionIndex
+from modules.impact_index import ImpactIndex
+from modules.logging_base import Logging
+from modules.neo4j_utils import get_node_by_name, get_user_summary, stream_direct_user_paths
+from modules.permission_assessment import PathAssessment, assess_permissions
+from modules.profiling import profile_iter, profile_stage
+from modules.reverse_reachability import InboundPrincipal, ReverseAdjacencyIndex, assess_inbound_principals
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+
+@dataclass
+class UserAssessment:
+    name: str
+    adass_score: float
+    cadra_score: int  # 0 if the user has no assessable paths
+    path_count: int
+
+
+def assess_user(session: neo4j.Session, name: str, attribute_rule_engine: RuleEngine,
+                permission_rules: Dict[str, Dict], event_monitoring_config: dict,
+                path_sink: Optional[Callable[[PathAssessment], None]] = None,
+                impact_index: Optional[ImpactIndex] = None,
+                group_index: Optional[GroupPermissionIndex] = None,
+                adcs_index: Optional[AdcsIndex] = None) -> Optional[UserAssessment]:
+    # With group_index the rights inherited through (nested) group membership are assessed as well,
+    # with adcs_index the certificate based escalations of the user
+    logger.debug(f"Fetching user: {name}")
+    with profile_stage("fetch", snapshot=True):
+        record = get_user_summary(session, name)
+    if record is None:
+        logger.error(f"User {name} not found in the database.")
+        return None
+    # memberof and edges are fetched upfront, so the paths can be streamed straight into the scoring
+    with profile_stage("model"):
+        user: User = node_from_record(record["n"], record["memberof"])
+        user.edges = list(record["edges"])
+
+    logger.debug(f"User object: {user}")
+    with profile_stage("adass", snapshot=True):
+        adass_score = assess_user_attributes(user, attribute_rule_engine)
+    logger.info(f"Attribute Assessment: {adass_score}")
+
+    cadra_score = 0
+    path_count = 0
+    if user.edges:
+        logger.info(f"Direct paths for user {name}:")
+        # Fetching and model building happen lazily while assess_permissions consumes the paths
+        paths = profile_iter("model", iter_user_paths(
+            profile_iter("fetch", stream_direct_user_paths(session, record["n"])), user))
+        if group_index is not None:
+            paths = itertools.chain(paths, profile_iter("model", group_index.iter_inherited_paths(
+                user, record["group_ids"])))
+        if adcs_index is not None:
+            paths = itertools.chain(paths, adcs_index.iter_escalation_paths(user, skip_techniques=user.edges))
+        # zip stops at the end of the paths without advancing the counter once more
+        counter = itertools.count()
+        with profile_stage("assess_permissions", snapshot=True):
+            cadra_score = assess_permissions(
+                (path for path, _ in zip(paths, counter)), permission_rules, attribute_rule_engine, adass_score,
+                event_monitoring_config, path_sink, impact_index)
+        path_count = next(counter)
+        logger.info(f"CADRA Score: {cadra_score}")
+    else:
+        logger.info(f"User {name} found but has no direct paths, skipping permission assessment.")
+
+    return UserAssessment(name=name, adass_score=adass_score, cadra_score=cadra_score, path_count=path_count)
+
+
+def assess_target(session: neo4j.Session, name: str, attribute_rule_engine: RuleEngine,
+                  permission_rules: Dict[str, Dict], event_monitoring_config: dict,
+                  index: Optional[ReverseAdjacencyIndex] = None) -> Optional[List[InboundPrincipal]]:
+    logger.debug(f"Fetching target object: {name}")
+    with profile_stage("fetch", snapshot=True):
+        record = get_node_by_name(session, name)
+    if record is None:
+        logger.error(f"Object {name} not found in the database.")
+        return None
+    with profile_stage("model"):
+        target = node_from_record(record["n"], record["memberof"])
+
+    return assess_inbound_principals(
+        session, target, permission_rules, attribute_rule_engine, event_monitoring_config, index)
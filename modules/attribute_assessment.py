@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List, Optional
 
 from models.neo4j import User
 from modules.rule_engine import RuleEngine
@@ -8,39 +8,36 @@ from modules.adass import ADASS
 logger = Logging().getLogger()
 
 
-def assess_user_attributes(user: User, rule_engine: RuleEngine) -> float:
+def assess_user_attributes(user: User, rule_engine: RuleEngine, pack: Optional[str] = None) -> float:
+    # The score only depends on the matching rules, so it is shared by all nodes the rule engine considers equivalent.
+    # With several rule packs loaded, pack selects the rules the score is based on.
+    key = 'adass_score' if pack is None else f'adass_score:{pack}'
+    return rule_engine.get_shared_result(user, key, lambda: _assess_user_attributes(user, rule_engine, pack))
 
-    # Evaluate the user's attributes against the loaded rules
-    matching_rules = rule_engine.get_matching_rules(user)
-    logger.info(f"Matching Rules: {[rule['rule_name'] for rule in matching_rules]}")
 
-    adass_metrics_dict: Dict[str, str] = {}
-    for rule in matching_rules:
-        if rule['metric'] in adass_metrics_dict and adass_metrics_dict[rule['metric']] != rule['value']:
-            adass_metrics_dict[rule['metric']] = rule['value']
-            logger.warning(
-                f"Overwriting ADASS metric {rule['metric']} from {adass_metrics_dict[rule['metric']]} to {rule['value']}")
-        else:
-            adass_metrics_dict[rule['metric']] = rule['value']
+def _assess_user_attributes(user: User, rule_engine: RuleEngine, pack: Optional[str] = None) -> float:
+
+    # Evaluate the user's attributes against the loaded rules
+    adass_metrics_dict = _adass_metrics(user, rule_engine, pack)
+    logger.info(f"ADASS metrics from the attribute rules: {adass_metrics_dict}")
 
     adass_string_parts = [f"{key}:{value}" for key, value in adass_metrics_dict.items()]
 
     # CIA rules
-    matching_rule_names = [rule['rule_name'] for rule in matching_rules]
     # Confidentiality
     high_confidentiality_rules = ['Tier Zero Object']
     low_confidentiality_rules = ['Service Account']
-    adass_string_parts.append(_check_cia_rules(matching_rule_names, "C",
+    adass_string_parts.append(_check_cia_rules(user, rule_engine, pack, "C",
                               high_confidentiality_rules, low_confidentiality_rules, "L"))
     # Integrity
     high_integrity_rules = ['Tier Zero Object']
     low_integrity_rules = ['Service Account']
-    adass_string_parts.append(_check_cia_rules(matching_rule_names, "I",
+    adass_string_parts.append(_check_cia_rules(user, rule_engine, pack, "I",
                               high_integrity_rules, low_integrity_rules, "L"))
     # Availability
     high_availability_rules = ['Tier Zero Object']
     low_availability_rules = ['Service Account']
-    adass_string_parts.append(_check_cia_rules(matching_rule_names, "A",
+    adass_string_parts.append(_check_cia_rules(user, rule_engine, pack, "A",
                               high_availability_rules, low_availability_rules, "N"))
 
     logger.debug(f"ADASS String: {'/'.join(adass_string_parts)}")
@@ -49,11 +46,29 @@ def assess_user_attributes(user: User, rule_engine: RuleEngine) -> float:
     return score
 
 
-def _check_cia_rules(matching_rule_names: list[str], metric: str,
+def _adass_metrics(user: User, rule_engine: RuleEngine, pack: Optional[str]) -> Dict[str, str]:
+    # Every metric takes the value of its last matching rule, so the rules of a metric are queried
+    # from the last one backwards and the rules before the first match are never evaluated
+    rules_by_metric: Dict[str, List[Dict]] = {}
+    for rule in rule_engine.rules:
+        if pack is None or rule.get('Pack') == pack:
+            rules_by_metric.setdefault(rule.get('Metric'), []).append(rule)
+
+    adass_metrics_dict: Dict[str, str] = {}
+    for metric, rules in rules_by_metric.items():
+        for rule in reversed(rules):
+            if rule_engine.rule_result(user, rule)['matches']:
+                adass_metrics_dict[metric] = rule.get('Value')
+                break
+    return adass_metrics_dict
+
+
+def _check_cia_rules(user: User, rule_engine: RuleEngine, pack: Optional[str], metric: str,
                      high_rules: list[str], low_rules: list[str], default_value: str) -> str:
-    if any(rule in matching_rule_names for rule in high_rules):
+    # High wins over low, the low rules are only queried if no high rule matches
+    if rule_engine.first_matching_rule(user, high_rules, pack) is not None:
         return f"{metric}:H"
-    elif any(rule in matching_rule_names for rule in low_rules):
+    elif rule_engine.first_matching_rule(user, low_rules, pack) is not None:
         return f"{metric}:L"
     else:
         return f"{metric}:{default_value}"
@@ -0,0 +1,239 @@
+# Choke-point analysis: which edges and intermediate nodes carry the most high-risk paths.
+#
+# For every scored impact class (Tier Zero, Tier One, privileged/service accounts) the
+# targets of that class are joined into one virtual sink and a single reverse
+# breadth-first search over the ReverseAdjacencyIndex builds the shortest-path DAG of
+# every principal that can reach the class, following the same expansion rules as the
+# target-centric assessment. Every principal is rated for every class it reaches and
+# keeps the class with its highest risk.
+#
+# The principals are then pushed through their DAG with Brandes-style dependency
+# accumulation: a principal contributes one unit (and its qualitative risk) that is
+# split over its shortest paths in proportion to the number of paths through each
+# edge. This counts paths without enumerating them, each pass is linear in the number
+# of edges.
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import neo4j
+
+from models.neo4j import node_from_record
+from modules.attribute_assessment import assess_user_attributes
+from modules.impact_index import ImpactIndex, build_impact_index
+from modules.logging_base import Logging
+from modules.neo4j_utils import get_nodes_by_ids
+from modules.permission_assessment import (ImpactClass, _assess_edge_likelihood, _impact_from_class,
+                                           _qualitative_risk)
+from modules.reverse_reachability import ReverseAdjacencyIndex, _is_expandable
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+# Impact classes a principal can be rated for, NONE targets are not worth a path
+SCORED_IMPACT_CLASSES = [ImpactClass.TIER_ZERO, ImpactClass.TIER_ONE, ImpactClass.PRIVILEGED_OR_SERVICE_ACCOUNT]
+
+# Nodes are fetched in batches of this size for the attribute assessment and the report
+NODE_BATCH_SIZE = 1000
+
+EdgeKey = Tuple[str, str, str]  # (source id, edge type, target id)
+
+
+@dataclass
+class NodeChokePoint:
+    node_id: str
+    name: Optional[str]
+    principals: float      # principals whose highest risk paths pass through the node, split over their paths
+    weighted_risk: float   # the same, weighted by the qualitative risk of every principal
+
+
+@dataclass
+class EdgeChokePoint:
+    source_id: str
+    edge_type: str
+    target_id: str
+    source_name: Optional[str]
+    target_name: Optional[str]
+    principals: float
+    weighted_risk: float
+
+    def __str__(self):
+        return f"({self.source_name}) - [{self.edge_type}] -> ({self.target_name}): " + \
+            f"{self.principals:.1f} principal(s), weighted risk {self.weighted_risk:.1f}"
+
+
+@dataclass
+class ChokePointReport:
+    principal_count: int
+    nodes: List[NodeChokePoint] = field(default_factory=list)
+    edges: List[EdgeChokePoint] = field(default_factory=list)
+
+
+@dataclass
+class ChokePointFlows:
+    principal_risk: Dict[str, int]                 # highest qualitative risk per principal that reaches a target
+    node_principals: Dict[str, float]
+    node_weighted_risk: Dict[str, float]
+    edge_principals: Dict[EdgeKey, float]
+    edge_weighted_risk: Dict[EdgeKey, float]
+
+
+class _ShortestPathDag:
+    def __init__(self, index: ReverseAdjacencyIndex, target_ids: List[str], permission_rules: Dict[str, Dict]):
+        self.targets = set(target_ids)
+        # Number of shortest paths from every node to any target
+        self.sigma: Dict[str, int] = {target_id: 1 for target_id in self.targets}
+        # Whether a shortest path of the node ends with a traversable edge into the target
+        self.final_traversable: Dict[str, bool] = {}
+        # DAG edges in discovery order, i.e. by increasing distance to the targets
+        self.edges: List[EdgeKey] = []
+
+        distance = {target_id: 0 for target_id in self.targets}
+        queue = deque(self.targets)
+        while queue:
+            node_id = queue.popleft()
+            level = distance[node_id] + 1
+            is_target = node_id in self.targets
+            for source_id, edge_type in index.inbound.get(node_id, []):
+                if not is_target and not _is_expandable(edge_type, permission_rules):
+                    continue
+                source_level = distance.get(source_id)
+                if source_level is None:
+                    distance[source_id] = level
+                    self.sigma[source_id] = 0
+                    queue.append(source_id)
+                elif source_level != level:
+                    continue
+                self.sigma[source_id] += self.sigma[node_id]
+                self.edges.append((source_id, edge_type, node_id))
+                if is_target:
+                    traversable = permission_rules.get(edge_type, {}).get('Traversable', False)
+                else:
+                    traversable = self.final_traversable[node_id]
+                self.final_traversable[source_id] = self.final_traversable.get(source_id, False) or traversable
+
+        self.principals: List[str] = [node_id for node_id in distance if node_id not in self.targets]
+
+
+def compute_choke_point_flows(index: ReverseAdjacencyIndex, impact_index: ImpactIndex,
+                              permission_rules: Dict[str, Dict], adass_scores: Dict[str, float],
+                              event_monitoring_config: dict) -> ChokePointFlows:
+    # adass_scores needs an entry for every principal that can reach a scored target
+    dags = []
+    best: Dict[str, Tuple[Tuple[int, float], int]] = {}  # principal -> ((risk, likelihood * impact), pass)
+    likelihoods: Dict[Tuple[str, float], float] = {}
+    for impact_class in SCORED_IMPACT_CLASSES:
+        target_ids = impact_index.node_ids_with_class(impact_class)
+        if not target_ids:
+            continue
+        dag = _ShortestPathDag(index, target_ids, permission_rules)
+        logger.debug(f"{impact_class.name}: {len(dag.principals)} principals reach {len(target_ids)} targets "
+                     f"over {len(dag.edges)} shortest path edges")
+
+        # The principal's own edges decide the likelihood, the last edge decides the impact
+        principal_likelihood: Dict[str, float] = {}
+        for source_id, edge_type, _ in dag.edges:
+            key = (edge_type, adass_scores.get(source_id, 0.0))
+            if key not in likelihoods:
+                likelihoods[key] = _assess_edge_likelihood(edge_type, permission_rules, key[1], event_monitoring_config)
+            principal_likelihood[source_id] = max(principal_likelihood.get(source_id, likelihoods[key]),
+                                                  likelihoods[key])
+        for principal_id, likelihood in principal_likelihood.items():
+            impact = _impact_from_class(impact_class, dag.final_traversable[principal_id])
+            rating = (_qualitative_risk(likelihood, impact), likelihood * impact)
+            if principal_id not in best or rating > best[principal_id][0]:
+                best[principal_id] = (rating, len(dags))
+        dags.append(dag)
+
+    flows = ChokePointFlows(principal_risk={principal_id: rating[0] for principal_id, (rating, _) in best.items()},
+                            node_principals={}, node_weighted_risk={}, edge_principals={}, edge_weighted_risk={})
+    for dag_position, dag in enumerate(dags):
+        _accumulate(dag, {principal_id: flows.principal_risk[principal_id]
+                          for principal_id, (_, position) in best.items() if position == dag_position}, flows)
+    return flows
+
+
+def _accumulate(dag: _ShortestPathDag, principal_risk: Dict[str, int], flows: ChokePointFlows) -> None:
+    # Reversed discovery order visits all edges into a node before the edges leaving it
+    principals: Dict[str, float] = {}
+    weighted_risk: Dict[str, float] = {}
+    inbound_principals: Dict[str, float] = {}
+    inbound_weighted_risk: Dict[str, float] = {}
+    for edge in reversed(dag.edges):
+        source_id, _, target_id = edge
+        if source_id not in principals:
+            own_risk = principal_risk.get(source_id)
+            principals[source_id] = inbound_principals.get(source_id, 0.0) + (1.0 if own_risk else 0.0)
+            weighted_risk[source_id] = inbound_weighted_risk.get(source_id, 0.0) + (own_risk or 0.0)
+        if not weighted_risk[source_id]:
+            continue
+        share = dag.sigma[target_id] / dag.sigma[source_id]
+        edge_principals = principals[source_id] * share
+        edge_weighted_risk = weighted_risk[source_id] * share
+        flows.edge_principals[edge] = flows.edge_principals.get(edge, 0.0) + edge_principals
+        flows.edge_weighted_risk[edge] = flows.edge_weighted_risk.get(edge, 0.0) + edge_weighted_risk
+        if target_id in dag.targets:
+            continue
+        inbound_principals[target_id] = inbound_principals.get(target_id, 0.0) + edge_principals
+        inbound_weighted_risk[target_id] = inbound_weighted_risk.get(target_id, 0.0) + edge_weighted_risk
+
+    for node_id, value in inbound_principals.items():
+        flows.node_principals[node_id] = flows.node_principals.get(node_id, 0.0) + value
+    for node_id, value in inbound_weighted_risk.items():
+        flows.node_weighted_risk[node_id] = flows.node_weighted_risk.get(node_id, 0.0) + value
+
+
+def analyze_choke_points(session: neo4j.Session, permission_rules: Dict[str, Dict], attribute_rule_engine: RuleEngine,
+                         event_monitoring_config: dict, limit: int = 20,
+                         index: Optional[ReverseAdjacencyIndex] = None,
+                         impact_index: Optional[ImpactIndex] = None,
+                         adass_scores: Optional[Dict[str, float]] = None) -> ChokePointReport:
+    edge_types = list(permission_rules.keys())
+    if index is None:
+        index = ReverseAdjacencyIndex.from_session(session, edge_types)
+    if impact_index is None:
+        impact_index = build_impact_index(session, attribute_rule_engine, edge_types)
+    adass_scores = dict(adass_scores or {})
+
+    # ADASS scores of every node with an outgoing edge, only for the ones not given
+    sources = {source_id for inbound in index.inbound.values() for source_id, _ in inbound}
+    names = _assess_missing_nodes(session, [node_id for node_id in sources if node_id not in adass_scores],
+                                  attribute_rule_engine, adass_scores)
+
+    flows = compute_choke_point_flows(index, impact_index, permission_rules, adass_scores, event_monitoring_config)
+    logger.info(f"{len(flows.principal_risk)} principals have a path to a scored target")
+
+    top_nodes = sorted(flows.node_weighted_risk, key=flows.node_weighted_risk.get, reverse=True)[:limit]
+    top_edges = sorted(flows.edge_weighted_risk, key=flows.edge_weighted_risk.get, reverse=True)[:limit]
+    unnamed = {node_id for node_id in top_nodes} | {edge[0] for edge in top_edges} | {edge[2] for edge in top_edges}
+    names.update(_node_names(session, [node_id for node_id in unnamed if node_id not in names]))
+
+    return ChokePointReport(
+        principal_count=len(flows.principal_risk),
+        nodes=[NodeChokePoint(node_id=node_id, name=names.get(node_id),
+                              principals=flows.node_principals[node_id],
+                              weighted_risk=flows.node_weighted_risk[node_id]) for node_id in top_nodes],
+        edges=[EdgeChokePoint(source_id=edge[0], edge_type=edge[1], target_id=edge[2],
+                              source_name=names.get(edge[0]), target_name=names.get(edge[2]),
+                              principals=flows.edge_principals[edge],
+                              weighted_risk=flows.edge_weighted_risk[edge]) for edge in top_edges])
+
+
+def _assess_missing_nodes(session: neo4j.Session, node_ids: List[str], attribute_rule_engine: RuleEngine,
+                          adass_scores: Dict[str, float]) -> Dict[str, str]:
+    names = {}
+    for start in range(0, len(node_ids), NODE_BATCH_SIZE):
+        for record in get_nodes_by_ids(session, node_ids[start:start + NODE_BATCH_SIZE]):
+            node = node_from_record(record["n"], record["memberof"])
+            adass_scores[node.id] = assess_user_attributes(node, attribute_rule_engine)
+            names[node.id] = node.name
+    return names
+
+
+def _node_names(session: neo4j.Session, node_ids: List[str]) -> Dict[str, str]:
+    names = {}
+    for start in range(0, len(node_ids), NODE_BATCH_SIZE):
+        for record in get_nodes_by_ids(session, node_ids[start:start + NODE_BATCH_SIZE]):
+            names[record["n"].element_id] = record["n"].get('name')
+    return names
@@ -0,0 +1,69 @@
+# Compound rights, e.g. DCSync = GetChanges + GetChangesAll on the same domain.
+#
+# A permission rule with a "Composite Of" list of edge types is a composite rule: a
+# principal holding all of these edge types on the same target holds the compound right,
+# which is scored with the composite rule itself. The components are still scored on
+# their own.
+#
+# join_composite_paths is a hash-join by (principal, target) over the path stream. Only
+# paths of component edge types are kept in the join table. A composite path is emitted
+# as soon as its last component arrives, so the cost is linear in the number of paths no
+# matter in which order the components are streamed. If the principal already holds the
+# compound right as an edge on the target, e.g. BloodHound's DCSync edge, the composite
+# path is not emitted. If the edge only arrives after the last component, the edge is
+# dropped instead, so every compound right is yielded once, whatever the stream order.
+
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Tuple
+
+from models.neo4j import CompositePath, Path
+from modules.logging_base import Logging
+
+logger = Logging().getLogger()
+
+COMPOSITE_KEY = 'Composite Of'
+
+
+def get_composite_rules(permission_rules: Dict[str, Dict]) -> Dict[str, FrozenSet[str]]:
+    # Name of every composite rule -> its component edge types
+    return {name: frozenset(rule[COMPOSITE_KEY]) for name, rule in permission_rules.items() if rule.get(COMPOSITE_KEY)}
+
+
+def join_composite_paths(paths: Iterable[Path], permission_rules: Dict[str, Dict]) -> Iterator[Path]:
+    # Yields every path and, right after the last component of a compound right, its composite path
+    composite_rules = get_composite_rules(permission_rules)
+    if not composite_rules:
+        yield from paths
+        return
+
+    composites_by_component: Dict[str, List[str]] = {}
+    for name, component_types in composite_rules.items():
+        for component_type in component_types:
+            composites_by_component.setdefault(component_type, []).append(name)
+    joined_types = set(composites_by_component) | set(composite_rules)
+
+    # (principal id, target id) -> first path of every joined edge type on this pair
+    held: Dict[Tuple[str, str], Dict[str, Path]] = {}
+    for path in paths:
+        # Composite paths go through the join as well, so composites can be nested
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            edge_type = path.relationship.type
+            if edge_type not in joined_types:
+                yield path
+                continue
+            pair = held.setdefault((path.start_node.id, path.end_node.id), {})
+            if edge_type in composite_rules and not isinstance(path, CompositePath) and \
+                    isinstance(pair.get(edge_type), CompositePath):
+                logger.debug(f"Compound right already joined from its components: {path}")
+                continue
+            yield path
+            pair.setdefault(edge_type, path)
+            for name in composites_by_component.get(edge_type, []):
+                if name in pair or not all(component_type in pair for component_type in composite_rules[name]):
+                    continue
+                composite = CompositePath([pair[component_type] for component_type in sorted(composite_rules[name])],
+                                          name)
+                logger.debug(f"Joined compound right: {composite}")
+                pair[name] = composite
+                pending.append(composite)
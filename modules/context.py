@@ -0,0 +1,247 @@
+# In-process assessments for other Python tools, e.g. notebooks or SOC pipelines.
+#
+# An AssessmentContext holds the driver of one graph source, the loaded rules and every
+# index that is expensive to build. The rule evaluation caches and the group, ADCS,
+# impact and reverse adjacency indexes are built on first use and reused by all later
+# calls, so scoring thousands of principals pays for the setup once. Results are
+# returned as objects instead of being logged only.
+#
+#   with AssessmentContext.from_config("config.json") as context:
+#       details = context.assess_user("ALICE@CORP.LOCAL", inherited=True, collect_paths=True)
+#       for assessment in context.assess_users():
+#           ...
+#
+# A context is not thread safe, every thread needs its own context, see fork.
+
+import json
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import neo4j
+
+from modules.adcs_index import AdcsIndex
+from modules.assessment import UserAssessment, assess_target, assess_user
+from modules.choke_points import ChokePointReport, analyze_choke_points
+from modules.cypher_compiler import get_matching_node_ids
+from modules.edge_aggregation import DEFAULT_SAMPLE_SIZE, AggregatedUserAssessment, assess_user_aggregated
+from modules.group_expansion import GroupPermissionIndex
+from modules.impact_index import ImpactIndex, build_impact_index
+from modules.logging_base import Logging
+from modules.multi_source import GraphSource, parse_graph_sources
+from modules.neo4j_utils import DEFAULT_FETCH_SIZE, get_user_names, vertify_connection
+from modules.permission_assessment import PathAssessment
+from modules.pipeline import DEFAULT_BATCH_SIZE, DEFAULT_QUEUE_SIZE, AssessmentPipeline
+from modules.query_cache import CachingSession, QueryCache
+from modules.reverse_reachability import InboundPrincipal, ReverseAdjacencyIndex
+from modules.risk_matrix import DomainRiskMatrix, assess_domain
+from modules.risk_ranking import TopRiskReport
+from modules.rule_cache import load_rules
+from modules.rule_engine import RuleEngine
+from modules.sampling import RiskDistributionEstimate, estimate_risk_distribution
+from modules.scenarios import ScenarioBaseline
+
+logger = Logging().getLogger()
+
+
+@dataclass
+class DetailedUserAssessment:
+    assessment: UserAssessment
+    paths: List[PathAssessment] = field(default_factory=list)  # highest risk first
+
+
+class AssessmentContext:
+    def __init__(self, driver: Any, attribute_rule_engine: RuleEngine, permission_rules: Dict[str, Dict],
+                 event_monitoring_config: Optional[dict] = None, database: Optional[str] = None,
+                 fetch_size: int = DEFAULT_FETCH_SIZE, owns_driver: bool = False,
+                 query_cache: Optional[QueryCache] = None, cache_namespace: str = "") -> None:
+        # driver is a neo4j.Driver or anything with a compatible session(database=, fetch_size=)
+        self.driver = driver
+        self.attribute_rule_engine = attribute_rule_engine
+        self.permission_rules = permission_rules
+        self.event_monitoring_config = dict(event_monitoring_config or {})
+        self.database = database
+        self.fetch_size = fetch_size
+        self._owns_driver = owns_driver
+        self.query_cache = query_cache
+        self.cache_namespace = cache_namespace
+        self._indexes: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_source(cls, source: GraphSource, attributes_rules_dir_path: str = "rules/attributes",
+                    permission_rules_dir_path: str = "rules/permissions",
+                    event_monitoring_config: Optional[dict] = None,
+                    rules_cache_dir: Optional[str] = None,
+                    query_cache: Optional[QueryCache] = None,
+                    rule_packs: Optional[Dict[str, str]] = None) -> "AssessmentContext":
+        attribute_rule_engine, permission_rules = load_rules(
+            attributes_rules_dir_path, permission_rules_dir_path, rules_cache_dir, rule_packs=rule_packs)
+        driver = neo4j.GraphDatabase.driver(source.uri, auth=(source.user, source.password))
+        context = cls(driver, attribute_rule_engine, permission_rules, event_monitoring_config,
+                      source.database, source.fetch_size, owns_driver=True, query_cache=query_cache,
+                      cache_namespace=source.cache_namespace)
+        with driver.session(database=source.database) as session:
+            if not vertify_connection(session):
+                context.close()
+                raise ConnectionError(f"Could not connect to Neo4j source '{source}' at {source.uri}")
+        return context
+
+    @classmethod
+    def from_config(cls, config_path: str = "config.json", source_name: Optional[str] = None) -> "AssessmentContext":
+        # The first graph source of the config, or the one named source_name
+        with open(config_path, "r") as config_file:
+            config = json.load(config_file)
+        sources = parse_graph_sources(config.get("Neo4jConfig", {}))
+        source = sources[0] if source_name is None else next(
+            (source for source in sources if source.name == source_name), None)
+        if source is None:
+            raise KeyError(f"No graph source named {source_name} in {config_path}")
+        rules_config = config.get("RulesConfig", {})
+        query_cache_config = config.get("QueryCacheConfig")
+        return cls.from_source(source,
+                               rules_config.get("attributes_rules_dir_path", "rules/attributes"),
+                               rules_config.get("permissions_rules_dir_path", "rules/permissions"),
+                               config.get("EventMonitoringConfig", {}),
+                               rules_config.get("cache_dir", ".cadra_cache"),
+                               QueryCache.from_config(query_cache_config) if query_cache_config is not None else None,
+                               rules_config.get("rule_packs"))
+
+    def fork(self) -> "AssessmentContext":
+        # Shares the driver, the rules and the built indexes, but keeps its own rule evaluation caches
+        context = AssessmentContext(self.driver, self.attribute_rule_engine.fork(), self.permission_rules,
+                                    self.event_monitoring_config, self.database, self.fetch_size,
+                                    query_cache=self.query_cache, cache_namespace=self.cache_namespace)
+        context._indexes = self._indexes
+        context._lock = self._lock
+        return context
+
+    def close(self) -> None:
+        if self._owns_driver:
+            self.driver.close()
+
+    def __enter__(self) -> "AssessmentContext":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def session(self) -> Iterator[neo4j.Session]:
+        with self.driver.session(database=self.database, fetch_size=self.fetch_size) as session:
+            yield session if self.query_cache is None else CachingSession(session, self.query_cache,
+                                                                          self.cache_namespace)
+
+    def invalidate(self) -> None:
+        # After a re-ingest of the graph, drops the indexes, the cached query results and the rule evaluation caches
+        with self._lock:
+            self._indexes.clear()
+        if self.query_cache is not None:
+            self.query_cache.clear(self.cache_namespace)
+        self.attribute_rule_engine = self.attribute_rule_engine.fork()
+
+    def _index(self, name: str, build: Callable[[neo4j.Session], Any]) -> Any:
+        with self._lock:
+            if name not in self._indexes:
+                logger.debug(f"Building the {name} index")
+                with self.session() as session:
+                    self._indexes[name] = build(session)
+            return self._indexes[name]
+
+    @property
+    def group_index(self) -> GroupPermissionIndex:
+        return self._index("group", lambda session: GroupPermissionIndex.from_session(
+            session, list(self.permission_rules)))
+
+    @property
+    def adcs_index(self) -> AdcsIndex:
+        return self._index("adcs", AdcsIndex.from_session)
+
+    @property
+    def impact_index(self) -> ImpactIndex:
+        return self._index("impact", lambda session: build_impact_index(
+            session, self.attribute_rule_engine, list(self.permission_rules)))
+
+    @property
+    def reverse_index(self) -> ReverseAdjacencyIndex:
+        return self._index("reverse", lambda session: ReverseAdjacencyIndex.from_session(
+            session, list(self.permission_rules)))
+
+    def assess_user(self, name: str, inherited: bool = False, adcs: bool = False,
+                    collect_paths: bool = False) -> Optional[DetailedUserAssessment]:
+        # With collect_paths every assessed path is returned, not only the scores
+        paths: List[PathAssessment] = []
+        group_index = self.group_index if inherited else None
+        adcs_index = self.adcs_index if adcs else None
+        with self.session() as session:
+            assessment = assess_user(session, name, self.attribute_rule_engine, self.permission_rules,
+                                     self.event_monitoring_config, paths.append if collect_paths else None,
+                                     self._indexes.get("impact"), group_index, adcs_index)
+        if assessment is None:
+            return None
+        paths.sort(key=lambda path: (path.risk, path.score), reverse=True)
+        return DetailedUserAssessment(assessment=assessment, paths=paths)
+
+    def assess_users(self, names: Optional[Iterable[str]] = None, inherited: bool = False, adcs: bool = False,
+                     report: Optional[TopRiskReport] = None,
+                     path_sink: Optional[Callable[[PathAssessment], None]] = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE,
+                     queue_size: int = DEFAULT_QUEUE_SIZE) -> Iterator[UserAssessment]:
+        # Every enabled user without names. The impact index is built for bulk assessments and kept.
+        impact_index = self.impact_index
+        group_index = self.group_index if inherited else None
+        adcs_index = self.adcs_index if adcs else None
+        with self.session() as session:
+            if names is None:
+                names = get_user_names(session)
+            pipeline = AssessmentPipeline(session, self.attribute_rule_engine, self.permission_rules,
+                                          self.event_monitoring_config, path_sink, report, impact_index,
+                                          group_index, adcs_index, batch_size, queue_size)
+            yield from pipeline.run(names)
+
+    def scenario_baseline(self, names: Optional[Iterable[str]] = None, inherited: bool = False,
+                          adcs: bool = False) -> ScenarioBaseline:
+        # Assesses the users once and keeps every path, so what-if scenarios only re-score what they change
+        baseline = ScenarioBaseline(self.permission_rules, self.event_monitoring_config)
+        for _ in self.assess_users(names, inherited, adcs, path_sink=baseline):
+            pass
+        return baseline
+
+    def score_domain(self, names: Optional[Iterable[str]] = None) -> DomainRiskMatrix:
+        # Vectorized scores of the direct paths of every enabled user, see modules.risk_matrix
+        impact_index = self.impact_index
+        with self.session() as session:
+            return assess_domain(session, self.attribute_rule_engine, self.permission_rules,
+                                 self.event_monitoring_config, names, impact_index)
+
+    def assess_user_aggregated(self, name: str, sample_size: int = DEFAULT_SAMPLE_SIZE
+                               ) -> Optional[AggregatedUserAssessment]:
+        with self.session() as session:
+            return assess_user_aggregated(session, name, self.attribute_rule_engine, self.permission_rules,
+                                          self.event_monitoring_config, sample_size)
+
+    def assess_target(self, name: str) -> Optional[List[InboundPrincipal]]:
+        index = self.reverse_index
+        with self.session() as session:
+            return assess_target(session, name, self.attribute_rule_engine, self.permission_rules,
+                                 self.event_monitoring_config, index)
+
+    def analyze_choke_points(self, limit: int = 20) -> ChokePointReport:
+        index = self.reverse_index
+        impact_index = self.impact_index
+        with self.session() as session:
+            return analyze_choke_points(session, self.permission_rules, self.attribute_rule_engine,
+                                        self.event_monitoring_config, limit, index, impact_index)
+
+    def matching_node_ids(self, rule_name: str) -> List[str]:
+        # Element ids of every node matching the attribute rule, evaluated by Neo4j where the rule compiles to Cypher
+        with self.session() as session:
+            return get_matching_node_ids(session, self.attribute_rule_engine, rule_name)
+
+    def estimate_risk_distribution(self, sample_size: Optional[int] = None, error_bound: float = 0.05,
+                                   confidence: float = 0.95, seed: Optional[int] = None) -> RiskDistributionEstimate:
+        with self.session() as session:
+            return estimate_risk_distribution(session, self.attribute_rule_engine, self.permission_rules,
+                                              self.event_monitoring_config, sample_size, error_bound, confidence,
+                                              seed)
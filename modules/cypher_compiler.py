@@ -0,0 +1,407 @@
+# Compiles attribute rules into Cypher WHERE clauses, so domain-wide questions
+# ("which nodes are Tier Zero Objects?") can be answered by Neo4j instead of
+# pulling every node into Python.
+#
+# The generated predicates mirror RuleEngine / utils.compare for string, integer,
+# boolean and list properties, including the defaults the models fall back to for
+# missing properties. Criteria that cannot be expressed in Cypher are replaced by
+# TRUE, which turns the clause into a pre-filter; the matching nodes are then
+# re-evaluated with the RuleEngine in Python.
+#
+# Type dispatch relies on valueType(), available from Neo4j 5.13. On older servers
+# the query fails and get_matching_node_ids falls back to Python evaluation.
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import neo4j
+
+from models.active_directory import UAC_FLAGS, GENERIC_PROPERTIES, PRINCIPAL_PROPERTIES
+from models.bloodhound import NODE_ATTRIBUTES, NODE_TYPES, EdgeType, NodeType
+from models.neo4j import node_from_record
+from modules.logging_base import Logging
+from modules.neo4j_utils import UAC_FLAG_PROPERTIES
+from modules.rule_engine import RuleEngine
+from modules.temporal import TEMPORAL_OPERATORS, ReferenceClock, compile_temporal_predicate
+from modules.utils import compare
+
+logger = Logging().getLogger()
+
+NODE_VARIABLE = "n"
+
+# Python attributes of Node/User that are not backed by a node property
+_UNSUPPORTED_ATTRIBUTES = ['id', 'properties', 'edges', 'uac_flags']
+
+_UNSET_VALUES = ['', 'null', 'None']
+
+
+@dataclass
+class CompiledRule:
+    rule_name: str
+    where: str
+    parameters: Dict[str, Any] = field(default_factory=dict)
+    # False if at least one criterion could not be pushed down and the clause is only a pre-filter
+    exact: bool = True
+
+
+class _CompilationContext:
+    def __init__(self, clock: ReferenceClock) -> None:
+        self.parameters: Dict[str, Any] = {}
+        self.exact: bool = True
+        self.clock: ReferenceClock = clock
+
+    def parameter(self, value: Any) -> str:
+        for name, existing in self.parameters.items():
+            if type(existing) is type(value) and existing == value:
+                return f"${name}"
+        name = f"p{len(self.parameters)}"
+        self.parameters[name] = value
+        return f"${name}"
+
+
+class UnsupportedCriteria(Exception):
+    pass
+
+
+def compile_rule(rule: Dict, clock: Optional[ReferenceClock] = None) -> CompiledRule:
+    context = _CompilationContext(clock or ReferenceClock())
+    rule_name = rule.get('Name', 'Unknown')
+
+    prerequisite_criteria: Dict[str, Any] = rule.get('Prerequisite Criteria', {})
+    prerequisite_clauses = []
+    for criteria_value in prerequisite_criteria.values():
+        if isinstance(criteria_value, list):
+            prerequisite_clauses.append(_compile_any(criteria_value, context))
+        elif isinstance(criteria_value, dict):
+            prerequisite_clauses.append(_compile_any([criteria_value], context))
+        else:
+            raise ValueError(f"Invalid format for prerequisite criteria: {prerequisite_criteria}")
+
+    criteria: Dict[str, Any] = rule.get('Criteria', {})
+    criteria_clauses = []
+    for criteria_value in criteria.values():
+        if isinstance(criteria_value, list):
+            criteria_clauses.append(_compile_any(criteria_value, context))
+        elif isinstance(criteria_value, dict):
+            criteria_clauses.append(_compile_any([criteria_value], context))
+        else:
+            raise ValueError(f"Invalid format for criteria: {criteria}")
+
+    # Prerequisites must all hold, any criteria group is sufficient (see RuleEngine.evaluate_rule)
+    prerequisites = _join("AND", prerequisite_clauses) if prerequisite_clauses else "true"
+    main_criteria = _join("OR", criteria_clauses) if criteria_clauses else "false"
+    where = f"({prerequisites}) AND ({main_criteria})"
+
+    if not context.exact:
+        logger.debug(f"Rule '{rule_name}' can only be partially pushed down to Neo4j")
+    return CompiledRule(rule_name=rule_name, where=where, parameters=context.parameters, exact=context.exact)
+
+
+def _compile_any(criterias: List[Any], context: _CompilationContext) -> str:
+    clauses = []
+    for criteria in criterias:
+        # Nested lists are flattened by the RuleEngine as well
+        sub_criterias = criteria if isinstance(criteria, list) else [criteria]
+        for sub_criteria in sub_criterias:
+            try:
+                clauses.append(_compile_criteria(sub_criteria, context))
+            except UnsupportedCriteria as e:
+                logger.debug(f"Cannot push down criteria '{sub_criteria}': {e}")
+                context.exact = False
+                # Any unsupported alternative makes the whole group a possible match
+                return "true"
+    return _join("OR", clauses) if clauses else "false"
+
+
+def _join(operator: str, clauses: List[str]) -> str:
+    if len(clauses) == 1:
+        return clauses[0]
+    return f" {operator} ".join(f"({clause})" for clause in clauses)
+
+
+def _compile_criteria(criteria: Dict[str, Any], context: _CompilationContext) -> str:
+    property_name = criteria['Property']
+    operator = criteria['Operator']
+    expected_value = criteria['Value']
+    n = NODE_VARIABLE
+
+    if property_name in _UNSUPPORTED_ATTRIBUTES:
+        raise UnsupportedCriteria(f"'{property_name}' is not a node property")
+
+    if property_name == 'type':
+        return _compile_type_criteria(operator, expected_value, context)
+
+    if property_name == 'name':
+        # Node.name is read with properties.get() and is None when missing
+        return _with_null_fallback(f"{n}.name", operator, expected_value, None, True, context)
+
+    user_clause = _compile_user_property(property_name, operator, expected_value, context)
+    node_clause = _compile_node_property(property_name, operator, expected_value, context)
+    if user_clause == node_clause:
+        return user_clause
+    return f"CASE WHEN {n}:{NodeType.USER.value} THEN {user_clause} ELSE {node_clause} END"
+
+
+def _compile_user_property(property_name: str, operator: str, expected_value: Any,
+                           context: _CompilationContext) -> str:
+    # Resolution order of User.__getattr__
+    n = NODE_VARIABLE
+    if property_name == 'memberof':
+        # User.memberof is built from outgoing MemberOf edges, not from a node property
+        memberof = f"[({n})-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname]"
+        return _value_predicate(memberof, operator, expected_value, context, value_type="LIST")
+    if property_name.upper() in UAC_FLAGS:
+        return _value_predicate(_uac_flag_expression(property_name.upper()), operator, expected_value,
+                                context, value_type="BOOLEAN")
+
+    property_key = property_name.lower()
+    has_default = property_key in PRINCIPAL_PROPERTIES
+    return _with_null_fallback(f"{n}.`{property_key}`", operator, expected_value,
+                               PRINCIPAL_PROPERTIES.get(property_key), has_default, context)
+
+
+def _compile_node_property(property_name: str, operator: str, expected_value: Any,
+                           context: _CompilationContext) -> str:
+    # Resolution order of Node.__getattr__
+    property_key = property_name.lower()
+    if property_key in GENERIC_PROPERTIES:
+        default, has_default = GENERIC_PROPERTIES[property_key], True
+    elif property_key in NODE_ATTRIBUTES:
+        default, has_default = NODE_ATTRIBUTES[property_key], True
+    else:
+        default, has_default = None, False
+    return _with_null_fallback(f"{NODE_VARIABLE}.`{property_key}`", operator, expected_value,
+                               default, has_default, context)
+
+
+def _uac_flag_expression(flag: str) -> str:
+    if flag not in UAC_FLAG_PROPERTIES:
+        # Flags that are never derived are always reported as unset
+        return "false"
+    property_name, flag_value = UAC_FLAG_PROPERTIES[flag]
+    return f"coalesce({NODE_VARIABLE}.`{property_name}` = {str(flag_value).lower()}, false)"
+
+
+def _with_null_fallback(value: str, operator: str, expected_value: Any, default: Any, has_default: bool,
+                        context: _CompilationContext) -> str:
+    # A missing property either resolves to a model default or raises an AttributeError,
+    # which the RuleEngine treats as a non-match
+    predicate = _value_predicate(value, operator, expected_value, context)
+    if has_default and operator in TEMPORAL_OPERATORS:
+        matched = compile_temporal_predicate(operator, expected_value).evaluate(default, context.clock)
+        fallback = "true" if matched else "false"
+    elif has_default and (default is not None or operator in ['==', '!=', 'notset']):
+        fallback = "true" if compare(operator, default, expected_value) else "false"
+    else:
+        fallback = "false"
+    return f"CASE WHEN {value} IS NULL THEN {fallback} ELSE {predicate} END"
+
+
+def _compile_type_criteria(operator: str, expected_value: Any, context: _CompilationContext) -> str:
+    n = NODE_VARIABLE
+    if operator in ['==', '!='] and expected_value in NODE_TYPES.values():
+        # Label checks can use the label index
+        label_check = f"{n}:{expected_value}"
+        return label_check if operator == '==' else f"NOT {label_check}"
+    # Same as get_node_type_from_labels
+    node_type = f"head([l IN labels({n}) WHERE l IN {context.parameter(list(NODE_TYPES.values()))}] + ['Unknown'])"
+    return _value_predicate(node_type, operator, expected_value, context, value_type="STRING")
+
+
+def _value_predicate(value: str, operator: str, expected_value: Any, context: _CompilationContext,
+                     value_type: Optional[str] = None) -> str:
+    if expected_value is None and operator not in ['notset']:
+        raise UnsupportedCriteria(f"Cannot compare against a null value with '{operator}'")
+
+    if operator in ['==', '!=']:
+        branches = _equality_branches(value, operator, expected_value, context)
+    elif operator in ['<', '>', '<=', '>=']:
+        branches = _comparison_branches(value, operator, expected_value, context)
+    elif operator in ['in', 'not in', 'any']:
+        branches = _membership_branches(value, operator, expected_value, context)
+    elif operator == 'set':
+        return f"NOT {value} IN {context.parameter(_UNSET_VALUES)} AND NOT {value} = []"
+    elif operator == 'notset':
+        if expected_value in [None] + _UNSET_VALUES:
+            # utils.compare also checks the expected value, which makes the criteria always match
+            return "true"
+        return f"{value} IN {context.parameter(_UNSET_VALUES)}"
+    elif operator in ['startswith', 'endswith']:
+        branches = _string_branches(value, operator, expected_value, context)
+    elif operator in TEMPORAL_OPERATORS:
+        branches = _temporal_branches(value, operator, expected_value, context)
+    else:
+        raise UnsupportedCriteria(f"Operator '{operator}' cannot be pushed down")
+
+    return _dispatch_on_type(value, branches, value_type)
+
+
+def _dispatch_on_type(value: str, branches: Dict[str, str], value_type: Optional[str]) -> str:
+    # branches maps a Cypher type name (or 'ANY' for everything else) to a predicate
+    otherwise = branches.get('ANY', 'false')
+    if value_type is not None:
+        return branches.get(value_type, otherwise)
+    cases = " ".join(f"WHEN valueType({value}) STARTS WITH '{type_name}' THEN {predicate}"
+                     for type_name, predicate in branches.items() if type_name != 'ANY')
+    if not cases:
+        return otherwise
+    return f"CASE {cases} ELSE {otherwise} END"
+
+
+def _try_convert(converter: Callable[[Any], Any], value: Any) -> Optional[Any]:
+    try:
+        return converter(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _to_bool(value: Any) -> bool:
+    # Same accepted inputs as converters.convert_to_bool, without its error logging
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower().strip() in ('true', '1'):
+        return True
+    if isinstance(value, str) and value.lower().strip() in ('false', '0'):
+        return False
+    raise ValueError(f"Cannot convert \"{value}\" to boolean")
+
+
+def _to_int(value: Any) -> int:
+    # Same accepted inputs as converters.convert_to_int
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('0x') or value.startswith('0X'):
+            return int(value, 16)
+        return int(value)
+    raise ValueError(f"Cannot convert \"{value}\" to integer")
+
+
+def _equality_branches(value: str, operator: str, expected_value: Any,
+                       context: _CompilationContext) -> Dict[str, str]:
+    # normalize_operator_values converts the expected value to the type of the actual value,
+    # a failed conversion makes the comparison fail for both operators
+    cypher_operator = '=' if operator == '==' else '<>'
+    branches = {}
+
+    expected_bool = _try_convert(_to_bool, expected_value)
+    branches['BOOLEAN'] = "false" if expected_bool is None else \
+        f"{value} {cypher_operator} {context.parameter(expected_bool)}"
+
+    expected_int = _try_convert(_to_int, expected_value)
+    branches['INTEGER'] = "false" if expected_int is None else \
+        f"{value} {cypher_operator} {context.parameter(expected_int)}"
+
+    branches['STRING'] = f"{value} {cypher_operator} {context.parameter(str(expected_value))}"
+    branches['ANY'] = f"{value} {cypher_operator} {context.parameter(expected_value)}"
+    return branches
+
+
+def _comparison_branches(value: str, operator: str, expected_value: Any,
+                         context: _CompilationContext) -> Dict[str, str]:
+    expected_number = expected_value if isinstance(expected_value, (int, float)) and \
+        not isinstance(expected_value, bool) else _try_convert(_to_int, expected_value)
+    if expected_number is None:
+        return {'ANY': "false"}
+    expected = context.parameter(expected_number)
+    return {
+        'INTEGER': f"{value} {operator} {expected}",
+        'FLOAT': f"{value} {operator} {expected}",
+        'BOOLEAN': f"(CASE WHEN {value} THEN 1 ELSE 0 END) {operator} {expected}",
+        # Numeric strings are converted by normalize_operator_values
+        'STRING': f"coalesce(toInteger(trim({value})) {operator} {expected}, false)",
+    }
+
+
+def _membership_branches(value: str, operator: str, expected_value: Any,
+                         context: _CompilationContext) -> Dict[str, str]:
+    if operator == 'any':
+        if isinstance(expected_value, (list, set)):
+            expected = context.parameter(list(expected_value))
+            return {
+                'LIST': f"any(x IN {expected} WHERE x IN {value})",
+                'STRING': f"{value} IN {expected}",
+            }
+        if isinstance(expected_value, str):
+            expected = context.parameter(expected_value)
+            return {
+                'LIST': f"{expected} IN {value}",
+                'STRING': f"({value} CONTAINS {expected} OR {expected} CONTAINS {value})",
+            }
+        return {'ANY': "false"}
+
+    # 'in' and 'not in' wrap single expected values into a list
+    expected_values = list(expected_value) if isinstance(expected_value, (list, set)) else [expected_value]
+    expected = context.parameter(expected_values)
+    if operator == 'in':
+        return {
+            'LIST': f"all(x IN {expected} WHERE x IN {value})",
+            'STRING': f"{value} IN {expected}",
+        }
+    return {
+        'LIST': f"NOT any(x IN {expected} WHERE x IN {value})",
+        'STRING': f"NOT {value} IN {expected}",
+    }
+
+
+def _string_branches(value: str, operator: str, expected_value: Any,
+                     context: _CompilationContext) -> Dict[str, str]:
+    if not isinstance(expected_value, str):
+        return {'ANY': "false"}
+    cypher_operator = "STARTS WITH" if operator == 'startswith' else "ENDS WITH"
+    expected = context.parameter(expected_value)
+    return {
+        'STRING': f"{value} {cypher_operator} {expected}",
+        'INTEGER': f"toString({value}) {cypher_operator} {expected}",
+    }
+
+
+def _temporal_branches(value: str, operator: str, expected_value: Any,
+                       context: _CompilationContext) -> Dict[str, str]:
+    try:
+        predicate = compile_temporal_predicate(operator, expected_value)
+    except ValueError as e:
+        raise UnsupportedCriteria(str(e))
+    cutoff = context.parameter(predicate.cutoff(context.clock))
+    if operator == 'older_than':
+        condition = f"({value} <= 0 OR {value} < {cutoff})"
+    else:
+        condition = f"({value} > 0 AND {value} >= {cutoff})"
+    return {'INTEGER': condition, 'FLOAT': condition}
+
+
+def get_matching_node_ids(session: neo4j.Session, rule_engine: RuleEngine, rule_name: str) -> List[str]:
+    rule = rule_engine.get_rule(rule_name)
+    compiled = compile_rule(rule, rule_engine.clock)
+    n = NODE_VARIABLE
+
+    if compiled.exact:
+        query = f"MATCH ({n}) WHERE {compiled.where} RETURN elementId({n}) AS id"
+        try:
+            return [record["id"] for record in session.run(query, compiled.parameters)]
+        except neo4j.exceptions.ClientError as e:
+            logger.warning(f"Neo4j rejected the compiled query for rule '{rule_name}', evaluating in Python: {e}")
+            return _evaluate_in_python(session, rule_engine, rule, "true", {})
+
+    logger.info(f"Rule '{rule_name}' is only partially pushed down, evaluating candidates in Python")
+    try:
+        return _evaluate_in_python(session, rule_engine, rule, compiled.where, compiled.parameters)
+    except neo4j.exceptions.ClientError as e:
+        logger.warning(f"Neo4j rejected the compiled query for rule '{rule_name}', evaluating in Python: {e}")
+        return _evaluate_in_python(session, rule_engine, rule, "true", {})
+
+
+def _evaluate_in_python(session: neo4j.Session, rule_engine: RuleEngine, rule: Dict, where: str,
+                        parameters: Dict[str, Any]) -> List[str]:
+    n = NODE_VARIABLE
+    query = f"MATCH ({n}) WHERE {where} " + \
+        f"RETURN {n}, [({n})-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname] AS memberof"
+    matching_node_ids = []
+    for record in session.run(query, parameters):
+        node = node_from_record(record[n], record["memberof"])
+        if rule_engine.evaluate_rule(rule, node)['matches']:
+            matching_node_ids.append(node.id)
+    return matching_node_ids
@@ -0,0 +1,163 @@
+# Columnar output of every assessed path, not only the highest scoring one.
+#
+# ColumnarDetailSink is a path sink for assess_permissions. Rows are buffered per column
+# and written in large record batches, either to Parquet or to an Arrow IPC file. Graph
+# sources, names, node types and edge types are dictionary encoded with one growing dictionary per
+# column, so repeated values cost an index per row and new values are written as
+# dictionary deltas.
+#
+# pyarrow is an optional dependency, it is only imported when a detail sink is created.
+
+import os
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from modules.logging_base import Logging
+from modules.permission_assessment import PathAssessment
+
+logger = Logging().getLogger()
+
+DEFAULT_BATCH_SIZE = 65536
+
+FILE_FORMATS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+
+DICTIONARY_COLUMNS = ['source', 'principal', 'principal_type', 'edge_type', 'target', 'target_type']
+INTEGER_COLUMNS = ['threat_initiation', 'threat_occurrence', 'predisposing_conditions', 'impact', 'risk']
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Writing path details needs pyarrow, install it with 'pip install pyarrow'") from e
+    return pyarrow
+
+
+class _DictionaryColumn:
+    def __init__(self) -> None:
+        self.values: List[str] = []
+        self._indices: Dict[str, int] = {}
+        self.rows: List[Optional[int]] = []
+
+    def append(self, value: Optional[str]) -> None:
+        if value is None:
+            self.rows.append(None)
+            return
+        index = self._indices.get(value)
+        if index is None:
+            index = self._indices[value] = len(self.values)
+            self.values.append(value)
+        self.rows.append(index)
+
+
+class ColumnarDetailSink:
+    """Path sink for assess_permissions that writes every assessment to a columnar file."""
+
+    def __init__(self, path: str, file_format: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.pa = _import_pyarrow()
+        self.path = path
+        self.file_format = file_format or _format_from_path(path)
+        if self.file_format not in FILE_FORMATS.values():
+            raise ValueError(f"Unsupported detail format '{self.file_format}'")
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self.schema = self.pa.schema(
+            [self.pa.field(column, self.pa.dictionary(self.pa.int32(), self.pa.string())) for column in
+             DICTIONARY_COLUMNS] +
+            [self.pa.field('edge_id', self.pa.string())] +
+            [self.pa.field(column, self.pa.int8()) for column in INTEGER_COLUMNS] +
+            [self.pa.field('likelihood', self.pa.float32())])
+        self._dictionaries = {column: _DictionaryColumn() for column in DICTIONARY_COLUMNS}
+        self._columns: Dict[str, List[Any]] = {column: [] for column in ['edge_id', 'likelihood'] + INTEGER_COLUMNS}
+        self._writer = None
+        # Graph sources are assessed in parallel threads
+        self._lock = threading.Lock()
+
+    def __call__(self, assessment: PathAssessment) -> None:
+        self.add(assessment)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._columns['edge_id'])
+
+    def for_source(self, source: str) -> Callable[[PathAssessment], None]:
+        # Path sink that tags every row with the name of its graph source
+        return partial(self.add, source=source)
+
+    def add(self, assessment: PathAssessment, source: Optional[str] = None) -> None:
+        path = assessment.path
+        with self._lock:
+            self._dictionaries['source'].append(source)
+            self._dictionaries['principal'].append(path.start_node.name)
+            self._dictionaries['principal_type'].append(path.start_node.type)
+            self._dictionaries['edge_type'].append(path.relationship.type)
+            self._dictionaries['target'].append(path.end_node.name)
+            self._dictionaries['target_type'].append(path.end_node.type)
+            self._columns['edge_id'].append(path.relationship.id)
+            self._columns['likelihood'].append(assessment.likelihood)
+            for column in INTEGER_COLUMNS:
+                self._columns[column].append(getattr(assessment, column))
+            if len(self) >= self.batch_size:
+                self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            if self._writer is None:
+                # Still write the schema, so an empty result loads like any other
+                self._writer = self._open_writer()
+            self._writer.close()
+            self._writer = None
+            logger.info(f"Wrote {self.rows_written} path details to {self.path}")
+
+    def _flush(self) -> None:
+        if not len(self):
+            return
+        pa = self.pa
+        arrays = []
+        for column in DICTIONARY_COLUMNS:
+            dictionary = self._dictionaries[column]
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(dictionary.rows, pa.int32()),
+                                                         pa.array(dictionary.values, pa.string())))
+            dictionary.rows = []
+        arrays.append(pa.array(self._columns['edge_id'], pa.string()))
+        arrays.extend(pa.array(self._columns[column], pa.int8()) for column in INTEGER_COLUMNS)
+        arrays.append(pa.array(self._columns['likelihood'], pa.float32()))
+        batch = pa.record_batch(arrays, schema=self.schema)
+
+        if self._writer is None:
+            self._writer = self._open_writer()
+        self._writer.write_batch(batch)
+        self.rows_written += batch.num_rows
+        self._columns = {column: [] for column in self._columns}
+        logger.debug(f"Flushed {batch.num_rows} path details to {self.path}")
+
+    def _open_writer(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.file_format == 'parquet':
+            return self.pa.parquet.ParquetWriter(self.path, self.schema)
+        # The dictionaries only grow, so every batch after the first carries a delta
+        options = self.pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+        return self.pa.ipc.new_file(self.path, self.schema, options=options)
+
+
+def _format_from_path(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FILE_FORMATS:
+        raise ValueError(f"Cannot derive the detail format from '{path}', use one of {sorted(FILE_FORMATS)}")
+    return FILE_FORMATS[extension]
@@ -0,0 +1,241 @@
+# Aggregated assessment of principals with a high fan-out, e.g. helpdesk accounts with
+# GenericAll on every computer of an OU.
+#
+# Instead of fetching every outbound edge as a path, Neo4j groups the edges by edge
+# type, target node type and impact class of the target and returns a count and a few
+# sample targets per group. The impact class is computed server-side from the impact
+# rules compiled to Cypher (see modules.cypher_compiler). Targets of rules that can only
+# be pre-filtered in Cypher come back individually and are classified by the RuleEngine.
+#
+# All paths of an aggregate share likelihood and impact, so every aggregate is scored
+# once. Edge types that take part in composite rules are still fetched and scored path
+# by path, the join needs the individual targets. expand_aggregate streams the paths of
+# one aggregate for reporting.
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import neo4j
+
+from models.bloodhound import NODE_TYPES, EdgeType
+from models.neo4j import Path, User, iter_user_paths, node_from_record
+from modules.assessment import UserAssessment
+from modules.attribute_assessment import assess_user_attributes
+from modules.composite_rules import get_composite_rules
+from modules.cypher_compiler import NODE_VARIABLE, compile_rule
+from modules.logging_base import Logging
+from modules.neo4j_utils import DetachedNode, DetachedPath, DetachedRelationship, get_user_summary, \
+    stream_direct_user_paths
+from modules.permission_assessment import (DEZ_TO_QV_MAPPING, IMPACT_CLASS_RULES, ImpactClass, PathAssessment,
+                                           _assess_edge_likelihood, _impact_from_class, _qualitative_risk,
+                                           assess_permissions, classify_impact)
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+DEFAULT_SAMPLE_SIZE = 3
+
+# Server-side impact class of targets only the RuleEngine can classify
+_UNDECIDED = -1
+# Node type of targets without a known label
+UNKNOWN_TARGET_TYPE = "Unknown"
+
+
+@dataclass
+class EdgeAggregate:
+    edge_type: str
+    target_type: str
+    impact_class: ImpactClass
+    count: int
+    samples: List[str] = field(default_factory=list)  # names of representative targets
+
+    def __str__(self):
+        return f"[{self.edge_type}] -> {self.count} x {self.target_type} ({self.impact_class.name}), " + \
+            f"e.g. {', '.join(str(sample) for sample in self.samples)}"
+
+
+@dataclass
+class AggregateAssessment:
+    aggregate: EdgeAggregate
+    likelihood: float
+    impact: int
+    risk: int  # qualitative risk
+
+    @property
+    def score(self) -> float:
+        return self.likelihood * self.impact
+
+
+@dataclass
+class AggregatedUserAssessment:
+    assessment: UserAssessment
+    aggregates: List[AggregateAssessment] = field(default_factory=list)
+
+
+def impact_class_expression(rule_engine: RuleEngine) -> Tuple[str, Dict[str, Any]]:
+    # CASE expression over the target variable of cypher_compiler, highest impact class first
+    branches = []
+    parameters: Dict[str, Any] = {}
+    for impact_class, rule_names in IMPACT_CLASS_RULES.items():
+        for rule_name in rule_names:
+            try:
+                rule = rule_engine.get_rule(rule_name)
+            except KeyError:
+                # Rules that are not loaded never match
+                continue
+            compiled = compile_rule(rule, rule_engine.clock)
+            # Every compiled rule numbers its parameters from p0
+            prefix = f"c{len(branches)}_"
+            where = re.sub(r"\$p(\d+)\b", lambda match: f"${prefix}p{match.group(1)}", compiled.where)
+            parameters.update({prefix + name: value for name, value in compiled.parameters.items()})
+            branches.append(f"WHEN {where} THEN {int(impact_class) if compiled.exact else _UNDECIDED}")
+    if not branches:
+        return str(int(ImpactClass.NONE)), parameters
+    return f"CASE {' '.join(branches)} ELSE {int(ImpactClass.NONE)} END", parameters
+
+
+def _target_type_expression() -> str:
+    # Grouping and expansion must agree on the node type of a target, including unknown ones
+    return f"head([label IN labels({NODE_VARIABLE}) WHERE label IN $node_types] + ['{UNKNOWN_TARGET_TYPE}'])"
+
+
+def fetch_edge_aggregates(session: neo4j.Session, principal_node: Any, rule_engine: RuleEngine,
+                          edge_types: List[str], sample_size: int = DEFAULT_SAMPLE_SIZE) -> List[EdgeAggregate]:
+    n = NODE_VARIABLE
+    impact_class, parameters = impact_class_expression(rule_engine)
+    target_type = _target_type_expression()
+    # The samples of a group are matched again with a LIMIT, so only sample_size names are
+    # read instead of collecting the name of every target of the group
+    result = session.run(
+        f"MATCH (u)-[r]->({n}) WHERE elementId(u) = $element_id AND type(r) IN $edge_types "
+        f"WITH u, type(r) AS edge_type, {target_type} AS target_type, {impact_class} AS impact_class, {n} "
+        "WITH u, edge_type, target_type, impact_class, count(*) AS count, "
+        f"collect(CASE WHEN impact_class = {_UNDECIDED} THEN {{id: elementId({n}), labels: labels({n}), "
+        f"properties: properties({n}), memberof: [({n})-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname]}} "
+        "END) AS undecided "
+        f"RETURN edge_type, target_type, impact_class, count, COLLECT {{ "
+        f"MATCH (u)-[r]->({n}) WHERE impact_class <> {_UNDECIDED} AND type(r) = edge_type "
+        f"AND {target_type} = target_type AND {impact_class} = impact_class "
+        f"RETURN {n}.name LIMIT $sample_size }} AS samples, undecided",
+        {**parameters, 'element_id': principal_node.element_id, 'edge_types': edge_types,
+         'node_types': list(NODE_TYPES.values()), 'sample_size': sample_size})
+
+    aggregates: Dict[Tuple[str, str, ImpactClass], EdgeAggregate] = {}
+    for record in result:
+        target_type = record["target_type"]
+        if record["impact_class"] != _UNDECIDED:
+            key = (record["edge_type"], target_type, ImpactClass(record["impact_class"]))
+            _merge(aggregates, key, record["count"], record["samples"], sample_size)
+            continue
+        for target in record["undecided"]:
+            node = node_from_record(DetachedNode(target["id"], target["labels"], target["properties"]),
+                                    target["memberof"])
+            key = (record["edge_type"], target_type, classify_impact(node, rule_engine))
+            _merge(aggregates, key, 1, [node.name], sample_size)
+    return list(aggregates.values())
+
+
+def _merge(aggregates: Dict[Tuple[str, str, ImpactClass], EdgeAggregate], key: Tuple[str, str, ImpactClass],
+           count: int, samples: List[str], sample_size: int) -> None:
+    aggregate = aggregates.get(key)
+    if aggregate is None:
+        aggregate = aggregates[key] = EdgeAggregate(edge_type=key[0], target_type=key[1], impact_class=key[2], count=0)
+    aggregate.count += count
+    aggregate.samples.extend(samples[:sample_size - len(aggregate.samples)])
+
+
+def assess_aggregates(aggregates: List[EdgeAggregate], permission_rules: Dict[str, Dict], adass_score: float,
+                      event_monitoring_config: dict) -> List[AggregateAssessment]:
+    # Highest risk first, ties broken by likelihood * impact like assess_permissions
+    assessments = []
+    for aggregate in aggregates:
+        likelihood = _assess_edge_likelihood(aggregate.edge_type, permission_rules, adass_score,
+                                             event_monitoring_config)
+        traversable = permission_rules[aggregate.edge_type].get('Traversable', False)
+        impact = _impact_from_class(aggregate.impact_class, traversable)
+        assessments.append(AggregateAssessment(aggregate=aggregate, likelihood=likelihood, impact=impact,
+                                               risk=_qualitative_risk(likelihood, impact)))
+    assessments.sort(key=lambda assessment: (assessment.risk, assessment.score), reverse=True)
+    return assessments
+
+
+def expand_aggregate(session: neo4j.Session, principal: User, principal_node: Any, aggregate: EdgeAggregate,
+                     rule_engine: RuleEngine) -> Iterator[Path]:
+    # The individual paths of one aggregate, e.g. for a detailed report
+    n = NODE_VARIABLE
+    impact_class, parameters = impact_class_expression(rule_engine)
+    result = session.run(
+        f"MATCH (u)-[r]->({n}) WHERE elementId(u) = $element_id AND type(r) = $edge_type "
+        f"AND {_target_type_expression()} = $target_type "
+        f"WITH r, {n}, {impact_class} AS impact_class WHERE impact_class IN [$impact_class, {_UNDECIDED}] "
+        f"RETURN elementId(r) AS id, elementId({n}) AS end_id, labels({n}) AS end_labels, "
+        f"properties({n}) AS end_properties, impact_class, "
+        f"[({n})-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname] AS memberof",
+        {**parameters, 'element_id': principal_node.element_id, 'edge_type': aggregate.edge_type,
+         'target_type': aggregate.target_type, 'node_types': list(NODE_TYPES.values()),
+         'impact_class': int(aggregate.impact_class)})
+
+    def detached_paths() -> Iterator[DetachedPath]:
+        for record in result:
+            end_node = DetachedNode(record["end_id"], record["end_labels"], record["end_properties"])
+            if record["impact_class"] == _UNDECIDED and \
+                    classify_impact(node_from_record(end_node, record["memberof"]), rule_engine) != \
+                    aggregate.impact_class:
+                continue
+            yield DetachedPath(principal_node,
+                               DetachedRelationship(record["id"], aggregate.edge_type, principal_node, end_node))
+
+    return iter_user_paths(detached_paths(), principal)
+
+
+def assess_user_aggregated(session: neo4j.Session, name: str, attribute_rule_engine: RuleEngine,
+                           permission_rules: Dict[str, Dict], event_monitoring_config: dict,
+                           sample_size: int = DEFAULT_SAMPLE_SIZE,
+                           path_sink: Optional[Callable[[PathAssessment], None]] = None
+                           ) -> Optional[AggregatedUserAssessment]:
+    # With a path_sink every aggregate is expanded and its paths are passed to the sink
+    record = get_user_summary(session, name)
+    if record is None:
+        logger.error(f"User {name} not found in the database.")
+        return None
+    user: User = node_from_record(record["n"], record["memberof"])
+    user.edges = list(record["edges"])
+    adass_score = assess_user_attributes(user, attribute_rule_engine)
+    logger.info(f"Attribute Assessment: {adass_score}")
+
+    composite_rules = get_composite_rules(permission_rules)
+    joined_types = set(composite_rules).union(*composite_rules.values())
+    individual_types = [edge_type for edge_type in user.edges if edge_type in joined_types]
+    aggregated_types = [edge_type for edge_type in user.edges
+                        if edge_type in permission_rules and edge_type not in joined_types]
+
+    cadra_score = 0
+    path_count = 0
+    if individual_types:
+        paths = list(iter_user_paths(stream_direct_user_paths(session, record["n"], individual_types), user))
+        path_count += len(paths)
+        cadra_score = assess_permissions(paths, permission_rules, attribute_rule_engine, adass_score,
+                                         event_monitoring_config, path_sink)
+
+    aggregates = []
+    if aggregated_types:
+        aggregates = assess_aggregates(
+            fetch_edge_aggregates(session, record["n"], attribute_rule_engine, aggregated_types, sample_size),
+            permission_rules, adass_score, event_monitoring_config)
+        path_count += sum(assessment.aggregate.count for assessment in aggregates)
+        if aggregates:
+            cadra_score = max(cadra_score, aggregates[0].risk)
+            logger.info(f"Highest risk aggregate: {aggregates[0].aggregate} => "
+                        f"{DEZ_TO_QV_MAPPING[aggregates[0].risk]}")
+        if path_sink is not None:
+            for assessment in aggregates:
+                assess_permissions(expand_aggregate(session, user, record["n"], assessment.aggregate,
+                                                    attribute_rule_engine),
+                                   permission_rules, attribute_rule_engine, adass_score, event_monitoring_config,
+                                   path_sink)
+    logger.info(f"CADRA Score: {cadra_score}")
+
+    return AggregatedUserAssessment(
+        assessment=UserAssessment(name=name, adass_score=adass_score, cadra_score=cadra_score, path_count=path_count),
+        aggregates=aggregates)
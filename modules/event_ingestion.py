@@ -0,0 +1,417 @@
+# EventMonitoringConfig derived from exported Windows event logs.
+#
+# Instead of maintaining the config by hand, the exported Security logs of the domain
+# controllers are scanned for the event ids the permission rules rely on. An event id
+# counts as monitored if enough hosts emitted it within the window, by default every
+# host that shows up in the logs during the last seven days.
+#
+# The logs are read as one record per line (JSON Lines, or CSV as written by Export-Csv)
+# and split into chunks of whole records that are parsed in parallel worker processes.
+# Every chunk is reduced to a count and the first and last time per (event id, host),
+# so the memory does not grow with the size of the logs. The window decides which hosts
+# cover an event, the counts are of every logged event, also of those before the window. JSON lines that do not contain
+# any of the event ids as text are dropped before they are parsed. CSV fields may span
+# several lines, e.g. the Message column of Get-WinEvent, the chunk boundaries are only
+# placed outside of quoted fields.
+#
+#   coverage = ingest_event_logs(["dc01.jsonl", "dc02.csv"], ["4662", "4887", "5136"])
+#   coverage.log()
+#   event_monitoring_config.update(coverage.monitoring_config())
+
+import csv
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+
+from modules.logging_base import Logging
+
+logger = Logging().getLogger()
+
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+DEFAULT_WINDOW = "7 days"
+DEFAULT_MIN_COVERAGE = 1.0
+
+FILE_FORMATS = {
+    '.json': 'json',
+    '.jsonl': 'json',
+    '.ndjson': 'json',
+    '.csv': 'csv',
+}
+
+# Candidate fields of Get-WinEvent exports, EVTX converters and Winlogbeat, nested fields are dotted
+EVENT_ID_FIELDS = ["EventID", "EventId", "Id", "event_id", "winlog.event_id", "event.code", "Event.System.EventID"]
+HOST_FIELDS = ["Computer", "MachineName", "computer_name", "winlog.computer_name", "host.name",
+               "Event.System.Computer"]
+TIME_FIELDS = ["TimeCreated", "TimeGenerated", "@timestamp", "timestamp",
+               "Event.System.TimeCreated.#attributes.SystemTime"]
+
+# Timestamps of Export-Csv in the en-US culture
+_CSV_TIME_FORMATS = ["%m/%d/%Y %I:%M:%S %p", "%m/%d/%Y %H:%M:%S"]
+# ConvertTo-Json writes DateTime values as "/Date(milliseconds)/"
+_DOTNET_DATE = re.compile(r"/Date\((-?\d+)")
+# Epochs above this are in milliseconds
+_MILLISECOND_EPOCH = 1e11
+# Block size of the boundary scan of CSV files
+_SCAN_BLOCK_BYTES = 1024 * 1024
+
+
+@dataclass
+class HostActivity:
+    count: int = 0
+    first_seen: Optional[float] = None  # epoch seconds, None if no record had a timestamp
+    last_seen: Optional[float] = None
+
+    def add(self, timestamp: Optional[float], count: int = 1) -> None:
+        self.count += count
+        if timestamp is None:
+            return
+        if self.first_seen is None or timestamp < self.first_seen:
+            self.first_seen = timestamp
+        if self.last_seen is None or timestamp > self.last_seen:
+            self.last_seen = timestamp
+
+    def merge(self, other: "HostActivity") -> None:
+        self.add(other.first_seen, other.count)
+        if other.last_seen is not None:
+            self.add(other.last_seen, 0)
+
+
+@dataclass
+class _ChunkCounts:
+    activity: Dict[Tuple[str, str], HostActivity] = field(default_factory=dict)  # (event id, host)
+    records: int = 0
+    skipped: int = 0  # records without an event id or host
+
+    def add(self, event_id: str, host: str, timestamp: Optional[float]) -> None:
+        activity = self.activity.get((event_id, host))
+        if activity is None:
+            activity = self.activity[(event_id, host)] = HostActivity()
+        activity.add(timestamp)
+
+    def merge(self, other: "_ChunkCounts") -> None:
+        for key, activity in other.activity.items():
+            own = self.activity.get(key)
+            if own is None:
+                self.activity[key] = activity
+            else:
+                own.merge(activity)
+        self.records += other.records
+        self.skipped += other.skipped
+
+
+@dataclass
+class EventCoverage:
+    event_id: str
+    hosts: Dict[str, HostActivity]  # hosts that emitted the event within the window
+    expected_hosts: int
+
+    @property
+    def coverage(self) -> float:
+        return min(len(self.hosts) / self.expected_hosts, 1.0) if self.expected_hosts else 0.0
+
+    @property
+    def count(self) -> int:
+        # All-time count of the covering hosts, the per host counts are not split by the window
+        return sum(activity.count for activity in self.hosts.values())
+
+    def __str__(self):
+        return f"{self.event_id}: {len(self.hosts)} of {self.expected_hosts} host(s) ({self.coverage:.0%}), " + \
+            f"{self.count} event(s) logged in total"
+
+
+@dataclass
+class EventLogCoverage:
+    events: Dict[str, EventCoverage]
+    hosts: List[str]  # hosts expected to log the events
+    window_start: Optional[float] = None
+    window_end: Optional[float] = None
+    records: int = 0
+    skipped: int = 0
+
+    def monitoring_config(self, min_coverage: float = DEFAULT_MIN_COVERAGE) -> Dict[str, bool]:
+        # In the format of "EventMonitoringConfig" in config.json
+        return {event_id: bool(self.hosts) and coverage.coverage >= min_coverage
+                for event_id, coverage in self.events.items()}
+
+    def missing_hosts(self, event_id: str) -> List[str]:
+        return [host for host in self.hosts if host not in self.events[event_id].hosts]
+
+    def log(self) -> None:
+        window = "all events"
+        if self.window_start is not None:
+            window = f"{_format_time(self.window_start)} to {_format_time(self.window_end)}"
+        logger.info(f"Event log coverage of {len(self.hosts)} host(s) from {self.records} matching record(s), "
+                    f"{self.skipped} skipped, {window}:")
+        for event_id, coverage in self.events.items():
+            missing = self.missing_hosts(event_id)
+            logger.info(f"  {coverage}" + (f", missing on {', '.join(missing)}" if missing else ""))
+
+
+def ingest_event_logs(paths: Iterable[str], event_ids: Iterable[Any], window_seconds: Optional[float] = None,
+                      hosts: Optional[Iterable[str]] = None, max_workers: Optional[int] = None,
+                      chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> EventLogCoverage:
+    # window_seconds counts back from the newest logged event, None counts every event.
+    # hosts are the expected hosts, e.g. all domain controllers, by default the hosts found in the logs.
+    event_ids = frozenset(str(event_id) for event_id in event_ids)
+    if chunk_bytes < 1:
+        raise ValueError("Chunk size must be at least 1 byte")
+
+    tasks = []
+    for path in paths:
+        file_format = _file_format(path)
+        if file_format == 'csv':
+            columns, data_start = _csv_columns(path)
+            tasks.extend((_scan_csv_chunk, path, start, end, columns, event_ids)
+                         for start, end in _chunk_ranges(path, data_start, chunk_bytes, quoted=True))
+        else:
+            tasks.extend((_scan_json_chunk, path, start, end, event_ids)
+                         for start, end in _chunk_ranges(path, 0, chunk_bytes, quoted=False))
+    logger.debug(f"Scanning {len(tasks)} chunk(s) for event ids {', '.join(sorted(event_ids))}")
+
+    counts = _ChunkCounts()
+    if max_workers == 1 or len(tasks) < 2:
+        for scan, *arguments in tasks:
+            counts.merge(scan(*arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # Chunks are merged as they finish, only the per (event id, host) counts are kept
+            for future in as_completed([executor.submit(scan, *arguments) for scan, *arguments in tasks]):
+                counts.merge(future.result())
+    return _coverage(counts, event_ids, window_seconds, hosts)
+
+
+def monitored_event_ids(permission_rules: Dict[str, Dict], event_monitoring_config: Dict[str, Any]) -> List[str]:
+    # Every event id a permission rule relies on or the config already lists
+    event_ids = {str(event_id) for event_id in event_monitoring_config}
+    for rule in permission_rules.values():
+        event_ids.update(str(event_id) for event_id in rule.get('Events', []))
+    return sorted(event_ids, key=_event_id_key)
+
+
+def _coverage(counts: _ChunkCounts, event_ids: FrozenSet[str], window_seconds: Optional[float],
+              hosts: Optional[Iterable[str]]) -> EventLogCoverage:
+    window_start = window_end = None
+    if window_seconds is not None:
+        timestamps = [activity.last_seen for activity in counts.activity.values() if activity.last_seen is not None]
+        if timestamps:
+            window_end = max(timestamps)
+            window_start = window_end - window_seconds
+        else:
+            logger.warning("No logged event has a timestamp, every event counts")
+
+    events = {event_id: {} for event_id in sorted(event_ids, key=_event_id_key)}
+    for (event_id, host), activity in counts.activity.items():
+        if window_start is not None and (activity.last_seen is None or activity.last_seen < window_start):
+            continue
+        events[event_id][host] = activity
+
+    if hosts is None:
+        expected = sorted({host for event_hosts in events.values() for host in event_hosts})
+    else:
+        expected = sorted({_normalize_host(host) for host in hosts})
+        for event_id, event_hosts in events.items():
+            events[event_id] = {host: activity for host, activity in event_hosts.items() if host in expected}
+    return EventLogCoverage(
+        events={event_id: EventCoverage(event_id, event_hosts, len(expected)) for event_id, event_hosts in events.items()},
+        hosts=expected, window_start=window_start, window_end=window_end,
+        records=counts.records, skipped=counts.skipped)
+
+
+def _file_format(path: str) -> str:
+    file_format = FILE_FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        raise ValueError(f"Unsupported event log format of {path}, expected one of {', '.join(FILE_FORMATS)}")
+    with open(path, 'rb') as f:
+        if f.read(2) in (b'\xff\xfe', b'\xfe\xff'):
+            raise ValueError(f"{path} is UTF-16 encoded, re-export it as UTF-8, e.g. with Export-Csv -Encoding UTF8")
+    return file_format
+
+
+def _chunk_ranges(path: str, start: int, chunk_bytes: int, quoted: bool) -> List[Tuple[int, int]]:
+    # Byte ranges of whole records, with quoted=True a boundary is never placed inside a quoted field
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        while start < size:
+            target = start + chunk_bytes
+            if target >= size:
+                ranges.append((start, size))
+                break
+            if quoted:
+                # Quotes inside fields are doubled, an even count means the position is outside of any field
+                f.seek(start)
+                quotes = 0
+                position = start
+                while position < target:
+                    block = f.read(min(_SCAN_BLOCK_BYTES, target - position))
+                    quotes += block.count(b'"')
+                    position += len(block)
+                while line := f.readline():
+                    quotes += line.count(b'"')
+                    if quotes % 2 == 0 and line.endswith(b'\n'):
+                        break
+            else:
+                f.seek(target)
+                f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _read_lines(path: str, start: int, end: int) -> Iterator[bytes]:
+    # The lines of a chunk, chunks always start at the beginning of a line
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                return
+            position += len(line)
+            yield line
+
+
+def _scan_json_chunk(path: str, start: int, end: int, event_ids: FrozenSet[str]) -> _ChunkCounts:
+    counts = _ChunkCounts()
+    tokens = [event_id.encode() for event_id in event_ids]
+    for line in _read_lines(path, start, end):
+        # Cheap text match first, most events of a Security log are of other ids
+        if not any(token in line for token in tokens):
+            continue
+        # One array element per line, e.g. a compressed ConvertTo-Json export
+        line = line.strip().lstrip(b'[').rstrip(b',]')
+        try:
+            record = json.loads(line)
+        except ValueError:
+            counts.skipped += 1
+            continue
+        if not isinstance(record, dict):
+            counts.skipped += 1
+            continue
+        event_id = _normalize_event_id(_first_field(record, EVENT_ID_FIELDS))
+        if event_id not in event_ids:
+            continue
+        counts.records += 1
+        host = _first_field(record, HOST_FIELDS)
+        if not host:
+            counts.skipped += 1
+            continue
+        counts.add(event_id, _normalize_host(host), _parse_time(_first_field(record, TIME_FIELDS)))
+    return counts
+
+
+def _csv_columns(path: str) -> Tuple[Tuple[int, int, Optional[int]], int]:
+    # Column indices of event id, host and time, and the offset of the first record
+    with open(path, 'rb') as f:
+        offset = 0
+        while line := f.readline():
+            offset += len(line)
+            # Windows PowerShell writes the type of the exported objects first
+            if not line.lstrip(b'\xef\xbb\xbf').startswith(b'#TYPE'):
+                break
+    header = next(csv.reader([line.decode('utf-8-sig', errors='replace')]), [])
+    columns = {name.strip(): index for index, name in enumerate(header)}
+    event_id_column = next((columns[name] for name in EVENT_ID_FIELDS if name in columns), None)
+    host_column = next((columns[name] for name in HOST_FIELDS if name in columns), None)
+    if event_id_column is None or host_column is None:
+        raise ValueError(f"{path} has no event id or host column, expected one of "
+                         f"{', '.join(EVENT_ID_FIELDS)} and one of {', '.join(HOST_FIELDS)}")
+    time_column = next((columns[name] for name in TIME_FIELDS if name in columns), None)
+    return (event_id_column, host_column, time_column), offset
+
+
+def _scan_csv_chunk(path: str, start: int, end: int, columns: Tuple[int, int, Optional[int]],
+                    event_ids: FrozenSet[str]) -> _ChunkCounts:
+    counts = _ChunkCounts()
+    event_id_column, host_column, time_column = columns
+    width = max(column for column in columns if column is not None) + 1
+    lines = (line.decode('utf-8', errors='replace') for line in _read_lines(path, start, end))
+    for row in csv.reader(lines):
+        if len(row) < width:
+            counts.skipped += 1
+            continue
+        event_id = _normalize_event_id(row[event_id_column])
+        if event_id not in event_ids:
+            continue
+        counts.records += 1
+        host = row[host_column]
+        if not host:
+            counts.skipped += 1
+            continue
+        counts.add(event_id, _normalize_host(host), _parse_time(row[time_column]) if time_column is not None else None)
+    return counts
+
+
+def _first_field(record: Dict[str, Any], names: List[str]) -> Any:
+    for name in names:
+        value = record
+        for key in name.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                value = None
+                break
+            value = value[key]
+        if value is not None:
+            return value
+    return None
+
+
+def _normalize_event_id(value: Any) -> Optional[str]:
+    if isinstance(value, dict):
+        # EVTX converters keep the qualifiers as attributes, e.g. {"#text": 4662, ...}
+        value = value.get('#text', value.get('value'))
+    if value is None:
+        return None
+    try:
+        return str(int(str(value).strip()))
+    except ValueError:
+        return None
+
+
+def _normalize_host(host: Any) -> str:
+    return str(host).strip().lower()
+
+
+def _parse_time(value: Any) -> Optional[float]:
+    # Epoch seconds of ISO 8601, .NET JSON, Export-Csv or epoch timestamps, naive times are taken as UTC
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > _MILLISECOND_EPOCH else float(value)
+    value = str(value).strip()
+    if not value:
+        return None
+    match = _DOTNET_DATE.match(value)
+    if match:
+        return int(match.group(1)) / 1000
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        parsed = None
+        for time_format in _CSV_TIME_FORMATS:
+            try:
+                parsed = datetime.strptime(value, time_format)
+                break
+            except ValueError:
+                continue
+        if parsed is None:
+            try:
+                return _parse_time(float(value))
+            except ValueError:
+                return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+def _event_id_key(event_id: str) -> Tuple[int, str]:
+    return (int(event_id), event_id) if event_id.isdigit() else (0, event_id)
+
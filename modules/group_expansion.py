@@ -0,0 +1,114 @@
+# Rights inherited through (nested) group membership.
+#
+# Most permissions in AD are granted to groups. The GroupPermissionIndex loads every
+# group, every group to group MemberOf edge and every assessable edge leaving a group
+# once. The effective edges of a group are its own edges plus the effective edges of
+# all groups it is a member of. They are computed once per strongly connected
+# component of the membership graph, so nested and even circular memberships are
+# expanded without any per-principal traversal. A principal then inherits the
+# effective edges of its direct groups as InheritedPaths, which assess_permissions
+# scores like direct paths.
+
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import neo4j
+
+from models.bloodhound import EdgeType, NodeType
+from models.neo4j import InheritedPath, Node
+from modules.logging_base import Logging
+from modules.neo4j_utils import DetachedNode, DetachedPath, DetachedRelationship
+from modules.utils import strongly_connected_components
+
+logger = Logging().getLogger()
+
+
+class GroupPermissionIndex:
+    def __init__(self) -> None:
+        self.groups: Dict[str, DetachedNode] = {}
+        self.parents: Dict[str, List[str]] = {}
+        self.direct_edges: Dict[str, List[DetachedRelationship]] = {}
+        self._effective_edges: Optional[Dict[str, List[DetachedRelationship]]] = None
+
+    def add_group(self, group: DetachedNode) -> None:
+        self.groups[group.element_id] = group
+        self._effective_edges = None
+
+    def add_membership(self, group_id: str, parent_id: str) -> None:
+        self.parents.setdefault(group_id, []).append(parent_id)
+        self._effective_edges = None
+
+    def add_edge(self, relationship: DetachedRelationship) -> None:
+        self.direct_edges.setdefault(relationship.start_node.element_id, []).append(relationship)
+        self._effective_edges = None
+
+    @classmethod
+    def from_session(cls, session: neo4j.Session, edge_types: List[str]) -> "GroupPermissionIndex":
+        # edge_types are the assessable edge types, MemberOf is only used for the expansion
+        index = cls()
+        group_label = NodeType.GROUP.value
+        member_of = EdgeType.MEMBER_OF.value
+        for record in session.run(
+                f"MATCH (g:{group_label}) RETURN elementId(g) AS id, labels(g) AS labels, properties(g) AS properties"):
+            index.add_group(DetachedNode(record["id"], record["labels"], record["properties"]))
+
+        for record in session.run(
+                f"MATCH (g:{group_label})-[:{member_of}]->(p:{group_label}) "
+                "RETURN elementId(g) AS group_id, elementId(p) AS parent_id"):
+            index.add_membership(record["group_id"], record["parent_id"])
+
+        end_nodes: Dict[str, DetachedNode] = {}
+        for record in session.run(
+                f"MATCH (g:{group_label})-[r]->(m) WHERE type(r) IN $edge_types "
+                "RETURN elementId(g) AS group_id, elementId(r) AS id, type(r) AS type, "
+                "elementId(m) AS end_id, labels(m) AS end_labels, properties(m) AS end_properties",
+                edge_types=[edge_type for edge_type in edge_types if edge_type != member_of]):
+            group = index.groups.get(record["group_id"])
+            if group is None:
+                continue
+            # Targets are shared by many groups, keep one plain node per target
+            end_node = end_nodes.get(record["end_id"])
+            if end_node is None:
+                end_node = end_nodes[record["end_id"]] = DetachedNode(
+                    record["end_id"], record["end_labels"], record["end_properties"])
+            index.add_edge(DetachedRelationship(record["id"], record["type"], group, end_node))
+
+        logger.debug(f"Loaded {len(index.groups)} groups with "
+                     f"{sum(len(edges) for edges in index.direct_edges.values())} assessable edges")
+        return index
+
+    def expand(self) -> None:
+        # Tarjan emits a component only after every component reachable from it, i.e. after all parent groups
+        effective_edges: Dict[str, List[DetachedRelationship]] = {}
+        for component in strongly_connected_components(self.groups.keys(), self.parents):
+            edges: Dict[str, DetachedRelationship] = {}
+            members = set(component)
+            for group_id in component:
+                for relationship in self.direct_edges.get(group_id, []):
+                    edges.setdefault(relationship.element_id, relationship)
+                for parent_id in self.parents.get(group_id, []):
+                    if parent_id in members or parent_id not in effective_edges:
+                        continue
+                    for relationship in effective_edges[parent_id]:
+                        edges.setdefault(relationship.element_id, relationship)
+            # Every group of a membership cycle has the same effective edges
+            shared = list(edges.values())
+            for group_id in component:
+                effective_edges[group_id] = shared
+        self._effective_edges = effective_edges
+        logger.debug(f"Expanded the effective edges of {len(effective_edges)} groups")
+
+    def effective_edges(self, group_id: str) -> List[DetachedRelationship]:
+        if self._effective_edges is None:
+            self.expand()
+        return self._effective_edges.get(group_id, [])
+
+    def iter_inherited_paths(self, principal: Node, group_ids: Iterable[str]) -> Iterator[InheritedPath]:
+        # group_ids are the direct groups of the principal, every right is inherited once
+        seen = set()
+        for group_id in group_ids:
+            for relationship in self.effective_edges(group_id):
+                if relationship.element_id in seen:
+                    continue
+                seen.add(relationship.element_id)
+                yield InheritedPath(DetachedPath(relationship.start_node, relationship), principal)
+
@@ -0,0 +1,71 @@
+# Precomputed impact classes for every node that is the target of an assessable edge.
+#
+# Thousands of principals usually point to the same few groups, computers and domain
+# objects. Classifying each target once up front turns the impact part of the
+# permission assessment into a single array lookup per path.
+
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import neo4j
+import numpy as np
+
+from models.neo4j import Node, node_from_record
+from modules.logging_base import Logging
+from modules.permission_assessment import ImpactClass, classify_impact
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+UNKNOWN_IMPACT_CLASS = -1
+
+
+class ImpactIndex:
+    def __init__(self, node_ids: List[str], impact_classes: np.ndarray) -> None:
+        if len(node_ids) != len(impact_classes):
+            raise ValueError("Every node id needs exactly one impact class")
+        self.node_ids: List[str] = list(node_ids)
+        self._positions: Dict[str, int] = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.impact_classes: np.ndarray = np.asarray(impact_classes, dtype=np.int8)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self._positions
+
+    def get(self, node_id: str) -> Optional[ImpactClass]:
+        position = self._positions.get(node_id)
+        if position is None:
+            return None
+        return ImpactClass(int(self.impact_classes[position]))
+
+    def node_ids_with_class(self, impact_class: ImpactClass) -> List[str]:
+        return [self.node_ids[position] for position in np.flatnonzero(self.impact_classes == int(impact_class))]
+
+    def lookup(self, node_ids: Sequence[str]) -> np.ndarray:
+        # Vectorized get, unknown nodes are reported as UNKNOWN_IMPACT_CLASS
+        if not len(self.impact_classes):
+            return np.full(len(node_ids), UNKNOWN_IMPACT_CLASS, dtype=np.int8)
+        positions = np.fromiter((self._positions.get(node_id, -1) for node_id in node_ids),
+                                dtype=np.int64, count=len(node_ids))
+        return np.where(positions >= 0, self.impact_classes[positions], UNKNOWN_IMPACT_CLASS).astype(np.int8)
+
+
+def build_impact_index_from_nodes(nodes: Iterable[Node], rule_engine: RuleEngine) -> ImpactIndex:
+    node_ids = []
+    impact_classes = []
+    for node in nodes:
+        node_ids.append(node.id)
+        impact_classes.append(int(classify_impact(node, rule_engine)))
+    logger.debug(f"Built impact index for {len(node_ids)} nodes")
+    return ImpactIndex(node_ids, np.array(impact_classes, dtype=np.int8))
+
+
+def build_impact_index(session: neo4j.Session, rule_engine: RuleEngine, edge_types: List[str]) -> ImpactIndex:
+    # Every distinct end node of an edge with a permission rule, fetched once. Like the end nodes of
+    # the paths assess_permissions classifies without an index, they are built without their groups.
+    result = session.run(
+        "MATCH ()-[r]->(m) WHERE type(r) IN $edge_types WITH DISTINCT m RETURN m",
+        edge_types=edge_types)
+    nodes = (node_from_record(record["m"]) for record in result)
+    return build_impact_index_from_nodes(nodes, rule_engine)
@@ -0,0 +1,101 @@
+# Concurrent assessment of several graph sources, e.g. one Neo4j database per forest.
+#
+# "Neo4jConfig" in config.json is either a single source or a list of sources:
+#
+#   "Neo4jConfig": [
+#       {"name": "corp", "uri": "bolt://neo4j-corp:7687", "user": "neo4j", "password": "..."},
+#       {"name": "lab", "uri": "bolt://neo4j-lab:7687", "user": "neo4j", "password": "...", "database": "lab",
+#        "fetch_size": 5000}
+#   ]
+#
+# Every source runs in its own thread with its own driver and connection pool. The
+# rules are loaded once and shared, only the per-node evaluation caches are separate
+# because element ids are not unique across databases. Results are yielded as soon as
+# a source finishes, so a slow source never holds back the others.
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, List, Optional, Union
+
+import neo4j
+
+from modules.logging_base import Logging
+from modules.neo4j_utils import DEFAULT_FETCH_SIZE, vertify_connection
+from modules.query_cache import CachingSession, QueryCache
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+
+@dataclass
+class GraphSource:
+    name: str
+    uri: str
+    user: str
+    password: str
+    database: Optional[str] = None
+    fetch_size: int = DEFAULT_FETCH_SIZE
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def cache_namespace(self) -> str:
+        # Cached query results of a source are shared by every run against the same database
+        return f"{self.uri}/{self.database or ''}"
+
+
+@dataclass
+class SourceResult:
+    source: str
+    result: Any = None
+    error: Optional[str] = None
+
+
+def parse_graph_sources(neo4j_config: Union[dict, List[dict]]) -> List[GraphSource]:
+    source_configs = neo4j_config if isinstance(neo4j_config, list) else [neo4j_config]
+    if not source_configs:
+        raise ValueError("Neo4jConfig must contain at least one graph source")
+    sources = []
+    for i, source_config in enumerate(source_configs):
+        sources.append(GraphSource(
+            name=source_config.get("name", source_config.get("database") or f"source-{i}"),
+            uri=source_config.get("uri"),
+            user=source_config.get("user"),
+            password=source_config.get("password"),
+            database=source_config.get("database"),
+            fetch_size=source_config.get("fetch_size", DEFAULT_FETCH_SIZE)))
+    names = [source.name for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Graph source names must be unique: {names}")
+    return sources
+
+
+def assess_sources(sources: List[GraphSource], attribute_rule_engine: RuleEngine,
+                   task: Callable[[neo4j.Session, RuleEngine, GraphSource], Any],
+                   max_workers: Optional[int] = None,
+                   query_cache: Optional[QueryCache] = None) -> Iterator[SourceResult]:
+    # task runs once per source with an open session, a fork of attribute_rule_engine and the source,
+    # with a query_cache the session reads through it
+    with ThreadPoolExecutor(max_workers=max_workers or len(sources), thread_name_prefix="cadra-source") as executor:
+        futures = {executor.submit(_assess_source, source, attribute_rule_engine.fork(), task, query_cache): source
+                   for source in sources}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                yield SourceResult(source=source.name, result=future.result())
+            except Exception as e:
+                logger.error(f"[{source}] Assessment failed: {e}")
+                yield SourceResult(source=source.name, error=str(e))
+
+
+def _assess_source(source: GraphSource, attribute_rule_engine: RuleEngine,
+                   task: Callable[[neo4j.Session, RuleEngine, GraphSource], Any], query_cache: Optional[QueryCache] = None) -> Any:
+    logger.debug(f"[{source}] Initializing neo4j driver...")
+    with neo4j.GraphDatabase.driver(source.uri, auth=(source.user, source.password)) as driver:
+        with driver.session(database=source.database, fetch_size=source.fetch_size) as session:
+            if not vertify_connection(session):
+                raise ConnectionError(f"Could not connect to Neo4j source '{source}' at {source.uri}")
+            if query_cache is not None:
+                session = CachingSession(session, query_cache, source.cache_namespace)
+            return task(session, attribute_rule_engine, source)
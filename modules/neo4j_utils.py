@@ -1,11 +1,14 @@
-from typing import Any, Dict, List
-from neo4j import Session
+from typing import Any, Dict, Iterator, List, Optional
+from neo4j import Record, Session
 
 from modules.logging_base import Logging
-from models.bloodhound import NODE_TYPES
+from models.bloodhound import NODE_TYPES, EdgeType
 
 logger = Logging().getLogger()
 
+# Records the driver buffers per round trip for streamed results
+DEFAULT_FETCH_SIZE = 2000
+
 
 def vertify_connection(session: Session) -> bool:
     try:
@@ -19,6 +22,131 @@ def vertify_connection(session: Session) -> bool:
         return False
 
 
+def get_user_summary(session: Session, username: str) -> Record:
+    # The user node 'n' with what the assessment needs to know before streaming its paths:
+    # the names of its direct groups as 'memberof' and its distinct outgoing edge types as 'edges'.
+    # 'group_ids' holds the element ids of the direct groups for the group expansion.
+    return session.run(
+        "MATCH (n: User {name: $username}) OPTIONAL MATCH (n)-[r]->() "
+        "WITH n, collect(DISTINCT type(r)) AS edges "
+        f"RETURN n, [(n)-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname] AS memberof, "
+        f"[(n)-[:{EdgeType.MEMBER_OF.value}]->(g) | elementId(g)] AS group_ids, edges LIMIT 1",
+        username=username).single()
+
+
+def stream_direct_user_paths(session: Session, user_node: Any,
+                             edge_types: Optional[List[str]] = None) -> Iterator["DetachedPath"]:
+    # Lazily yields the direct paths of a user as plain values. Returning graph objects would make
+    # the driver keep every node and relationship of the result alive until it is consumed.
+    # The node is matched by element id only, so computers can be streamed the same way.
+    # edge_types restricts the paths to these edge types.
+    result = session.run(
+        "MATCH (n)-[r]->(m) WHERE elementId(n) = $element_id " +
+        ("AND type(r) IN $edge_types " if edge_types is not None else "") +
+        "RETURN elementId(r) AS id, type(r) AS type, "
+        "elementId(m) AS end_id, labels(m) AS end_labels, properties(m) AS end_properties",
+        element_id=user_node.element_id, edge_types=edge_types)
+    for record in result:
+        end_node = DetachedNode(record["end_id"], record["end_labels"], record["end_properties"])
+        relationship = DetachedRelationship(record["id"], record["type"], user_node, end_node)
+        yield DetachedPath(user_node, relationship)
+
+
+def get_user_summaries(session: Session, usernames: List[str]) -> List[Record]:
+    # get_user_summary for a batch of users in one round trip, unknown names are left out
+    return list(session.run(
+        "UNWIND $usernames AS username MATCH (n: User {name: username}) OPTIONAL MATCH (n)-[r]->() "
+        "WITH n, collect(DISTINCT type(r)) AS edges "
+        f"RETURN n, [(n)-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname] AS memberof, "
+        f"[(n)-[:{EdgeType.MEMBER_OF.value}]->(g) | elementId(g)] AS group_ids, edges",
+        usernames=usernames))
+
+
+def get_direct_paths_by_start(session: Session, start_nodes: List[Any]) -> Dict[str, List["DetachedPath"]]:
+    # stream_direct_user_paths for a batch of nodes in one round trip, grouped by start node element id
+    start_nodes_by_id = {start_node.element_id: start_node for start_node in start_nodes}
+    paths: Dict[str, List[DetachedPath]] = {element_id: [] for element_id in start_nodes_by_id}
+    result = session.run(
+        "MATCH (n)-[r]->(m) WHERE elementId(n) IN $element_ids "
+        "RETURN elementId(n) AS start_id, elementId(r) AS id, type(r) AS type, "
+        "elementId(m) AS end_id, labels(m) AS end_labels, properties(m) AS end_properties",
+        element_ids=list(start_nodes_by_id))
+    for record in result:
+        start_node = start_nodes_by_id[record["start_id"]]
+        end_node = DetachedNode(record["end_id"], record["end_labels"], record["end_properties"])
+        relationship = DetachedRelationship(record["id"], record["type"], start_node, end_node)
+        paths[record["start_id"]].append(DetachedPath(start_node, relationship))
+    return paths
+
+
+def get_user_names(session: Session, enabled_only: bool = True) -> List[str]:
+    query = "MATCH (n: User) WHERE n.name IS NOT NULL "
+    if enabled_only:
+        query += "AND coalesce(n.enabled, false) "
+    return [record["name"] for record in session.run(query + "RETURN n.name AS name")]
+
+
+class DetachedNode:
+    """Plain stand-in for neo4j.graph.Node, with the attributes the models read."""
+    __slots__ = ('element_id', 'labels', '_properties')
+
+    def __init__(self, element_id: str, labels: List[str], properties: Dict[str, Any]) -> None:
+        self.element_id = element_id
+        self.labels = frozenset(labels)
+        self._properties = properties
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self._properties.get(name, default)
+
+
+class DetachedRelationship:
+    """Plain stand-in for neo4j.graph.Relationship."""
+    __slots__ = ('element_id', 'type', 'start_node', 'end_node')
+
+    def __init__(self, element_id: str, type: str, start_node: Any, end_node: Any) -> None:
+        self.element_id = element_id
+        self.type = type
+        self.start_node = start_node
+        self.end_node = end_node
+
+
+class DetachedPath:
+    """Plain stand-in for a single hop neo4j.graph.Path."""
+    __slots__ = ('start_node', 'end_node', 'relationships')
+
+    def __init__(self, start_node: Any, relationship: DetachedRelationship) -> None:
+        self.start_node = start_node
+        self.end_node = relationship.end_node
+        self.relationships = (relationship,)
+
+
+def get_node_by_name(session: Session, name: str) -> Record:
+    # Returns a record with the node 'n' and the names of its direct groups as 'memberof'.
+    # BloodHound labels every node it ingests with Base, which carries the name index.
+    return session.run(
+        "MATCH (n:Base {name: $name}) "
+        f"RETURN n, [(n)-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname] AS memberof LIMIT 1",
+        name=name).single()
+
+
+def get_nodes_by_ids(session: Session, element_ids: List[str]) -> List[Record]:
+    # Same record layout as get_node_by_name
+    result = session.run(
+        "MATCH (n) WHERE elementId(n) IN $element_ids "
+        f"RETURN n, [(n)-[:{EdgeType.MEMBER_OF.value}]->(g) | g.samaccountname] AS memberof",
+        element_ids=element_ids)
+    return list(result)
+
+
+def iter_principal_strata(session: Session, node_types: List[str]) -> Iterator[Record]:
+    # One record per principal of the given types with the properties it is stratified by
+    return iter(session.run(
+        "MATCH (n) WHERE any(label IN labels(n) WHERE label IN $node_types) "
+        "RETURN elementId(n) AS id, [label IN labels(n) WHERE label IN $node_types][0] AS type, "
+        "coalesce(n.enabled, false) AS enabled, coalesce(n.admincount, false) AS admincount",
+        node_types=node_types))
+
+
 def get_node_type_from_labels(labels: List[str]) -> str:
     for label in labels:
         if label in NODE_TYPES.values():
@@ -26,49 +154,22 @@ def get_node_type_from_labels(labels: List[str]) -> str:
     return "Unknown"
 
 
+# Maps each UAC flag CADRA can derive to the BloodHound property and value that sets it
+UAC_FLAG_PROPERTIES: Dict[str, tuple] = {
+    'ACCOUNTDISABLE': ('enabled', False),
+    'PASSWD_NOTREQD': ('passwordnotreqd', True),
+    'DONT_EXPIRE_PASSWD': ('pwdneverexpires', True),
+    'TRUSTED_FOR_DELEGATION': ('unconstraineddelegation', True),
+    'NOT_DELEGATED': ('sensitive', True),
+    'DONT_REQUIRE_PREAUTH': ('dontreqpreauth', True),
+    'TRUSTED_TO_AUTHENTICATE_FOR_DELEGATION': ('trustedtoauth', True),
+}
+
+
 def get_uac_flags_from_properties(props: Dict[str, Any]) -> List[str]:
     flags = []
-    # 'SCRIPT',
-    # 'ACCOUNTDISABLE',
-    if 'enabled' in props:
-        if props['enabled'] == False:
-            flags.append('ACCOUNTDISABLE')
-    # 'HOMEDIR_REQUIRED',
-    # 'LOCKOUT',
-    # 'PASSWD_NOTREQD',
-    if 'passwordnotreqd' in props:
-        if props['passwordnotreqd'] == True:
-            flags.append('PASSWD_NOTREQD')
-    # 'PASSWD_CANT_CHANGE',
-    # 'ENCRYPTED_TEXT_PASSWORD_ALLOWED',
-    # 'TEMP_DUPLICATE_ACCOUNT',
-    # 'NORMAL_ACCOUNT',
-    # 'INTERDOMAIN_TRUST_ACCOUNT',
-    # 'WORKSTATION_TRUST_ACCOUNT',
-    # 'SERVER_TRUST_ACCOUNT',
-    # 'DONT_EXPIRE_PASSWD',
-    if 'pwdneverexpires' in props:
-        if props['pwdneverexpires'] == True:
-            flags.append('DONT_EXPIRE_PASSWD')
-    # 'MNS_LOGON_ACCOUNT',
-    # 'SMARTCARD_REQUIRED',
-    # 'TRUSTED_FOR_DELEGATION',
-    if 'unconstraineddelegation' in props:
-        if props['unconstraineddelegation'] == True:
-            flags.append('TRUSTED_FOR_DELEGATION')
-    # 'NOT_DELEGATED',
-    if 'sensitive' in props:
-        if props['sensitive'] == True:
-            flags.append('NOT_DELEGATED')
-    # 'USE_DES_KEY_ONLY',
-    # 'DONT_REQUIRE_PREAUTH',
-    if 'dontreqpreauth' in props:
-        if props['dontreqpreauth'] == True:
-            flags.append('DONT_REQUIRE_PREAUTH')
-    # 'PASSWORD_EXPIRED',
-    # 'TRUSTED_TO_AUTHENTICATE_FOR_DELEGATION',
-    if 'trustedtoauth' in props:
-        if props['trustedtoauth'] == True:
-            flags.append('TRUSTED_TO_AUTHENTICATE_FOR_DELEGATION')
-    # 'PARTIAL_SECRETS_ACCOUNT'
+    for flag, (property_name, flag_value) in UAC_FLAG_PROPERTIES.items():
+        if property_name in props:
+            if props[property_name] == flag_value:
+                flags.append(flag)
     return flags
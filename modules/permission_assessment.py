@@ -2,8 +2,15 @@ from modules.logging_base import Logging
 from models.neo4j import Node, Path
 import os
 import json
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Union
+from modules.composite_rules import join_composite_paths
 from modules.rule_engine import RuleEngine
 
+if TYPE_CHECKING:
+    from modules.impact_index import ImpactIndex
+
 QV_TO_DEZ_MAPPING = {
     'Very High': 5,
     'High': 4,
@@ -14,12 +21,48 @@ QV_TO_DEZ_MAPPING = {
 
 DEZ_TO_QV_MAPPING = {v: k for k, v in QV_TO_DEZ_MAPPING.items()}
 
+
+class ImpactClass(IntEnum):
+    NONE = 0
+    PRIVILEGED_OR_SERVICE_ACCOUNT = 1
+    TIER_ONE = 2
+    TIER_ZERO = 3
+
+
+# Attribute rules that classify the end node of a path, highest impact first
+IMPACT_CLASS_RULES = {
+    ImpactClass.TIER_ZERO: ['Tier Zero Object'],
+    ImpactClass.TIER_ONE: ['Tier One Object'],
+    ImpactClass.PRIVILEGED_OR_SERVICE_ACCOUNT: ['Privileged Account', 'Service Account'],
+}
+
+# Impact of a traversable edge per impact class, non traversable edges are always 'Very Low'
+IMPACT_CLASS_TO_QV_MAPPING = {
+    ImpactClass.TIER_ZERO: 'Very High',
+    ImpactClass.TIER_ONE: 'High',
+    ImpactClass.PRIVILEGED_OR_SERVICE_ACCOUNT: 'Medium',
+    ImpactClass.NONE: 'Low',
+}
+
 logger = Logging().getLogger()
 
 
-def assess_permissions(paths: list[Path], permission_rules_dir_path: str, attribute_rule_engine: RuleEngine,
-                       adass_score: float, event_monitoring_config: dict) -> int:
-    # Load all rules from directory
+@dataclass
+class PathAssessment:
+    path: Path
+    threat_initiation: int
+    threat_occurrence: int
+    predisposing_conditions: int
+    likelihood: float
+    impact: int
+    risk: int  # qualitative risk
+
+    @property
+    def score(self) -> float:
+        return self.likelihood * self.impact
+
+
+def load_permission_rules(permission_rules_dir_path: str) -> Dict[str, Dict]:
     rules = {}
     for filename in os.listdir(permission_rules_dir_path):
         if filename.endswith(".json"):
@@ -30,7 +73,24 @@ def assess_permissions(paths: list[Path], permission_rules_dir_path: str, attrib
                     logger.debug(f"Loaded {len(rules)} permission assessment rules from {filename}")
                 except json.JSONDecodeError as e:
                     raise RuntimeError(f"Error loading rules from {permission_rules_dir_path}: {e}")
+    return rules
+
+
+def assess_permissions(paths: list[Path], permission_rules: Union[str, Dict[str, Dict]], attribute_rule_engine: RuleEngine,
+                       adass_score: float, event_monitoring_config: dict,
+                       path_sink: Optional[Callable[[PathAssessment], None]] = None,
+                       impact_index: Optional["ImpactIndex"] = None) -> int:
+    # permission_rules is either the rules directory or the rules returned by load_permission_rules
+    # path_sink receives the assessment of every scored path, not only the highest scoring one
+    # impact_index holds precomputed impact classes of end nodes, see modules.impact_index
+    if isinstance(permission_rules, str):
+        # Load all rules from directory
+        rules = load_permission_rules(permission_rules)
+    else:
+        rules = permission_rules
 
+    # Compound rights of composite rules are scored as paths of their own
+    paths = join_composite_paths(paths, rules)
     highest_scoring_assessment = ()
     for path in paths:
         logger.debug(f"Assessing permissions for path: {path}")
@@ -38,11 +98,23 @@ def assess_permissions(paths: list[Path], permission_rules_dir_path: str, attrib
             permission_likelihood = _assess_permission_likelihood(
                 path, rules, adass_score, event_monitoring_config)
             logger.debug(f"Path likelihood: {permission_likelihood}")
-            permission_impact = _assess_permission_impact(path, rules, attribute_rule_engine)
+            permission_impact = _assess_permission_impact(path, rules, attribute_rule_engine, impact_index)
             logger.debug(f"Path impact: {permission_impact}")
-            if highest_scoring_assessment == () or \
-                    permission_likelihood > highest_scoring_assessment[1] and permission_impact >= highest_scoring_assessment[2]:
-                highest_scoring_assessment = (path, permission_likelihood, permission_impact)
+            if path_sink is not None:
+                rule = rules[path.relationship.type]
+                path_sink(PathAssessment(
+                    path=path,
+                    threat_initiation=_threat_initiation(adass_score),
+                    threat_occurrence=rule.get('Threat Occurrence'),
+                    predisposing_conditions=_predisposing_conditions(rule, event_monitoring_config),
+                    likelihood=permission_likelihood,
+                    impact=permission_impact,
+                    risk=_qualitative_risk(permission_likelihood, permission_impact)))
+            # Highest qualitative risk wins, ties are broken by likelihood * impact
+            path_key = (_qualitative_risk(permission_likelihood, permission_impact),
+                        permission_likelihood * permission_impact)
+            if highest_scoring_assessment == () or path_key > highest_scoring_assessment[3]:
+                highest_scoring_assessment = (path, permission_likelihood, permission_impact, path_key)
 
         else:
             logger.warning(
@@ -68,54 +140,80 @@ def assess_permissions(paths: list[Path], permission_rules_dir_path: str, attrib
 
 def _assess_permission_likelihood(path: Path, permission_rules: dict, adass_score: float, event_monitoring_config: dict) -> float:
     logger.debug(f"Assessing likelihood")
+    return _assess_edge_likelihood(path.relationship.type, permission_rules, adass_score, event_monitoring_config)
+
+
+def _assess_edge_likelihood(edge_type: str, permission_rules: dict, adass_score: float,
+                            event_monitoring_config: dict) -> float:
+    threat_initiation = _threat_initiation(adass_score)
+    predisposing_conditions = _predisposing_conditions(permission_rules[edge_type], event_monitoring_config)
+    threat_occurrence = permission_rules[edge_type].get('Threat Occurrence')
+    likelihood = (threat_initiation * threat_occurrence) + predisposing_conditions
+
+    logger.debug(
+        f"likelihood = ({threat_initiation} * {threat_occurrence}) + {predisposing_conditions} = {likelihood}")
+    return likelihood
+
 
+def _threat_initiation(adass_score: float) -> int:
     # Determine Threat Initiation from ADASS score
     if adass_score >= 9:
-        threat_initiation = 5
+        return 5
     elif adass_score >= 7:
-        threat_initiation = 4
+        return 4
     elif adass_score >= 4:
-        threat_initiation = 3
+        return 3
     elif adass_score > 0:
-        threat_initiation = 2
+        return 2
     else:
-        threat_initiation = 1
+        return 1
 
-    events = permission_rules[path.relationship.type].get('Events')
-    predisposing_conditions = permission_rules[path.relationship.type].get(
-        'Predisposing Conditions')
 
-    for event_id in events:
-        for event, monitored in event_monitoring_config.items():
-            if event == event_id and monitored == True:
-                predisposing_conditions = predisposing_conditions * -1
-                break
+def _predisposing_conditions(permission_rule: dict, event_monitoring_config: dict) -> int:
+    predisposing_conditions = permission_rule.get('Predisposing Conditions')
+    # Event ids are numbers in the rules but strings in the config
+    monitored_events = [str(event) for event, monitored in event_monitoring_config.items() if monitored == True]
+    if any(str(event_id) in monitored_events for event_id in permission_rule.get('Events', [])):
+        predisposing_conditions = predisposing_conditions * -1
+    return predisposing_conditions
 
-    threat_occurrence = permission_rules[path.relationship.type].get('Threat Occurrence')
-    likelihood = (threat_initiation * threat_occurrence) + predisposing_conditions
 
-    logger.debug(
-        f"likelihood = ({threat_initiation} * {threat_occurrence}) + {predisposing_conditions} = {likelihood}")
-    return likelihood
-
-
-def _assess_permission_impact(path: Path, permission_rules: dict, rule_engine: RuleEngine) -> int:
+def _assess_permission_impact(path: Path, permission_rules: dict, rule_engine: RuleEngine,
+                              impact_index: Optional["ImpactIndex"] = None) -> int:
     logger.debug(f"Assessing impact")
     traversable_edge = permission_rules[path.relationship.type].get('Traversable', False)
-    matching_rules = rule_engine.get_matching_rules(path.end_node)
-    logger.info(f"Matching Rules: {[rule['rule_name'] for rule in matching_rules]}")
-    impact_rules = {
-        'Very High': ['Tier Zero Object'],
-        'High': ['Tier One Object'],
-        'Medium': ['Privileged Account', 'Service Account'],
-    }
-    for qualitative_value, rules in impact_rules.items():
-        if any(rule in [r['rule_name'] for r in matching_rules] for rule in rules):
-            return QV_TO_DEZ_MAPPING[qualitative_value] if traversable_edge else QV_TO_DEZ_MAPPING['Very Low']
-        elif traversable_edge:
-            return QV_TO_DEZ_MAPPING['Low']
-        else:
-            return QV_TO_DEZ_MAPPING['Very Low']
+    if impact_index is not None:
+        impact_class = impact_index.get(path.end_node.id)
+        if impact_class is not None:
+            return _impact_from_class(impact_class, traversable_edge)
+    impact_class = classify_impact(path.end_node, rule_engine)
+    logger.info(f"Impact class of {path.end_node.name}: {impact_class.name}")
+    return _impact_from_class(impact_class, traversable_edge)
+
+
+def get_impact_class(matching_rule_names: List[str]) -> ImpactClass:
+    for impact_class, rules in IMPACT_CLASS_RULES.items():
+        if any(rule in matching_rule_names for rule in rules):
+            return impact_class
+    return ImpactClass.NONE
+
+
+def classify_impact(node: Node, rule_engine: RuleEngine) -> ImpactClass:
+    # Same as get_impact_class, but only evaluates the impact rules and stops at the first match
+    for impact_class, rules in IMPACT_CLASS_RULES.items():
+        if rule_engine.first_matching_rule(node, rules) is not None:
+            return impact_class
+    return ImpactClass.NONE
+
+
+def _impact_from_class(impact_class: ImpactClass, traversable_edge: bool) -> int:
+    if not traversable_edge:
+        return QV_TO_DEZ_MAPPING['Very Low']
+    return QV_TO_DEZ_MAPPING[IMPACT_CLASS_TO_QV_MAPPING[impact_class]]
+
+
+def _qualitative_risk(likelihood: float, impact: int) -> int:
+    return _semi_qualitative_to_qualitative_dezimal(_semi_qualitative_to_qualitative_dezimal(likelihood) * impact)
 
 
 def _semi_qualitative_to_qualitative_dezimal(value: int) -> int:
@@ -0,0 +1,316 @@
+# Pipelined assessment of many principals.
+#
+# The principals flow through three stages that run in their own threads and are
+# linked by bounded queues:
+#
+#   fetch   batches of user summaries and their direct paths in two round trips per batch
+#   model   User and Path objects, plus the inherited paths with a GroupPermissionIndex and
+#           the certificate based escalations with an AdcsIndex
+#   score   attribute and permission assessment
+#
+# The fetcher is the only stage that talks to the database, so the next batches are
+# fetched while the current one is scored. The queues bound the number of batches in
+# flight, a slow stage back-pressures the stages before it instead of buffering the
+# whole domain. Every stage records its busy time and the time it waited for input or
+# for room in its output queue, every queue samples its occupancy, which tells which
+# stage limits the throughput.
+#
+#   pipeline = AssessmentPipeline(session, engine, permission_rules, event_monitoring_config)
+#   for assessment in pipeline.run(get_user_names(session)):
+#       ...
+#   pipeline.stats.log()
+
+import itertools
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import neo4j
+
+from models.neo4j import Path, User, iter_user_paths, node_from_record
+from modules.adcs_index import AdcsIndex
+from modules.assessment import UserAssessment
+from modules.attribute_assessment import assess_user_attributes
+from modules.group_expansion import GroupPermissionIndex
+from modules.impact_index import ImpactIndex
+from modules.logging_base import Logging
+from modules.neo4j_utils import DetachedPath, get_direct_paths_by_start, get_user_summaries
+from modules.permission_assessment import PathAssessment, assess_permissions
+from modules.risk_ranking import TopRiskReport
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_QUEUE_SIZE = 4
+
+# Blocked stages check this often whether the pipeline was stopped
+_POLL_SECONDS = 0.1
+
+# Marks the end of the stream in a queue
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    busy_seconds: float = 0.0
+    input_wait_seconds: float = 0.0   # starved, waiting for the previous stage
+    output_wait_seconds: float = 0.0  # back-pressured, waiting for room in the next queue
+
+    @property
+    def utilization(self) -> float:
+        total = self.busy_seconds + self.input_wait_seconds + self.output_wait_seconds
+        return self.busy_seconds / total if total else 0.0
+
+    def __str__(self):
+        return f"{self.name}: {self.items} principal(s), busy {self.busy_seconds:.2f}s " + \
+            f"({self.utilization:.0%}), waited {self.input_wait_seconds:.2f}s for input " + \
+            f"and {self.output_wait_seconds:.2f}s for output"
+
+
+@dataclass
+class QueueStats:
+    name: str
+    capacity: int
+    samples: int = 0
+    occupancy_sum: int = 0
+    full_samples: int = 0
+    empty_samples: int = 0
+
+    def sample(self, occupancy: int) -> None:
+        self.samples += 1
+        self.occupancy_sum += occupancy
+        if occupancy >= self.capacity:
+            self.full_samples += 1
+        elif occupancy == 0:
+            self.empty_samples += 1
+
+    @property
+    def mean_occupancy(self) -> float:
+        return self.occupancy_sum / self.samples if self.samples else 0.0
+
+    def __str__(self):
+        if not self.samples:
+            return f"{self.name}: no samples"
+        return f"{self.name}: mean {self.mean_occupancy:.1f} of {self.capacity} batches, " + \
+            f"full {self.full_samples / self.samples:.0%}, empty {self.empty_samples / self.samples:.0%}"
+
+
+@dataclass
+class PipelineStats:
+    stages: List[StageStats] = field(default_factory=list)
+    queues: List[QueueStats] = field(default_factory=list)
+    wall_seconds: float = 0.0
+
+    def log(self) -> None:
+        logger.info(f"Pipeline finished in {self.wall_seconds:.2f}s")
+        for stage in self.stages:
+            logger.info(f"  stage {stage}")
+        for stats in self.queues:
+            logger.info(f"  queue {stats}")
+
+
+@dataclass
+class _FetchedPrincipal:
+    record: Any
+    paths: List[DetachedPath]
+
+
+@dataclass
+class _ModeledPrincipal:
+    user: User
+    paths: List[Path]
+
+
+class _Channel:
+    # Bounded queue between two stages that samples its occupancy on every put
+    def __init__(self, name: str, capacity: int, stopped: threading.Event) -> None:
+        self.queue: queue.Queue = queue.Queue(maxsize=capacity)
+        self.stats = QueueStats(name=name, capacity=capacity)
+        self._stopped = stopped
+
+    def put(self, item: Any) -> None:
+        self.stats.sample(self.queue.qsize())
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def get(self) -> Any:
+        while not self._stopped.is_set():
+            try:
+                return self.queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+
+class AssessmentPipeline:
+    def __init__(self, session: neo4j.Session, attribute_rule_engine: RuleEngine,
+                 permission_rules: Dict[str, Dict], event_monitoring_config: dict,
+                 path_sink: Optional[Callable[[PathAssessment], None]] = None,
+                 report: Optional[TopRiskReport] = None,
+                 impact_index: Optional[ImpactIndex] = None,
+                 group_index: Optional[GroupPermissionIndex] = None,
+                 adcs_index: Optional[AdcsIndex] = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE, queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        if batch_size < 1 or queue_size < 1:
+            raise ValueError("Batch and queue size must be at least 1")
+        self.session = session
+        self.attribute_rule_engine = attribute_rule_engine
+        self.permission_rules = permission_rules
+        self.event_monitoring_config = event_monitoring_config
+        self.path_sink = path_sink
+        self.report = report
+        self.impact_index = impact_index
+        self.group_index = group_index
+        self.adcs_index = adcs_index
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.stats = PipelineStats()
+
+    def run(self, names: Iterable[str]) -> Iterator[UserAssessment]:
+        # Yields the assessments in the order of the names, unknown names are logged and skipped
+        if self.group_index is not None:
+            # Expand once upfront instead of inside the model stage of the first principal
+            self.group_index.effective_edges("")
+        stopped = threading.Event()
+        fetched = _Channel("fetched", self.queue_size, stopped)
+        modeled = _Channel("modeled", self.queue_size, stopped)
+        scored = _Channel("scored", self.queue_size, stopped)
+        self.stats = PipelineStats(queues=[fetched.stats, modeled.stats, scored.stats])
+        errors: List[BaseException] = []
+
+        batches = _batched(names, self.batch_size)
+        threads = [
+            self._start_stage("fetch", lambda _: self._fetch(batches), None, fetched, stopped, errors),
+            self._start_stage("model", self._model, fetched, modeled, stopped, errors),
+            self._start_stage("score", self._score, modeled, scored, stopped, errors),
+        ]
+
+        start = time.perf_counter()
+        try:
+            while True:
+                batch = scored.get()
+                if batch is _DONE:
+                    break
+                yield from batch
+        finally:
+            # Also stops the stages when the consumer does not read all results
+            stopped.set()
+            for thread in threads:
+                thread.join()
+            self.stats.wall_seconds = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+
+    def _start_stage(self, name: str, process: Callable[[Any], Iterator[List[Any]]],
+                     source: Optional[_Channel], target: _Channel, stopped: threading.Event,
+                     errors: List[BaseException]) -> threading.Thread:
+        stats = StageStats(name=name)
+        self.stats.stages.append(stats)
+
+        def run() -> None:
+            try:
+                for batch in self._timed_input(source, stats, process):
+                    started = time.perf_counter()
+                    target.put(batch)
+                    stats.output_wait_seconds += time.perf_counter() - started
+                    if stopped.is_set():
+                        # Closed early or another stage failed, stop pulling from the source
+                        break
+            except BaseException as e:
+                logger.error(f"Pipeline stage {name} failed: {e}")
+                errors.append(e)
+                stopped.set()
+            finally:
+                target.put(_DONE)
+
+        thread = threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _timed_input(source: Optional[_Channel], stats: StageStats,
+                     process: Callable[[Any], Iterator[List[Any]]]) -> Iterator[List[Any]]:
+        # Splits the stage time into waiting for the previous stage and own work
+        inputs = itertools.repeat(None, 1) if source is None else iter(source.get, _DONE)
+        while True:
+            started = time.perf_counter()
+            item = next(inputs, _DONE)
+            stats.input_wait_seconds += time.perf_counter() - started
+            if item is _DONE:
+                return
+            outputs = iter(process(item))
+            while True:
+                started = time.perf_counter()
+                batch = next(outputs, _DONE)
+                stats.busy_seconds += time.perf_counter() - started
+                if batch is _DONE:
+                    break
+                stats.items += len(batch)
+                yield batch
+
+    def _fetch(self, batches: Iterator[List[str]]) -> Iterator[List[_FetchedPrincipal]]:
+        for names in batches:
+            records = get_user_summaries(self.session, names)
+            found = {record["n"].get('name') for record in records}
+            for name in names:
+                if name not in found:
+                    logger.error(f"User {name} not found in the database.")
+            # Users without edges have no paths, only the others are fetched
+            paths = get_direct_paths_by_start(self.session, [record["n"] for record in records if record["edges"]])
+            yield [_FetchedPrincipal(record, paths.get(record["n"].element_id, [])) for record in records]
+
+    def _model(self, batch: List[_FetchedPrincipal]) -> Iterator[List[_ModeledPrincipal]]:
+        modeled = []
+        for principal in batch:
+            user: User = node_from_record(principal.record["n"], principal.record["memberof"])
+            user.edges = list(principal.record["edges"])
+            paths = list(iter_user_paths(principal.paths, user))
+            if self.group_index is not None and user.edges:
+                paths.extend(self.group_index.iter_inherited_paths(user, principal.record["group_ids"]))
+            if self.adcs_index is not None:
+                paths.extend(self.adcs_index.iter_escalation_paths(user, skip_techniques=user.edges))
+            modeled.append(_ModeledPrincipal(user, paths))
+        yield modeled
+
+    def _score(self, batch: List[_ModeledPrincipal]) -> Iterator[List[UserAssessment]]:
+        assessments = []
+        for principal in batch:
+            user = principal.user
+            adass_score = assess_user_attributes(user, self.attribute_rule_engine)
+            ranking = self.report.start(user.name) if self.report is not None else None
+            cadra_score = 0
+            if principal.paths:
+                cadra_score = assess_permissions(
+                    principal.paths, self.permission_rules, self.attribute_rule_engine, adass_score,
+                    self.event_monitoring_config, _combine_sinks(self.path_sink, ranking), self.impact_index)
+            if ranking is not None:
+                self.report.finish(ranking)
+            assessments.append(UserAssessment(name=user.name, adass_score=adass_score, cadra_score=cadra_score,
+                                              path_count=len(principal.paths)))
+        yield assessments
+
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _combine_sinks(*sinks: Optional[Callable[[PathAssessment], None]]) -> Optional[Callable[[PathAssessment], None]]:
+    sinks = [sink for sink in sinks if sink is not None]
+    if len(sinks) < 2:
+        return sinks[0] if sinks else None
+
+    def sink(assessment: PathAssessment) -> None:
+        for s in sinks:
+            s(assessment)
+    return sink
@@ -0,0 +1,223 @@
+# Built-in CPU and memory profiling, enabled with --profile.
+#
+# A run is split into named stages (fetch, model, rule_engine, adass, assess_permissions, ...).
+# Every stage has its own cProfile profile. Stages nest: entering a stage pauses the
+# enclosing one, so every stage only accounts for its own time even though fetching and
+# model building happen lazily inside assess_permissions while the paths are streamed.
+#
+# Block stages can additionally take tracemalloc snapshots at their boundaries; the
+# allocation sites that grew the most inside the stage are reported at the end.
+#
+# For every stage the profiler writes into the output directory:
+#   <stage>.pstats      raw cProfile statistics, e.g. for snakeviz or pstats
+#   <stage>.collapsed   collapsed stacks, e.g. for flamegraph.pl or speedscope
+# and all.collapsed with every stage as the root frame.
+#
+# The stages are tracked for the thread that runs the assessment, so graph sources
+# are assessed one after another while profiling. The first thread that enters a stage
+# owns the profiler, stages entered by other threads (e.g. pipeline stages) are ignored.
+
+import cProfile
+import os
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from modules.logging_base import Logging
+
+logger = Logging().getLogger()
+
+T = TypeVar("T")
+
+_active_profiler: Optional["StageProfiler"] = None
+
+# Collapsed stacks deeper than this or with less time than this (in microseconds) are dropped
+MAX_STACK_DEPTH = 64
+MIN_STACK_MICROSECONDS = 1
+
+
+class StageProfiler:
+    def __init__(self, output_dir: str, top_allocations: int = 10, traceback_frames: int = 1):
+        self.output_dir = output_dir
+        self.top_allocations = top_allocations
+        self.traceback_frames = traceback_frames
+        self._profiles: Dict[str, cProfile.Profile] = {}
+        self._stack: List[cProfile.Profile] = []
+        self._allocations: Dict[str, Dict[Tuple, Tuple[int, int]]] = {}
+        self._thread: Optional[int] = None
+
+    def start(self) -> None:
+        global _active_profiler
+        if _active_profiler is not None:
+            raise RuntimeError("Another profiler is already active")
+        tracemalloc.start(self.traceback_frames)
+        _active_profiler = self
+
+    def stop(self) -> None:
+        global _active_profiler
+        while self._stack:
+            self._stack.pop().disable()
+        _active_profiler = None
+        self._log_allocations(tracemalloc.take_snapshot())
+        tracemalloc.stop()
+
+    def owns_current_thread(self) -> bool:
+        if self._thread is None:
+            self._thread = threading.get_ident()
+        return self._thread == threading.get_ident()
+
+    @contextmanager
+    def stage(self, name: str, snapshot: bool = False) -> Iterator[None]:
+        profile = self._profiles.get(name)
+        if profile is None:
+            profile = self._profiles[name] = cProfile.Profile()
+        if self._stack:
+            self._stack[-1].disable()
+        before = tracemalloc.take_snapshot() if snapshot else None
+
+        self._stack.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._stack.pop()
+            if before is not None:
+                self._record_allocations(name, before, tracemalloc.take_snapshot())
+            if self._stack:
+                self._stack[-1].enable()
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        # Accounts the time spent producing every item of a lazy iterable to the stage
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _record_allocations(self, name: str, before: tracemalloc.Snapshot, after: tracemalloc.Snapshot) -> None:
+        allocations = self._allocations.setdefault(name, {})
+        for diff in after.compare_to(before, 'lineno'):
+            if diff.size_diff <= 0:
+                continue
+            key = tuple((frame.filename, frame.lineno) for frame in diff.traceback)
+            size, count = allocations.get(key, (0, 0))
+            allocations[key] = (size + diff.size_diff, count + diff.count_diff)
+
+    def write_reports(self) -> List[str]:
+        os.makedirs(self.output_dir, exist_ok=True)
+        written = []
+        all_stacks = []
+        for name, profile in self._profiles.items():
+            stats_path = os.path.join(self.output_dir, f"{name}.pstats")
+            profile.dump_stats(stats_path)
+            stacks = collapsed_stacks(pstats.Stats(profile))
+            collapsed_path = os.path.join(self.output_dir, f"{name}.collapsed")
+            _write_collapsed(collapsed_path, stacks)
+            all_stacks.extend((f"{name};{stack}", microseconds) for stack, microseconds in stacks)
+            written.extend([stats_path, collapsed_path])
+
+            total = sum(microseconds for _, microseconds in stacks) / 1e6
+            logger.info(f"Profile stage {name}: {total:.3f}s CPU")
+
+        all_path = os.path.join(self.output_dir, "all.collapsed")
+        _write_collapsed(all_path, all_stacks)
+        written.append(all_path)
+
+        for name, allocations in self._allocations.items():
+            top = sorted(allocations.items(), key=lambda item: item[1][0], reverse=True)[:self.top_allocations]
+            logger.info(f"Top allocation sites in stage {name}:")
+            for frames, (size, count) in top:
+                location = " <- ".join(f"{filename}:{lineno}" for filename, lineno in frames)
+                logger.info(f"  {location}: +{size / 1024:.1f} KiB in {count} blocks")
+        return written
+
+    def _log_allocations(self, snapshot: tracemalloc.Snapshot) -> None:
+        logger.info("Top allocation sites still held at the end of the run:")
+        for statistic in snapshot.statistics('lineno')[:self.top_allocations]:
+            logger.info(f"  {statistic}")
+
+
+@contextmanager
+def profiling(output_dir: str, top_allocations: int = 10) -> Iterator[StageProfiler]:
+    profiler = StageProfiler(output_dir, top_allocations)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        for path in profiler.write_reports():
+            logger.debug(f"Wrote profile {path}")
+        logger.info(f"Profiles written to {output_dir}")
+
+
+def profile_stage(name: str, snapshot: bool = False) -> ContextManager:
+    # No-op unless a profiler is active, so the stages can stay in the hot paths
+    if _active_profiler is None or not _active_profiler.owns_current_thread():
+        return nullcontext()
+    return _active_profiler.stage(name, snapshot)
+
+
+def profile_iter(name: str, iterable: Iterable[T]) -> Iterable[T]:
+    if _active_profiler is None or not _active_profiler.owns_current_thread():
+        return iterable
+    return _active_profiler.iterate(name, iterable)
+
+
+def is_profiling() -> bool:
+    return _active_profiler is not None
+
+
+def collapsed_stacks(stats: pstats.Stats) -> List[Tuple[str, int]]:
+    # cProfile only records caller -> callee edges, so the stacks are reconstructed from the
+    # roots of the call graph. The self time of a function is split over its callers in
+    # proportion to the cumulative time every caller spent in it.
+    entries = stats.stats
+    callees: Dict[Tuple, List[Tuple[Tuple, float]]] = {}
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, (_, _, _, caller_cumulative) in callers.items():
+            callees.setdefault(caller, []).append((function, caller_cumulative))
+
+    stacks: Dict[str, float] = {}
+
+    def walk(function: Tuple, frames: List[str], seen: frozenset, share: float) -> None:
+        _, _, total_time, cumulative_time, _ = entries[function]
+        stack = ";".join(frames)
+        stacks[stack] = stacks.get(stack, 0.0) + total_time * share
+        if len(frames) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_cumulative in callees.get(function, []):
+            callee_cumulative = entries[callee][3]
+            if callee in seen or not callee_cumulative:
+                continue
+            callee_share = share * edge_cumulative / callee_cumulative
+            if callee_share * callee_cumulative * 1e6 < MIN_STACK_MICROSECONDS:
+                continue
+            walk(callee, frames + [_frame_label(callee)], seen | {callee}, callee_share)
+
+    for function, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(function, [_frame_label(function)], frozenset([function]), 1.0)
+
+    return [(stack, round(seconds * 1e6)) for stack, seconds in stacks.items()
+            if round(seconds * 1e6) >= MIN_STACK_MICROSECONDS]
+
+
+def _frame_label(function: Tuple) -> str:
+    filename, lineno, name = function
+    if filename == "~":
+        label = name
+    else:
+        label = f"{os.path.basename(filename)}:{name}:{lineno}"
+    return label.replace(";", ",")
+
+
+def _write_collapsed(path: str, stacks: List[Tuple[str, int]]) -> None:
+    with open(path, 'w') as f:
+        for stack, microseconds in stacks:
+            f.write(f"{stack} {microseconds}\n")
@@ -0,0 +1,395 @@
+# Read-through cache of Cypher results, for principals that are assessed again and again.
+#
+# A CachingSession wraps a neo4j.Session. Every read query goes through the QueryCache,
+# keyed by the query text and its parameters, so the fetch functions of neo4j_utils and
+# the indexes are cached without knowing about it. Results are kept in memory and,
+# with a disk_dir, in one file per query that outlives the process. Entries expire after
+# ttl_seconds, the memory tier evicts the least recently used results beyond max_records
+# records and the disk tier the least recently used files beyond max_disk_bytes.
+# Results of more than max_result_records records, e.g. the bulk loads of the indexes,
+# are streamed and not cached.
+#
+# The graph only changes on a re-ingest. The cache asks the database for a graph version
+# marker at most every version_interval_seconds and drops every entry of an older
+# version. By default the marker is the number of nodes and relationships, which Neo4j
+# answers from its count store. A query returning e.g. the last ingest time detects
+# changes that keep the counts:
+#
+#   "QueryCacheConfig": {
+#       "ttl_seconds": 900,
+#       "disk_dir": ".cadra_cache/queries",
+#       "version_query": "MATCH (n:Base) RETURN max(n.lastseen) AS version"
+#   }
+
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import neo4j
+from neo4j import Record
+from neo4j.graph import Node, Path, Relationship
+
+from modules.logging_base import Logging
+from modules.neo4j_utils import DetachedNode, DetachedPath, DetachedRelationship
+
+logger = Logging().getLogger()
+
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_TTL_SECONDS = 900
+DEFAULT_MAX_RECORDS = 200_000
+DEFAULT_MAX_RESULT_RECORDS = 10_000
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+DEFAULT_VERSION_INTERVAL_SECONDS = 60
+DEFAULT_VERSION_QUERY = "CALL { MATCH (n) RETURN count(n) AS nodes } " \
+                        "CALL { MATCH ()-[r]->() RETURN count(r) AS relationships } " \
+                        "RETURN nodes, relationships"
+
+# Queries that may change the graph or call procedures are never cached
+_UNCACHEABLE_QUERY = re.compile(r"\b(CREATE|MERGE|SET|DELETE|REMOVE|FOREACH)\b|\bCALL\s+[A-Za-z]", re.IGNORECASE)
+# The disk tier is pruned to this share of max_disk_bytes
+_DISK_PRUNE_RATIO = 0.9
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+@dataclass
+class _CacheEntry:
+    namespace: str
+    version: Any
+    expires_at: float
+    keys: Tuple[str, ...]
+    rows: List[tuple]
+
+    def records(self) -> List[Record]:
+        return [Record(zip(self.keys, row)) for row in self.rows]
+
+
+@dataclass
+class QueryCacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    uncached: int = 0  # results too large or of uncacheable values
+    evictions: int = 0
+    invalidations: int = 0
+
+    def __str__(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        return f"{lookups} lookups, {self.hits} memory and {self.disk_hits} disk hits ({hit_rate:.0%}), " + \
+            f"{self.uncached} uncached results, {self.evictions} evictions, {self.invalidations} invalidations"
+
+
+class CachedResult(list):
+    # The records of a query, with the parts of neo4j.Result the fetch functions use
+    def single(self) -> Optional[Record]:
+        return self[0] if self else None
+
+    def consume(self) -> None:
+        return None
+
+
+class _StreamedResult:
+    # A result beyond max_result_records: the records read so far, then the rest of the stream
+    def __init__(self, result: Any, buffered: List[Record]) -> None:
+        self._result = result
+        self._records = itertools.chain(buffered, result)
+
+    def __iter__(self) -> Iterator[Record]:
+        return self._records
+
+    def single(self) -> Optional[Record]:
+        return next(self._records, None)
+
+    def consume(self) -> Any:
+        return self._result.consume()
+
+
+class QueryCache:
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_records: int = DEFAULT_MAX_RECORDS,
+                 max_result_records: int = DEFAULT_MAX_RESULT_RECORDS, disk_dir: Optional[str] = None,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES, version_query: Optional[str] = DEFAULT_VERSION_QUERY,
+                 version_interval_seconds: float = DEFAULT_VERSION_INTERVAL_SECONDS) -> None:
+        # Without a version_query the entries only expire with the TTL
+        if ttl_seconds <= 0 or max_records < 1 or max_result_records < 1:
+            raise ValueError("TTL and record limits of the query cache must be positive")
+        self.ttl_seconds = ttl_seconds
+        self.max_records = max_records
+        self.max_result_records = min(max_result_records, max_records)
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.version_query = version_query
+        self.version_interval_seconds = version_interval_seconds
+        self.stats = QueryCacheStats()
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._record_count = 0
+        # namespace -> (graph version, time of the last check)
+        self._versions: Dict[str, Tuple[Any, float]] = {}
+        self._lock = threading.Lock()
+        self._disk_bytes = self._scan_disk() if disk_dir else 0
+
+    @classmethod
+    def from_config(cls, cache_config: Dict[str, Any]) -> "QueryCache":
+        # "QueryCacheConfig" in config.json, every key is optional
+        return cls(ttl_seconds=cache_config.get("ttl_seconds", DEFAULT_TTL_SECONDS),
+                   max_records=cache_config.get("max_records", DEFAULT_MAX_RECORDS),
+                   max_result_records=cache_config.get("max_result_records", DEFAULT_MAX_RESULT_RECORDS),
+                   disk_dir=cache_config.get("disk_dir"),
+                   max_disk_bytes=cache_config.get("max_disk_bytes", DEFAULT_MAX_DISK_BYTES),
+                   version_query=cache_config.get("version_query", DEFAULT_VERSION_QUERY),
+                   version_interval_seconds=cache_config.get("version_interval_seconds",
+                                                             DEFAULT_VERSION_INTERVAL_SECONDS))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def run(self, session: neo4j.Session, namespace: str, query: str, parameters: Dict[str, Any]) -> Any:
+        # namespace tells graph sources apart, e.g. the URI and database of the source
+        if _UNCACHEABLE_QUERY.search(query):
+            return session.run(query, parameters)
+        version = self._graph_version(session, namespace)
+        key = _cache_key(namespace, query, parameters)
+        entry = self._get(key, version)
+        if entry is not None:
+            return CachedResult(entry.records())
+
+        self.stats.misses += 1
+        result = session.run(query, parameters)
+        records = []
+        for record in result:
+            records.append(record)
+            if len(records) > self.max_result_records:
+                self.stats.uncached += 1
+                return _StreamedResult(result, records)
+        try:
+            keys = tuple(records[0].keys()) if records else ()
+            rows = [tuple(_detach(value) for value in record.values()) for record in records]
+        except _Uncacheable:
+            self.stats.uncached += 1
+            return CachedResult(records)
+        entry = _CacheEntry(namespace, version, time.time() + self.ttl_seconds, keys, rows)
+        self._put(key, entry)
+        return CachedResult(entry.records())
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        # Drops the cached results of one or all namespaces from memory and disk
+        with self._lock:
+            for key in [key for key, entry in self._entries.items()
+                        if namespace is None or entry.namespace == namespace]:
+                self._remove(key)
+            if namespace is None:
+                self._versions.clear()
+            else:
+                self._versions.pop(namespace, None)
+        if self.disk_dir is not None:
+            self._clear_disk(namespace)
+
+    def _graph_version(self, session: neo4j.Session, namespace: str) -> Any:
+        if self.version_query is None:
+            return None
+        now = time.time()
+        with self._lock:
+            known = self._versions.get(namespace)
+            if known is not None and now - known[1] < self.version_interval_seconds:
+                return known[0]
+        record = session.run(self.version_query).single()
+        version = tuple(record.values()) if record is not None else None
+        with self._lock:
+            if known is not None and known[0] != version:
+                logger.info(f"Graph version of {namespace or 'the graph'} changed, dropping its cached query results")
+                self.stats.invalidations += 1
+                for key in [key for key, entry in self._entries.items() if entry.namespace == namespace]:
+                    self._remove(key)
+            self._versions[namespace] = (version, now)
+        return version
+
+    def _get(self, key: str, version: Any) -> Optional[_CacheEntry]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.version == version and entry.expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats.hits += 1
+                    return entry
+                self._remove(key)
+        if self.disk_dir is None:
+            return None
+        entry = self._read_disk(key)
+        if entry is None:
+            return None
+        if entry.version != version or entry.expires_at <= now:
+            self._remove_disk(key)
+            return None
+        self.stats.disk_hits += 1
+        self._put(key, entry, write_disk=False)
+        return entry
+
+    def _put(self, key: str, entry: _CacheEntry, write_disk: bool = True) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._record_count += len(entry.rows)
+            while self._record_count > self.max_records:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+        if write_disk and self.disk_dir is not None:
+            self._write_disk(key, entry)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._record_count -= len(entry.rows)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.pickle")
+
+    def _read_disk(self, key: str) -> Optional[_CacheEntry]:
+        # The files are only ever written by CADRA itself into the configured cache directory
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                format_version, entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.debug(f"Ignoring unreadable cached query result {path}: {e}")
+            return None
+        if format_version != CACHE_FORMAT_VERSION or not isinstance(entry, _CacheEntry):
+            return None
+        try:
+            # The modification time orders the files for the eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def _write_disk(self, key: str, entry: _CacheEntry) -> None:
+        # Written to a temporary file first, so concurrent runs never read a partial result
+        path = self._disk_path(key)
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump((CACHE_FORMAT_VERSION, entry), f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = os.path.getsize(tmp_path)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Could not write cached query result {path}: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += size
+            prune = self._disk_bytes > self.max_disk_bytes
+        if prune:
+            self._prune_disk()
+
+    def _remove_disk(self, key: str) -> None:
+        try:
+            size = os.path.getsize(self._disk_path(key))
+            os.unlink(self._disk_path(key))
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= size
+
+    def _clear_disk(self, namespace: Optional[str]) -> None:
+        # The file names are hashes, so the namespace of a file is read from its entry
+        try:
+            files = [entry.path for entry in os.scandir(self.disk_dir) if entry.name.endswith(".pickle")]
+        except FileNotFoundError:
+            return
+        for path in files:
+            if namespace is not None:
+                try:
+                    with open(path, 'rb') as f:
+                        _, entry = pickle.load(f)
+                except Exception:
+                    continue
+                if not isinstance(entry, _CacheEntry) or entry.namespace != namespace:
+                    continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+        with self._lock:
+            self._disk_bytes = self._scan_disk()
+
+    def _scan_disk(self) -> int:
+        try:
+            return sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.name.endswith(".pickle"))
+        except FileNotFoundError:
+            return 0
+
+    def _prune_disk(self) -> None:
+        # Least recently used files first, until the tier is well below its limit
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".pickle"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_disk_bytes * _DISK_PRUNE_RATIO:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                continue
+        with self._lock:
+            self._disk_bytes = total
+
+
+class CachingSession:
+    # Stand-in for a neo4j.Session whose read queries go through a QueryCache
+    def __init__(self, session: neo4j.Session, cache: QueryCache, namespace: str = "") -> None:
+        self.session = session
+        self.cache = cache
+        self.namespace = namespace
+
+    def run(self, query: str, parameters: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        return self.cache.run(self.session, self.namespace, query, {**(parameters or {}), **kwargs})
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self.session, item)
+
+
+def _cache_key(namespace: str, query: str, parameters: Dict[str, Any]) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"{namespace}\0{query}\0".encode())
+    digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def _detach(value: Any) -> Any:
+    # Plain, picklable values instead of graph objects that keep their whole result alive
+    if isinstance(value, Node):
+        return DetachedNode(value.element_id, list(value.labels), dict(value))
+    if isinstance(value, Relationship):
+        return DetachedRelationship(value.element_id, value.type, _detach(value.start_node), _detach(value.end_node))
+    if isinstance(value, Path):
+        if len(value.relationships) != 1:
+            raise _Uncacheable()
+        return DetachedPath(_detach(value.start_node), _detach(value.relationships[0]))
+    if isinstance(value, list):
+        return [_detach(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _detach(item) for key, item in value.items()}
+    return value
@@ -0,0 +1,128 @@
+# Target-centric assessment: which principals can reach a given object.
+#
+# A reverse adjacency index over all edges with a permission rule is built in one
+# query. A single breadth-first traversal from the target then finds every principal
+# holding a right on the target, or controlling such a principal through traversable
+# edges or group membership. Each principal is scored with the regular likelihood and
+# impact logic of the permission assessment.
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import neo4j
+
+from models.bloodhound import EdgeType
+from models.neo4j import Node, node_from_record
+from modules.attribute_assessment import assess_user_attributes
+from modules.logging_base import Logging
+from modules.neo4j_utils import get_nodes_by_ids
+from modules.permission_assessment import (_assess_edge_likelihood, _impact_from_class, _qualitative_risk,
+                                           classify_impact)
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+
+@dataclass
+class ReachingEdge:
+    edge_type: str         # edge leaving the principal
+    next_hop_id: str       # node the edge points to, the target for direct rights
+    depth: int             # number of edges between the principal and the target
+    target_edge_type: str  # edge entering the target at the end of the chain
+
+
+@dataclass
+class InboundPrincipal:
+    principal: Node
+    reaching_edge: ReachingEdge
+    adass_score: float
+    likelihood: float
+    impact: int
+    risk: int  # qualitative risk
+
+    def __str__(self):
+        return f"({self.principal.name}: {self.principal.type}) - [{self.reaching_edge.edge_type}] -> " + \
+            f"... ({self.reaching_edge.depth} hop(s)) => {self.risk}"
+
+
+class ReverseAdjacencyIndex:
+    def __init__(self) -> None:
+        self.inbound: Dict[str, List[Tuple[str, str]]] = {}
+        self.edge_count: int = 0
+
+    def add_edge(self, source_id: str, edge_type: str, target_id: str) -> None:
+        self.inbound.setdefault(target_id, []).append((source_id, edge_type))
+        self.edge_count += 1
+
+    @classmethod
+    def from_session(cls, session: neo4j.Session, edge_types: List[str]) -> "ReverseAdjacencyIndex":
+        index = cls()
+        result = session.run(
+            "MATCH (a)-[r]->(b) WHERE type(r) IN $edge_types "
+            "RETURN elementId(a) AS source, type(r) AS type, elementId(b) AS target",
+            edge_types=edge_types)
+        for record in result:
+            index.add_edge(record["source"], record["type"], record["target"])
+        logger.debug(f"Built reverse adjacency index with {index.edge_count} edges")
+        return index
+
+    def traverse(self, target_id: str, permission_rules: Dict[str, Dict]) -> Dict[str, ReachingEdge]:
+        reached: Dict[str, ReachingEdge] = {}
+        queue = deque([target_id])
+        while queue:
+            node_id = queue.popleft()
+            hop = reached.get(node_id)
+            for source_id, edge_type in self.inbound.get(node_id, []):
+                if source_id == target_id or source_id in reached:
+                    continue
+                if hop is not None and not _is_expandable(edge_type, permission_rules):
+                    # A non traversable right on an intermediate principal does not grant its rights
+                    continue
+                reached[source_id] = ReachingEdge(
+                    edge_type=edge_type,
+                    next_hop_id=node_id,
+                    depth=1 if hop is None else hop.depth + 1,
+                    target_edge_type=edge_type if hop is None else hop.target_edge_type)
+                queue.append(source_id)
+        return reached
+
+
+def _is_expandable(edge_type: str, permission_rules: Dict[str, Dict]) -> bool:
+    # Members inherit the rights of their groups, regardless of MemberOf being rated non traversable
+    if edge_type == EdgeType.MEMBER_OF.value:
+        return True
+    return permission_rules.get(edge_type, {}).get('Traversable', False)
+
+
+def assess_inbound_principals(session: neo4j.Session, target: Node, permission_rules: Dict[str, Dict],
+                              attribute_rule_engine: RuleEngine, event_monitoring_config: dict,
+                              index: ReverseAdjacencyIndex = None) -> List[InboundPrincipal]:
+    if index is None:
+        index = ReverseAdjacencyIndex.from_session(session, list(permission_rules.keys()))
+    reached = index.traverse(target.id, permission_rules)
+    logger.info(f"{len(reached)} principals can reach {target.name}")
+    if not reached:
+        return []
+
+    target_impact_class = classify_impact(target, attribute_rule_engine)
+
+    inbound_principals = []
+    for record in get_nodes_by_ids(session, list(reached.keys())):
+        principal = node_from_record(record["n"], record["memberof"])
+        reaching_edge = reached[principal.id]
+        adass_score = assess_user_attributes(principal, attribute_rule_engine)
+        likelihood = _assess_edge_likelihood(reaching_edge.edge_type, permission_rules, adass_score,
+                                             event_monitoring_config)
+        traversable = permission_rules[reaching_edge.target_edge_type].get('Traversable', False)
+        impact = _impact_from_class(target_impact_class, traversable)
+        inbound_principals.append(InboundPrincipal(
+            principal=principal,
+            reaching_edge=reaching_edge,
+            adass_score=adass_score,
+            likelihood=likelihood,
+            impact=impact,
+            risk=_qualitative_risk(likelihood, impact)))
+
+    inbound_principals.sort(key=lambda inbound: (inbound.risk, inbound.likelihood * inbound.impact), reverse=True)
+    return inbound_principals
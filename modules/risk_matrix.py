@@ -0,0 +1,235 @@
+# Vectorized permission scoring for all paths of a domain.
+#
+# Paths are encoded as integer arrays (principal index, edge type index, impact class
+# of the target) and scored with NumPy lookup tables built from the permission rules.
+# Likelihood, impact and risk follow assess_permissions. The per-principal maximum is
+# the path with the highest qualitative risk, ties broken by likelihood * impact.
+#
+# assess_domain scores every enabled user of a graph this way, see AssessmentContext.score_domain.
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import neo4j
+import numpy as np
+
+from models.neo4j import Path, User, iter_user_paths, node_from_record
+from modules.attribute_assessment import assess_user_attributes
+from modules.composite_rules import join_composite_paths
+from modules.impact_index import ImpactIndex
+from modules.logging_base import Logging
+from modules.neo4j_utils import get_direct_paths_by_start, get_user_names, get_user_summaries
+from modules.permission_assessment import ImpactClass, _impact_from_class, _predisposing_conditions, classify_impact
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+# Lower bounds of the qualitative values 'Low' to 'Very High' (see _semi_qualitative_to_qualitative_dezimal)
+QUALITATIVE_THRESHOLDS = np.array([5, 10, 15, 20])
+
+# Bit layout of the per-principal reduction key: risk | likelihood * impact | path index
+_RISK_SHIFT = 56
+_RAW_SHIFT = 32
+_RAW_OFFSET = 1 << 15
+_INDEX_MASK = (1 << 32) - 1
+
+DEFAULT_BATCH_SIZE = 500
+
+
+@dataclass
+class EncodedPaths:
+    principal_ids: List[str]
+    edge_types: List[str]
+    principal_index: np.ndarray  # per path, index into principal_ids
+    edge_type_index: np.ndarray  # per path, index into edge_types
+    impact_class: np.ndarray     # per path, ImpactClass of the end node
+
+    def __len__(self):
+        return len(self.principal_index)
+
+
+@dataclass
+class RiskMatrix:
+    likelihood: np.ndarray
+    impact: np.ndarray
+    risk: np.ndarray                 # qualitative risk per path
+    principal_risk: np.ndarray       # highest qualitative risk per principal, 0 without assessable paths
+    principal_best_path: np.ndarray  # index of the path with the highest risk per principal, -1 if none
+
+
+@dataclass
+class DomainRiskMatrix:
+    principal_names: List[str]  # per entry of encoded.principal_ids
+    adass_scores: np.ndarray
+    encoded: EncodedPaths
+    matrix: RiskMatrix
+
+    @property
+    def cadra_scores(self) -> Dict[str, int]:
+        # Same as UserAssessment.cadra_score, 0 for users without assessable paths
+        return {name: int(risk) for name, risk in zip(self.principal_names, self.matrix.principal_risk)}
+
+
+class PathEncoder:
+    def __init__(self, permission_rules: Dict[str, Dict]) -> None:
+        self.edge_types: List[str] = list(permission_rules.keys())
+        self._edge_type_indices: Dict[str, int] = {edge_type: i for i, edge_type in enumerate(self.edge_types)}
+        self.principal_ids: List[str] = []
+        self._principal_indices: Dict[str, int] = {}
+        self._principal_index: List[int] = []
+        self._edge_type_index: List[int] = []
+        self._impact_class: List[int] = []
+
+    def __contains__(self, principal_id: str) -> bool:
+        return principal_id in self._principal_indices
+
+    def principal(self, principal_id: str) -> int:
+        if principal_id not in self._principal_indices:
+            self._principal_indices[principal_id] = len(self.principal_ids)
+            self.principal_ids.append(principal_id)
+        return self._principal_indices[principal_id]
+
+    def add(self, principal_id: str, edge_type: str, impact_class: ImpactClass) -> bool:
+        if edge_type not in self._edge_type_indices:
+            logger.debug(f"No permission assessment rule for relationship type '{edge_type}', skipping")
+            return False
+        self._principal_index.append(self.principal(principal_id))
+        self._edge_type_index.append(self._edge_type_indices[edge_type])
+        self._impact_class.append(int(impact_class))
+        return True
+
+    def encode(self) -> EncodedPaths:
+        return EncodedPaths(
+            principal_ids=self.principal_ids,
+            edge_types=self.edge_types,
+            principal_index=np.array(self._principal_index, dtype=np.int64),
+            edge_type_index=np.array(self._edge_type_index, dtype=np.int64),
+            impact_class=np.array(self._impact_class, dtype=np.int8),
+        )
+
+
+def encode_paths(paths: Iterable[Path], permission_rules: Dict[str, Dict], rule_engine: RuleEngine,
+                 impact_index: Optional[ImpactIndex] = None) -> EncodedPaths:
+    encoder = PathEncoder(permission_rules)
+    _add_paths(encoder, paths, permission_rules, rule_engine, impact_index)
+    return encoder.encode()
+
+
+def _add_paths(encoder: PathEncoder, paths: Iterable[Path], permission_rules: Dict[str, Dict],
+               rule_engine: RuleEngine, impact_index: Optional[ImpactIndex]) -> None:
+    for path in join_composite_paths(paths, permission_rules):
+        if path.relationship.type not in permission_rules:
+            continue
+        impact_class = impact_index.get(path.end_node.id) if impact_index is not None else None
+        if impact_class is None:
+            impact_class = classify_impact(path.end_node, rule_engine)
+        encoder.add(path.start_node.id, path.relationship.type, impact_class)
+
+
+def assess_domain(session: neo4j.Session, attribute_rule_engine: RuleEngine, permission_rules: Dict[str, Dict],
+                  event_monitoring_config: dict, names: Optional[Iterable[str]] = None,
+                  impact_index: Optional[ImpactIndex] = None,
+                  batch_size: int = DEFAULT_BATCH_SIZE) -> DomainRiskMatrix:
+    # The direct paths of every enabled user (or of the given users) scored in one pass.
+    # Users and their paths are fetched in batches of two round trips, like the AssessmentPipeline.
+    names = list(get_user_names(session) if names is None else names)
+    encoder = PathEncoder(permission_rules)
+    principal_names: List[str] = []
+    adass_scores: List[float] = []
+    for start in range(0, len(names), batch_size):
+        records = get_user_summaries(session, names[start:start + batch_size])
+        paths = get_direct_paths_by_start(session, [record["n"] for record in records if record["edges"]])
+        users: List[User] = []
+        user_paths: Dict[str, List[Path]] = {}
+        for record in records:
+            user: User = node_from_record(record["n"], record["memberof"])
+            user.edges = list(record["edges"])
+            if user.id in encoder or user.id in user_paths:
+                continue
+            users.append(user)
+            user_paths[user.id] = list(iter_user_paths(paths.get(user.id, []), user))
+        # The stale account checks of the batch, users and targets, run over epoch arrays
+        attribute_rule_engine.evaluate_temporal_criterias(
+            users + [path.end_node for user_path in user_paths.values() for path in user_path
+                     if impact_index is None or impact_index.get(path.end_node.id) is None])
+        for user in users:
+            encoder.principal(user.id)
+            principal_names.append(user.name)
+            adass_scores.append(assess_user_attributes(user, attribute_rule_engine))
+            _add_paths(encoder, user_paths[user.id], permission_rules, attribute_rule_engine, impact_index)
+
+    encoded = encoder.encode()
+    adass_array = np.array(adass_scores, dtype=np.float64)
+    matrix = score_paths(encoded, adass_array, permission_rules, event_monitoring_config)
+    logger.info(f"Scored {len(encoded)} paths of {len(principal_names)} users")
+    return DomainRiskMatrix(principal_names=principal_names, adass_scores=adass_array, encoded=encoded,
+                            matrix=matrix)
+
+
+def threat_initiation_from_adass(adass_scores: np.ndarray) -> np.ndarray:
+    adass_scores = np.asarray(adass_scores, dtype=np.float64)
+    return np.select(
+        [adass_scores >= 9, adass_scores >= 7, adass_scores >= 4, adass_scores > 0],
+        [5, 4, 3, 2], default=1).astype(np.int64)
+
+
+def build_lookup_tables(edge_types: List[str], permission_rules: Dict[str, Dict],
+                        event_monitoring_config: dict) -> Dict[str, np.ndarray]:
+    threat_occurrence = np.zeros(len(edge_types), dtype=np.int64)
+    predisposing_conditions = np.zeros(len(edge_types), dtype=np.int64)
+    traversable = np.zeros(len(edge_types), dtype=bool)
+    for i, edge_type in enumerate(edge_types):
+        rule = permission_rules[edge_type]
+        threat_occurrence[i] = rule.get('Threat Occurrence')
+        predisposing_conditions[i] = _predisposing_conditions(rule, event_monitoring_config)
+        traversable[i] = rule.get('Traversable', False)
+
+    # impact[traversable, impact_class]
+    impact = np.array([[_impact_from_class(impact_class, is_traversable) for impact_class in ImpactClass]
+                       for is_traversable in (False, True)], dtype=np.int64)
+
+    return {
+        'threat_occurrence': threat_occurrence,
+        'predisposing_conditions': predisposing_conditions,
+        'traversable': traversable,
+        'impact': impact,
+    }
+
+
+def to_qualitative(values: np.ndarray) -> np.ndarray:
+    return np.searchsorted(QUALITATIVE_THRESHOLDS, values, side='right') + 1
+
+
+def score_paths(encoded: EncodedPaths, adass_scores: np.ndarray, permission_rules: Dict[str, Dict],
+                event_monitoring_config: dict, tables: Optional[Dict[str, np.ndarray]] = None) -> RiskMatrix:
+    # adass_scores holds one ADASS score per entry of encoded.principal_ids
+    if tables is None:
+        tables = build_lookup_tables(encoded.edge_types, permission_rules, event_monitoring_config)
+    principal_count = len(encoded.principal_ids)
+    if len(adass_scores) != principal_count:
+        raise ValueError(f"Expected {principal_count} ADASS scores, got {len(adass_scores)}")
+    if len(encoded) > _INDEX_MASK:
+        raise ValueError(f"Cannot score more than {_INDEX_MASK} paths at once")
+
+    threat_initiation = threat_initiation_from_adass(adass_scores)[encoded.principal_index]
+    edge_type_index = encoded.edge_type_index
+    likelihood = threat_initiation * tables['threat_occurrence'][edge_type_index] + \
+        tables['predisposing_conditions'][edge_type_index]
+    impact = tables['impact'][tables['traversable'][edge_type_index].astype(np.int64),
+                              encoded.impact_class.astype(np.int64)]
+    risk = to_qualitative(to_qualitative(likelihood) * impact)
+
+    # Reduce to the highest scoring path per principal with a single unbuffered maximum
+    keys = (risk.astype(np.int64) << _RISK_SHIFT) | \
+        ((likelihood * impact + _RAW_OFFSET).astype(np.int64) << _RAW_SHIFT) | \
+        np.arange(len(encoded), dtype=np.int64)
+    best_keys = np.full(principal_count, -1, dtype=np.int64)
+    np.maximum.at(best_keys, encoded.principal_index, keys)
+
+    has_paths = best_keys >= 0
+    principal_risk = np.where(has_paths, best_keys >> _RISK_SHIFT, 0)
+    principal_best_path = np.where(has_paths, best_keys & _INDEX_MASK, -1)
+    logger.debug(f"Scored {len(encoded)} paths of {principal_count} principals")
+
+    return RiskMatrix(likelihood=likelihood, impact=impact, risk=risk,
+                      principal_risk=principal_risk, principal_best_path=principal_best_path)
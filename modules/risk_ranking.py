@@ -0,0 +1,97 @@
+# Streaming top-K report of the riskiest principals and their worst paths.
+#
+# Principals are ranked by qualitative risk, ties broken by likelihood * impact and then
+# by the order they were assessed in: on a full tie the earlier principal (or path) stays.
+# Only the current top principals and their top paths are kept in bounded heaps,
+# so memory depends on the report size and not on the size of the domain.
+
+import heapq
+import itertools
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from modules.logging_base import Logging
+from modules.permission_assessment import DEZ_TO_QV_MAPPING, PathAssessment
+
+logger = Logging().getLogger()
+
+
+@dataclass
+class RankedPrincipal:
+    principal: str
+    risk: int
+    score: float
+    paths: List[PathAssessment] = field(default_factory=list)
+
+    def __str__(self):
+        return f"{self.principal}: {DEZ_TO_QV_MAPPING.get(self.risk, 'None')} ({self.risk}, score {self.score})"
+
+
+class PrincipalRanking:
+    """Path sink for assess_permissions that keeps the highest risk paths of one principal."""
+
+    def __init__(self, principal: str, path_limit: int, counter: itertools.count) -> None:
+        self.principal: str = principal
+        self.path_limit: int = path_limit
+        self.risk: int = 0
+        self.score: float = float('-inf')
+        self._counter = counter
+        self._paths: List[Tuple[int, float, int, PathAssessment]] = []
+
+    def __call__(self, assessment: PathAssessment) -> None:
+        self.add(assessment)
+
+    def add(self, assessment: PathAssessment) -> None:
+        if (assessment.risk, assessment.score) > (self.risk, self.score):
+            self.risk, self.score = assessment.risk, assessment.score
+        # The negated counter keeps heap entries comparable without comparing assessments,
+        # and ranks earlier entries higher on a tie
+        entry = (assessment.risk, assessment.score, -next(self._counter), assessment)
+        if len(self._paths) < self.path_limit:
+            heapq.heappush(self._paths, entry)
+        elif entry > self._paths[0]:
+            heapq.heapreplace(self._paths, entry)
+
+    @property
+    def key(self) -> Tuple[int, float]:
+        return self.risk, self.score
+
+    def ranked_principal(self) -> RankedPrincipal:
+        paths = [entry[3] for entry in sorted(self._paths, reverse=True)]
+        return RankedPrincipal(principal=self.principal, risk=self.risk, score=self.score, paths=paths)
+
+
+class TopRiskReport:
+    def __init__(self, principal_limit: int = 100, path_limit: int = 5) -> None:
+        if principal_limit < 1 or path_limit < 1:
+            raise ValueError("Report limits must be at least 1")
+        self.principal_limit: int = principal_limit
+        self.path_limit: int = path_limit
+        self.principals_seen: int = 0
+        self._counter = itertools.count()
+        self._principals: List[Tuple[int, float, int, PrincipalRanking]] = []
+
+    def start(self, principal: str) -> PrincipalRanking:
+        return PrincipalRanking(principal, self.path_limit, self._counter)
+
+    def finish(self, ranking: PrincipalRanking) -> None:
+        self.principals_seen += 1
+        if ranking.risk == 0:
+            # No assessable paths
+            return
+        entry = (ranking.risk, ranking.score, -next(self._counter), ranking)
+        if len(self._principals) < self.principal_limit:
+            heapq.heappush(self._principals, entry)
+        elif entry > self._principals[0]:
+            evicted = heapq.heapreplace(self._principals, entry)
+            logger.debug(f"Dropped {evicted[3].principal} from the top {self.principal_limit} principals")
+
+    def report(self) -> List[RankedPrincipal]:
+        return [entry[3].ranked_principal() for entry in sorted(self._principals, reverse=True)]
+
+    def log_report(self) -> None:
+        logger.info(f"Top {len(self._principals)} of {self.principals_seen} assessed principals:")
+        for position, ranked in enumerate(self.report(), start=1):
+            logger.info(f"{position}. {ranked}")
+            for assessment in ranked.paths:
+                logger.info(f"    {assessment.path} => {DEZ_TO_QV_MAPPING[assessment.risk]}")
@@ -0,0 +1,163 @@
+# Compiled rule bundle, so a start does not have to parse every rule file again.
+#
+# The attribute rules (with their compiled temporal predicates) and the permission
+# rules are pickled into a single file in the cache directory. The bundle remembers
+# two keys:
+#
+#   - a stat key over the paths, mtimes and sizes of all rule files, which is cheap to
+#     compute even on network mounted rule directories
+#   - a content key over the paths and contents of all rule files
+#
+# Both keys include the configured rule packs, as the bundled rules are tagged with them.
+#
+# A matching stat key loads the bundle right away. Otherwise the content key decides,
+# so touching a file without changing it does not trigger a rebuild. Any mismatch, a
+# corrupt bundle or a bundle of another format version rebuilds it transparently.
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from modules.logging_base import Logging
+from modules.permission_assessment import load_permission_rules
+from modules.rule_engine import RuleEngine
+from modules.temporal import ReferenceClock, TemporalPredicate
+
+logger = Logging().getLogger()
+
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_FILENAME = "rules.bundle"
+
+
+@dataclass
+class RuleBundle:
+    attribute_rules: List[Dict]
+    temporal_predicates: Dict[Tuple[str, str], TemporalPredicate]
+    permission_rules: Dict[str, Dict]
+    stat_key: str = ""
+    content_key: str = ""
+    format_version: int = field(default=BUNDLE_FORMAT_VERSION)
+
+
+def load_rules(attributes_rules_dir_path: str, permission_rules_dir_path: str,
+               cache_dir: Optional[str] = None,
+               clock: Optional[ReferenceClock] = None,
+               rule_packs: Optional[Dict[str, str]] = None) -> Tuple[RuleEngine, Dict[str, Dict]]:
+    # Returns the attribute rule engine and the permission rules, from the bundle if it is up to date
+    # Without cache_dir the rule files are parsed directly
+    # With rule_packs ({pack: directory}) the attribute rules are loaded from the packs instead of
+    # attributes_rules_dir_path, see RuleEngine.load_rule_packs
+    if not cache_dir:
+        return _parse_rules(attributes_rules_dir_path, permission_rules_dir_path, clock, rule_packs)
+
+    bundle = load_rule_bundle(attributes_rules_dir_path, permission_rules_dir_path, cache_dir, rule_packs)
+    attribute_rule_engine = RuleEngine(clock)
+    attribute_rule_engine.load_rules(bundle.attribute_rules, bundle.temporal_predicates)
+    return attribute_rule_engine, bundle.permission_rules
+
+
+def load_rule_bundle(attributes_rules_dir_path: str, permission_rules_dir_path: str, cache_dir: str,
+                     rule_packs: Optional[Dict[str, str]] = None) -> RuleBundle:
+    attribute_dirs = list(rule_packs.values()) if rule_packs else [attributes_rules_dir_path]
+    rule_files = _rule_files(attribute_dirs + [permission_rules_dir_path])
+    bundle_path = os.path.join(cache_dir, BUNDLE_FILENAME)
+    # The order of the packs is the order of the rules, so it is part of the keys
+    packs_key = json.dumps(list(rule_packs.items())) if rule_packs else ""
+    stat_key = _stat_key(rule_files, packs_key)
+
+    cached = _read_bundle(bundle_path)
+    if cached is not None and cached.stat_key == stat_key:
+        logger.debug(f"Using rule bundle {bundle_path}")
+        return cached
+
+    content_key = _content_key(rule_files, packs_key)
+    if cached is not None and cached.content_key == content_key:
+        logger.debug(f"Rule files touched but unchanged, refreshing rule bundle {bundle_path}")
+        cached.stat_key = stat_key
+        _write_bundle(bundle_path, cached)
+        return cached
+
+    logger.info(f"Rule files changed, rebuilding rule bundle {bundle_path}")
+    attribute_rule_engine, permission_rules = _parse_rules(attributes_rules_dir_path, permission_rules_dir_path,
+                                                           rule_packs=rule_packs)
+    bundle = RuleBundle(attribute_rules=attribute_rule_engine.rules,
+                        temporal_predicates=attribute_rule_engine.temporal_predicates,
+                        permission_rules=permission_rules,
+                        stat_key=stat_key,
+                        content_key=content_key)
+    _write_bundle(bundle_path, bundle)
+    return bundle
+
+
+def _parse_rules(attributes_rules_dir_path: str, permission_rules_dir_path: str,
+                 clock: Optional[ReferenceClock] = None,
+                 rule_packs: Optional[Dict[str, str]] = None) -> Tuple[RuleEngine, Dict[str, Dict]]:
+    attribute_rule_engine = RuleEngine(clock)
+    if rule_packs:
+        attribute_rule_engine.load_rule_packs(rule_packs)
+    else:
+        attribute_rule_engine.load_rules_from_directory(attributes_rules_dir_path)
+    return attribute_rule_engine, load_permission_rules(permission_rules_dir_path)
+
+
+def _rule_files(directories: List[str]) -> List[str]:
+    rule_files = []
+    for directory in directories:
+        if not os.path.exists(directory):
+            logger.error(f"Rules directory not found: {directory}")
+            raise FileNotFoundError(f"Rules directory not found: {directory}")
+        rule_files.extend(sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.json')))
+    return rule_files
+
+
+def _stat_key(rule_files: List[str], packs_key: str = "") -> str:
+    digest = hashlib.sha256(packs_key.encode())
+    for rule_file in rule_files:
+        stat = os.stat(rule_file)
+        digest.update(f"{rule_file}\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode())
+    return digest.hexdigest()
+
+
+def _content_key(rule_files: List[str], packs_key: str = "") -> str:
+    digest = hashlib.sha256(packs_key.encode())
+    for rule_file in rule_files:
+        digest.update(f"{rule_file}\0".encode())
+        with open(rule_file, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def _read_bundle(bundle_path: str) -> Optional[RuleBundle]:
+    # The bundle is only ever written by CADRA itself into the configured cache directory
+    try:
+        with open(bundle_path, 'rb') as f:
+            bundle = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable rule bundle {bundle_path}: {e}")
+        return None
+    if not isinstance(bundle, RuleBundle) or bundle.format_version != BUNDLE_FORMAT_VERSION:
+        logger.debug(f"Ignoring rule bundle {bundle_path} of another format")
+        return None
+    return bundle
+
+
+def _write_bundle(bundle_path: str, bundle: RuleBundle) -> None:
+    # Written to a temporary file first, so concurrent starts never read a partial bundle
+    try:
+        os.makedirs(os.path.dirname(bundle_path) or ".", exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(bundle_path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, bundle_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        logger.warning(f"Could not write rule bundle {bundle_path}: {e}")
@@ -1,18 +1,68 @@
 import os
 import json
-from typing import Dict, List, Any
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Any, Optional, Tuple
 
 from modules.logging_base import Logging
 from models.neo4j import Node
+from modules.profiling import profile_stage
+from modules.temporal import TEMPORAL_OPERATORS, ReferenceClock, TemporalPredicate, compile_temporal_predicate, \
+    epoch_array
 from modules.utils import compare
 
 logger = Logging().getLogger()
 
+# Fingerprint entry of a property a node does not have
+_MISSING = ('missing',)
+
+# Operators that enter the fingerprint by their outcome instead of the property value, because
+# the values (timestamps, account names, SPNs) differ for almost every node
+_OUTCOME_OPERATORS = set(TEMPORAL_OPERATORS) | {'startswith', 'endswith', 'set', 'notset'}
+
+# Nodes whose on demand results, criteria outcomes and fingerprints are kept, the least recently
+# used ones are dropped first. A run asks for the same principals again while it scores their paths,
+# so this only has to cover a batch, not the whole domain.
+NODE_CACHE_SIZE = 10_000
+
+
+@dataclass
+class _EquivalenceClass:
+    # Rule results shared by all nodes with the same fingerprint. They hold no property values:
+    # the criteria outcomes with the 'actual' values stay with the node that was evaluated.
+    results: List[Dict]
+    members: int = 1
+
 
 class RuleEngine:
-    def __init__(self):
+    def __init__(self, clock: Optional[ReferenceClock] = None, node_cache_size: int = NODE_CACHE_SIZE):
         self.rules: List[Dict] = []
         self.evaluated_rules: Dict[int, List[Dict]] = {}
+        # Results of single rules evaluated on demand, per node and rule, see rule_matches.
+        # Like the criteria outcomes and fingerprints below, kept for at most node_cache_size nodes.
+        self.node_cache_size = node_cache_size
+        self.partial_results: Dict[int, Dict[int, Dict]] = OrderedDict()
+        self._rules_by_name: Dict[str, List[Dict]] = {}
+        # Identical criteria of all rules (and rule packs) are evaluated once per node:
+        # id of a criteria in a rule -> index of the distinct criteria, and the cached
+        # outcomes of the distinct criteria of nodes whose rules are not all evaluated yet
+        self._criteria_keys: Dict[int, int] = {}
+        self.distinct_criteria: int = 0
+        # Distinct temporal criteria: (property, operator, canonical value) -> index, and index -> criteria
+        self._temporal_keys: Dict[Tuple, int] = {}
+        self._temporal_criterias: Dict[int, Dict[str, Any]] = {}
+        self._criteria_results: Dict[int, Dict[int, Any]] = OrderedDict()
+        # One reference time for every temporal criteria evaluated during this run
+        self.clock: ReferenceClock = clock or ReferenceClock()
+        self.temporal_predicates: Dict[Tuple[str, str], TemporalPredicate] = {}
+        # Nodes with equal values for every property the rules reference get equal results
+        self.equivalence_classes: Dict[Tuple, _EquivalenceClass] = {}
+        # Values derived from rule results, like the ADASS score, per fingerprint, see get_shared_result
+        self.shared_results: Dict[Tuple, Dict[str, Any]] = {}
+        self._node_fingerprints: Dict[str, Tuple] = OrderedDict()
+        self._fingerprint_properties: List[str] = []
+        self._fingerprint_criterias: List[Tuple[str, str, Any]] = []
+        self._indexed_rules: Tuple[int, int] = (id(self.rules), 0)
 
     def load_rules_from_directory(self, rules_directory: str) -> None:
         self.rules = []
@@ -28,13 +78,179 @@ class RuleEngine:
             with open(rule_path, 'r') as f:
                 try:
                     rule = json.load(f)
+                    self._compile_temporal_criterias(rule)
                     self.rules.append(rule)
                 except json.JSONDecodeError as e:
                     logger.error(f"Error loading rule from {rule_path}: {e}")
                     continue
+                except ValueError as e:
+                    logger.error(f"Invalid temporal criteria in rule {rule_path}: {e}")
+                    continue
 
+        self._index_rule_properties()
         logger.info(f"Loaded {len(self.rules)} rules from {rules_directory}")
 
+    def load_rule_packs(self, rule_packs: Dict[str, str]) -> None:
+        # Several rule directories, e.g. {"baseline": ..., "strict": ...}, evaluated in one pass.
+        # Every rule is tagged with its pack, see get_matching_rules.
+        rules = []
+        for pack, rules_directory in rule_packs.items():
+            self.load_rules_from_directory(rules_directory)
+            for rule in self.rules:
+                rule['Pack'] = pack
+            rules.extend(self.rules)
+        self.rules = rules
+        self.evaluated_rules = {}
+        self.partial_results = OrderedDict()
+        self._index_rule_properties()
+        logger.info(f"Loaded {len(self.rules)} rules from {len(rule_packs)} rule packs")
+
+    @property
+    def rule_packs(self) -> List[str]:
+        return sorted({rule['Pack'] for rule in self.rules if 'Pack' in rule})
+
+    def load_rules(self, rules: List[Dict],
+                   temporal_predicates: Optional[Dict[Tuple[str, str], TemporalPredicate]] = None) -> None:
+        # Already parsed rules, e.g. from a rule bundle, see modules.rule_cache
+        self.rules = list(rules)
+        self.temporal_predicates = dict(temporal_predicates or {})
+        for rule in self.rules:
+            self._compile_temporal_criterias(rule)
+        self.evaluated_rules = {}
+        self.partial_results = OrderedDict()
+        self._index_rule_properties()
+        logger.info(f"Loaded {len(self.rules)} precompiled rules")
+
+    def fork(self) -> "RuleEngine":
+        # Shares the loaded rules and the reference clock, but keeps its own evaluation cache
+        engine = RuleEngine(self.clock, self.node_cache_size)
+        engine.rules = self.rules
+        engine.temporal_predicates = self.temporal_predicates
+        # Fingerprints do not depend on element ids, so equivalence classes are valid across sources
+        engine.equivalence_classes = self.equivalence_classes
+        engine.shared_results = self.shared_results
+        engine._fingerprint_properties = self._fingerprint_properties
+        engine._fingerprint_criterias = self._fingerprint_criterias
+        engine._rules_by_name = self._rules_by_name
+        engine._criteria_keys = self._criteria_keys
+        engine.distinct_criteria = self.distinct_criteria
+        engine._temporal_keys = self._temporal_keys
+        engine._temporal_criterias = self._temporal_criterias
+        engine._indexed_rules = self._indexed_rules
+        return engine
+
+    def _compile_temporal_criterias(self, rule: Dict) -> None:
+        for sub_criteria in _iter_criterias(rule):
+            if sub_criteria.get('Operator') in TEMPORAL_OPERATORS:
+                self._get_temporal_predicate(sub_criteria['Operator'], sub_criteria['Value'])
+
+    def _index_rule_properties(self) -> None:
+        properties = set()
+        criterias = {}
+        for rule in self.rules:
+            for criteria in _iter_criterias(rule):
+                if criteria.get('Operator') in _OUTCOME_OPERATORS:
+                    key = (criteria['Property'], criteria['Operator'], str(criteria['Value']))
+                    criterias[key] = (criteria['Property'], criteria['Operator'], criteria['Value'])
+                else:
+                    properties.add(criteria['Property'])
+        self._fingerprint_properties = sorted(properties)
+        self._fingerprint_criterias = [criterias[key] for key in sorted(criterias)]
+        self._rules_by_name = {}
+        for rule in self.rules:
+            self._rules_by_name.setdefault(rule.get('Name', 'Unknown'), []).append(rule)
+        distinct_criteria: Dict[Tuple, int] = {}
+        self._criteria_keys = {}
+        self._temporal_keys = {}
+        self._temporal_criterias = {}
+        for rule in self.rules:
+            for criteria in _iter_criterias(rule):
+                key = (criteria['Property'], criteria['Operator'], _canonical(criteria['Value']))
+                self._criteria_keys[id(criteria)] = distinct_criteria.setdefault(key, len(distinct_criteria))
+                if criteria['Operator'] in TEMPORAL_OPERATORS:
+                    self._temporal_keys[key] = distinct_criteria[key]
+                    self._temporal_criterias[distinct_criteria[key]] = criteria
+        self.distinct_criteria = len(distinct_criteria)
+        self._criteria_results = OrderedDict()
+        self.equivalence_classes = {}
+        self.shared_results = {}
+        self._node_fingerprints = OrderedDict()
+        self._indexed_rules = (id(self.rules), len(self.rules))
+
+    def fingerprint(self, node: Node) -> Tuple:
+        # Canonical values of every property the rules reference, resolved like the criteria do
+        if self._indexed_rules != (id(self.rules), len(self.rules)):
+            # The rules were changed without loading them, e.g. by appending to them
+            self._index_rule_properties()
+        values: List[Any] = [type(node).__name__]
+        for property_name in self._fingerprint_properties:
+            try:
+                values.append(_canonical(getattr(node, property_name)))
+            except AttributeError:
+                values.append(_MISSING)
+        for property_name, operator, expected_value in self._fingerprint_criterias:
+            try:
+                if operator in TEMPORAL_OPERATORS:
+                    values.append(self._temporal_match(node, property_name, operator, expected_value))
+                else:
+                    value = getattr(node, property_name)
+                    values.append(compare(operator, value, expected_value))
+            except Exception:
+                values.append(_MISSING)
+        return tuple(values)
+
+    def _temporal_match(self, node: Node, property_name: str, operator: str, expected_value: Any) -> bool:
+        # The outcome cached by evaluate_temporal_criterias, if the node was part of a batch
+        key = self._temporal_keys.get((property_name, operator, _canonical(expected_value)))
+        outcome = self._criteria_results.get(node.id, {}).get(key)
+        if isinstance(outcome, dict):
+            return outcome['match']
+        return self._get_temporal_predicate(operator, expected_value).evaluate(
+            getattr(node, property_name), self.clock)
+
+    def evaluate_temporal_criterias(self, nodes: Iterable[Node]) -> None:
+        # Checks every temporal criteria of the rules for a batch of nodes at once over epoch arrays,
+        # e.g. the stale account checks of a whole domain. The outcomes are cached per node and
+        # used by the fingerprints and rule evaluations of these nodes.
+        if self._indexed_rules != (id(self.rules), len(self.rules)):
+            self._index_rule_properties()
+        nodes = [node for node in nodes if not self.evaluated_rules.get(node.id)]
+        if not nodes or not self._temporal_criterias:
+            return
+        with profile_stage("rule_engine"):
+            for key, criteria in self._temporal_criterias.items():
+                property_name, operator = criteria['Property'], criteria['Operator']
+                expected_value = criteria['Value']
+                present = []
+                for node in nodes:
+                    try:
+                        present.append((node, getattr(node, property_name)))
+                    except AttributeError:
+                        # Missing properties are left to the node by node evaluation
+                        continue
+                matches = self._get_temporal_predicate(operator, expected_value).evaluate_many(
+                    epoch_array(value for _, value in present), self.clock)
+                for (node, value), matched in zip(present, matches):
+                    self._node_cache(self._criteria_results, node.id).setdefault(key, {
+                        'match': bool(matched),
+                        'property': property_name,
+                        'operator': operator,
+                        'expected': expected_value,
+                        'actual': value
+                    })
+
+    def _get_temporal_predicate(self, operator: str, value: Any) -> TemporalPredicate:
+        key = (operator, str(value))
+        if key not in self.temporal_predicates:
+            self.temporal_predicates[key] = compile_temporal_predicate(operator, value)
+        return self.temporal_predicates[key]
+
+    def get_rule(self, rule_name: str) -> Dict:
+        for rule in self.rules:
+            if rule.get('Name') == rule_name:
+                return rule
+        raise KeyError(f"No rule named '{rule_name}' loaded")
+
     def __check_criteria(self, criteria: Dict[str, Any], node: Node) -> Dict[str, Any]:
         property_name = criteria['Property']
         user_property_value = getattr(node, property_name)
@@ -42,7 +258,11 @@ class RuleEngine:
         expected_value = criteria['Value']
 
         try:
-            matched = compare(operator, user_property_value, expected_value)
+            if operator in TEMPORAL_OPERATORS:
+                matched = self._get_temporal_predicate(operator, expected_value).evaluate(
+                    user_property_value, self.clock)
+            else:
+                matched = compare(operator, user_property_value, expected_value)
             # logger.info(f"Criteria check: {property_name} {operator} {expected_value} => {matched}")
             logger.debug(
                 f"Comparing {property_name} with value {user_property_value} {operator} {expected_value}, match: {matched}")
@@ -58,17 +278,34 @@ class RuleEngine:
             'actual': user_property_value
         }
 
-    def __check_criterias(self, criterias: List[Dict[str, Any]], node: Node) -> list[bool]:
+    def __check_shared_criteria(self, criteria: Dict[str, Any], node: Node,
+                                criteria_results: Optional[Dict[int, Any]]) -> Dict[str, Any]:
+        # Outcome of an identical criteria evaluated for the node before, including a missing property
+        key = self._criteria_keys.get(id(criteria))
+        if criteria_results is None or key is None:
+            return self.__check_criteria(criteria, node)
+        if key not in criteria_results:
+            try:
+                criteria_results[key] = self.__check_criteria(criteria, node)
+            except Exception as e:
+                criteria_results[key] = e
+        outcome = criteria_results[key]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def __check_criterias(self, criterias: List[Dict[str, Any]], node: Node,
+                          criteria_results: Optional[Dict[int, Any]] = None) -> list[bool]:
         results = []
         for criteria in criterias:
             try:
                 logger.debug(f"Checking criteria: {criteria}")
                 if isinstance(criteria, list):
                     for sub_criteria in criteria:
-                        result = self.__check_criteria(sub_criteria, node)
+                        result = self.__check_shared_criteria(sub_criteria, node, criteria_results)
                         results.append(result['match'])
                 else:
-                    result = self.__check_criteria(criteria, node)
+                    result = self.__check_shared_criteria(criteria, node, criteria_results)
                     results.append(result['match'])
                 logger.debug(f"Criteria '{criteria}' => {any(results)}")
 
@@ -85,10 +322,12 @@ class RuleEngine:
 
         return results
 
-    def evaluate_rule(self, rule: Dict, node: Node) -> Dict[str, Any]:
+    def evaluate_rule(self, rule: Dict, node: Node, criteria_results: Optional[Dict[int, Any]] = None) -> Dict[str, Any]:
+        # criteria_results shares the outcomes of identical criteria between the rules evaluated for the node
         logger.debug(f"Evaluating rule: {rule.get('Name', 'Unnamed Rule')}")
         result = {
             'rule_name': rule.get('Name', 'Unknown'),
+            'pack': rule.get('Pack'),
             'metric': rule.get('Metric', 'Unknown'),
             'value': rule.get("Value", "Unknown"),
             'prerequisites_met': False,
@@ -105,9 +344,9 @@ class RuleEngine:
                 logger.debug(f"Checking prerequisite criteria '{criteria_key}'")
                 matched = None
                 if isinstance(criteria_value, list):
-                    matched = any(self.__check_criterias(criteria_value, node))
+                    matched = any(self.__check_criterias(criteria_value, node, criteria_results))
                 elif isinstance(criteria_value, dict):
-                    matched = self.__check_criterias([criteria_value], node)[0]
+                    matched = self.__check_criterias([criteria_value], node, criteria_results)[0]
                 else:
                     raise ValueError(
                         f"Invalid format for prerequisite criteria: {prerequisite_criteria}")
@@ -129,9 +368,9 @@ class RuleEngine:
                 logger.debug(f"Checking criteria '{criteria_key}'")
                 matched = None
                 if isinstance(criteria_value, list):
-                    matched = any(self.__check_criterias(criteria_value, node))
+                    matched = any(self.__check_criterias(criteria_value, node, criteria_results))
                 elif isinstance(criteria_value, dict):
-                    matched = self.__check_criterias([criteria_value], node)[0]
+                    matched = self.__check_criterias([criteria_value], node, criteria_results)[0]
                 else:
                     raise ValueError(f"Invalid format for criteria: {criteria}")
                 logger.debug(f"Criteria '{criteria_key}' matched: {matched}")
@@ -149,13 +388,112 @@ class RuleEngine:
 
     def evaluate_all_rules(self, node: Node):
         logger.info(f"Evaluating all rules for node: {node.name} (ID: {node.id})")
-        for rule in self.rules:
-            result = self.evaluate_rule(rule, node)
-            self.evaluated_rules.setdefault(node.id, []).append(result)
+        # Rules already evaluated on demand are not evaluated again
+        partial_results = self.partial_results.pop(node.id, {})
+        criteria_results = self._criteria_results.pop(node.id, {})
+        with profile_stage("rule_engine"):
+            for rule in self.rules:
+                result = partial_results.get(id(rule))
+                if result is None:
+                    result = self.evaluate_rule(rule, node, criteria_results)
+                self.evaluated_rules.setdefault(node.id, []).append(result)
 
-    def get_matching_rules(self, node: Node) -> List[Dict[str, Any]]:
+    def get_matching_rules(self, node: Node, pack: Optional[str] = None) -> List[Dict[str, Any]]:
+        # Matching rules of all rule packs, or only of the given one
         if not self.evaluated_rules.get(node.id):
-            self.evaluate_all_rules(node)
+            fingerprint = self._node_fingerprint(node)
+            equivalence_class = self.equivalence_classes.get(fingerprint)
+            if equivalence_class is None:
+                self.evaluate_all_rules(node)
+                self.equivalence_classes[fingerprint] = _EquivalenceClass(self.evaluated_rules.get(node.id, []))
+            else:
+                logger.debug(f"Sharing rule evaluations of an equivalent node with {node.name} (ID: {node.id})")
+                equivalence_class.members += 1
+                self.evaluated_rules[node.id] = equivalence_class.results
+                self.partial_results.pop(node.id, None)
+                self._criteria_results.pop(node.id, None)
         else:
             logger.info(f"Using cached rule evaluations for node: {node.name} (ID: {node.id})")
-        return [result for result in self.evaluated_rules.get(node.id, []) if result.get('matches', False)]
+        return [result for result in self.evaluated_rules.get(node.id, [])
+                if result.get('matches', False) and (pack is None or result.get('pack') == pack)]
+
+    def rule_matches(self, node: Node, rule_name: str, pack: Optional[str] = None) -> bool:
+        # Evaluates only the rules with this name, see rule_result. Rules that are not loaded never match.
+        if self._indexed_rules != (id(self.rules), len(self.rules)):
+            self._index_rule_properties()
+        return any(self.rule_result(node, rule)['matches'] for rule in self._rules_by_name.get(rule_name, [])
+                   if pack is None or rule.get('Pack') == pack)
+
+    def rule_result(self, node: Node, rule: Dict) -> Dict[str, Any]:
+        # Result of a single loaded rule, cached for the node unless all its rules were evaluated already
+        evaluated_rules = self.evaluated_rules.get(node.id)
+        if evaluated_rules:
+            for loaded_rule, result in zip(self.rules, evaluated_rules):
+                if loaded_rule is rule:
+                    return result
+        partial_results = self._node_cache(self.partial_results, node.id)
+        result = partial_results.get(id(rule))
+        if result is None:
+            with profile_stage("rule_engine"):
+                result = partial_results[id(rule)] = self.evaluate_rule(
+                    rule, node, self._node_cache(self._criteria_results, node.id))
+        return result
+
+    def first_matching_rule(self, node: Node, rule_names: Iterable[str], pack: Optional[str] = None) -> Optional[str]:
+        # rule_names in priority order, the rules after the first match are not evaluated
+        for rule_name in rule_names:
+            if self.rule_matches(node, rule_name, pack):
+                return rule_name
+        return None
+
+    def get_shared_result(self, node: Node, key: str, compute: Callable[[], Any]) -> Any:
+        # Memoizes a value that only depends on the rule results of the node, like its ADASS score,
+        # for all nodes with the same fingerprint. compute evaluates only the rules it queries.
+        shared = self.shared_results.setdefault(self._node_fingerprint(node), {})
+        if key not in shared:
+            shared[key] = compute()
+        return shared[key]
+
+    def _node_fingerprint(self, node: Node) -> Tuple:
+        fingerprint = self._node_fingerprints.get(node.id)
+        if fingerprint is None:
+            fingerprint = self._node_fingerprints[node.id] = self.fingerprint(node)
+            if len(self._node_fingerprints) > self.node_cache_size:
+                self._node_fingerprints.popitem(last=False)
+        else:
+            self._node_fingerprints.move_to_end(node.id)
+        return fingerprint
+
+    def _node_cache(self, cache: "OrderedDict[str, Dict]", node_id: str) -> Dict:
+        # The entry of the node in one of the per node caches, evicting the least recently used node
+        entry = cache.get(node_id)
+        if entry is None:
+            entry = cache[node_id] = {}
+            if len(cache) > self.node_cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(node_id)
+        return entry
+
+
+def _iter_criterias(rule: Dict):
+    for criteria_group in [rule.get('Prerequisite Criteria', {}), rule.get('Criteria', {})]:
+        for criteria_value in criteria_group.values():
+            criterias = criteria_value if isinstance(criteria_value, list) else [criteria_value]
+            for criteria in criterias:
+                for sub_criteria in (criteria if isinstance(criteria, list) else [criteria]):
+                    if isinstance(sub_criteria, dict) and 'Property' in sub_criteria:
+                        yield sub_criteria
+
+
+def _canonical(value: Any) -> Any:
+    # Hashable and order independent, the type keeps e.g. True and 1 apart
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return ('list', tuple(sorted((_canonical(item) for item in value), key=repr)))
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted(((key, _canonical(item)) for key, item in value.items()), key=repr)))
+    try:
+        hash(value)
+    except TypeError:
+        return (type(value).__name__, repr(value))
+    return (type(value).__name__, value)
@@ -0,0 +1,141 @@
+# Fast estimate of the domain risk distribution from a stratified random sample.
+#
+# Users and computers are stratified by node type, enabled state and admincount, which
+# are cheap to fetch for the whole domain in one query. A proportionally allocated
+# sample of every stratum runs through the regular attribute and permission assessment
+# and the number of principals per qualitative risk level is estimated with the
+# stratified estimator. The confidence intervals use the normal approximation with a
+# finite population correction.
+#
+# Without an explicit sample size the size is derived from the error bound, the largest
+# acceptable half width of the confidence interval of a risk level's share.
+
+import math
+import random
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Dict, List, Optional, Tuple
+
+import neo4j
+
+from models.bloodhound import NodeType
+from models.neo4j import iter_user_paths, node_from_record
+from modules.attribute_assessment import assess_user_attributes
+from modules.logging_base import Logging
+from modules.neo4j_utils import get_nodes_by_ids, iter_principal_strata, stream_direct_user_paths
+from modules.permission_assessment import DEZ_TO_QV_MAPPING, assess_permissions
+from modules.rule_engine import RuleEngine
+
+logger = Logging().getLogger()
+
+SAMPLED_NODE_TYPES = [NodeType.USER.value, NodeType.COMPUTER.value]
+
+# Risk levels that are estimated, 0 for principals without assessable paths
+RISK_LEVELS = [0] + sorted(DEZ_TO_QV_MAPPING.keys())
+
+# Sampled principals are fetched in batches of this size
+SAMPLE_BATCH_SIZE = 500
+
+Stratum = Tuple[str, bool, bool]  # (node type, enabled, admincount)
+
+
+@dataclass
+class RiskLevelEstimate:
+    risk: int
+    estimate: float
+    lower: float
+    upper: float
+
+    def __str__(self):
+        return f"{DEZ_TO_QV_MAPPING.get(self.risk, 'None')}: {self.estimate:.0f} ({self.lower:.0f} - {self.upper:.0f})"
+
+
+@dataclass
+class RiskDistributionEstimate:
+    population: int
+    sample_size: int
+    confidence: float
+    levels: List[RiskLevelEstimate] = field(default_factory=list)
+    strata: Dict[Stratum, Tuple[int, int]] = field(default_factory=dict)  # stratum -> (population, sample size)
+
+
+def required_sample_size(population: int, error_bound: float, confidence: float) -> int:
+    # Worst case p = 0.5 for the share of a single risk level
+    if not 0 < error_bound < 1:
+        raise ValueError(f"Error bound must be between 0 and 1, got {error_bound}")
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    n0 = z * z * 0.25 / (error_bound * error_bound)
+    return min(population, math.ceil(n0 / (1 + (n0 - 1) / population))) if population else 0
+
+
+def allocate_sample(strata: Dict[Stratum, int], sample_size: int) -> Dict[Stratum, int]:
+    # Proportional allocation, at least two principals per stratum so its variance can be estimated
+    population = sum(strata.values())
+    allocation = {}
+    for stratum, stratum_population in strata.items():
+        size = round(sample_size * stratum_population / population) if population else 0
+        allocation[stratum] = min(stratum_population, max(size, 2))
+    return allocation
+
+
+def estimate_risk_distribution(session: neo4j.Session, attribute_rule_engine: RuleEngine,
+                               permission_rules: Dict[str, Dict], event_monitoring_config: dict,
+                               sample_size: Optional[int] = None, error_bound: float = 0.05,
+                               confidence: float = 0.95, seed: Optional[int] = None) -> RiskDistributionEstimate:
+    strata_ids: Dict[Stratum, List[str]] = {}
+    for record in iter_principal_strata(session, SAMPLED_NODE_TYPES):
+        stratum = (record["type"], bool(record["enabled"]), bool(record["admincount"]))
+        strata_ids.setdefault(stratum, []).append(record["id"])
+    strata = {stratum: len(ids) for stratum, ids in strata_ids.items()}
+    population = sum(strata.values())
+    if sample_size is None:
+        sample_size = required_sample_size(population, error_bound, confidence)
+    allocation = allocate_sample(strata, sample_size)
+    logger.info(f"Sampling {sum(allocation.values())} of {population} principals in {len(strata)} strata")
+
+    rng = random.Random(seed)
+    risk_counts: Dict[Stratum, Dict[int, int]] = {}
+    for stratum, size in allocation.items():
+        sample = rng.sample(strata_ids[stratum], size)
+        counts = risk_counts.setdefault(stratum, {})
+        for risk in _assess_sample(session, sample, attribute_rule_engine, permission_rules, event_monitoring_config):
+            counts[risk] = counts.get(risk, 0) + 1
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    levels = []
+    for risk in RISK_LEVELS:
+        estimate = 0.0
+        variance = 0.0
+        for stratum, stratum_population in strata.items():
+            size = allocation[stratum]
+            if size == 0:
+                continue
+            share = risk_counts[stratum].get(risk, 0) / size
+            estimate += stratum_population * share
+            if 1 < size < stratum_population:
+                variance += stratum_population ** 2 * (1 - size / stratum_population) * \
+                    share * (1 - share) / (size - 1)
+        half_width = z * math.sqrt(variance)
+        levels.append(RiskLevelEstimate(risk=risk, estimate=estimate,
+                                        lower=max(0.0, estimate - half_width),
+                                        upper=min(float(population), estimate + half_width)))
+
+    return RiskDistributionEstimate(population=population, sample_size=sum(allocation.values()),
+                                    confidence=confidence, levels=levels,
+                                    strata={stratum: (strata[stratum], allocation[stratum]) for stratum in strata})
+
+
+def _assess_sample(session: neo4j.Session, node_ids: List[str], attribute_rule_engine: RuleEngine,
+                   permission_rules: Dict[str, Dict], event_monitoring_config: dict) -> List[int]:
+    risks = []
+    for start in range(0, len(node_ids), SAMPLE_BATCH_SIZE):
+        records = list(get_nodes_by_ids(session, node_ids[start:start + SAMPLE_BATCH_SIZE]))
+        principals = [node_from_record(record["n"], record["memberof"]) for record in records]
+        # The stale account checks of the batch run over epoch arrays
+        attribute_rule_engine.evaluate_temporal_criterias(principals)
+        for record, principal in zip(records, principals):
+            adass_score = assess_user_attributes(principal, attribute_rule_engine)
+            paths = iter_user_paths(stream_direct_user_paths(session, record["n"]), principal)
+            risks.append(assess_permissions(paths, permission_rules, attribute_rule_engine, adass_score,
+                                            event_monitoring_config))
+    return risks
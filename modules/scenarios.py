@@ -0,0 +1,191 @@
+# What-if scenarios on top of a baseline run, e.g. "what if event 4662 was monitored"
+# or "what if this GenericWrite edge was removed".
+#
+# ScenarioBaseline is a path sink for assess_permissions (and assess_user). It keeps the
+# components of every scored path (principal, edge, threat initiation and impact) and
+# the threat occurrence and predisposing conditions per edge type. A scenario only
+# changes the predisposing conditions of edge types whose monitored events change, or
+# drops single edges, so only those paths and the principals owning them are scored again.
+# The joined path of a compound right (see modules.composite_rules) is dropped with any
+# of its component edges.
+#
+#   baseline = ScenarioBaseline(permission_rules, event_monitoring_config)
+#   for name in principals:
+#       assess_user(session, name, engine, permission_rules, event_monitoring_config, path_sink=baseline)
+#   results = baseline.evaluate_all([
+#       Scenario("monitor 4662", event_monitoring={"4662": True}),
+#       Scenario("drop edge", removed_edges={"5:...:1234"}),
+#   ])
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from models.neo4j import CompositePath, Path
+from modules.logging_base import Logging
+from modules.permission_assessment import DEZ_TO_QV_MAPPING, PathAssessment
+from modules.risk_matrix import build_lookup_tables, to_qualitative
+
+logger = Logging().getLogger()
+
+
+@dataclass
+class Scenario:
+    name: str
+    event_monitoring: Dict[str, bool] = field(default_factory=dict)  # overrides of the EventMonitoringConfig
+    removed_edges: Set[str] = field(default_factory=set)  # element ids of the removed relationships
+
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    baseline_domain_risk: int
+    domain_risk: int  # highest qualitative risk of all principals, 0 without assessable paths
+    changed_principals: Dict[str, Tuple[int, int]]  # principal node id -> (baseline risk, scenario risk)
+    rescored_paths: int
+    removed_paths: int
+
+    def __str__(self):
+        return (f"{self.scenario}: domain risk {DEZ_TO_QV_MAPPING.get(self.baseline_domain_risk, 'None')} -> "
+                f"{DEZ_TO_QV_MAPPING.get(self.domain_risk, 'None')}, "
+                f"{len(self.changed_principals)} principal(s) changed")
+
+
+@dataclass
+class _BaselineArrays:
+    principal_index: np.ndarray
+    edge_type_index: np.ndarray
+    threat_initiation: np.ndarray
+    impact: np.ndarray
+    risk: np.ndarray
+    principal_risk: np.ndarray
+    edge_rows: Dict[str, np.ndarray]
+
+
+class ScenarioBaseline:
+    """Path sink for assess_permissions that caches the scoring components of every path."""
+
+    def __init__(self, permission_rules: Dict[str, Dict], event_monitoring_config: dict) -> None:
+        self.permission_rules: Dict[str, Dict] = permission_rules
+        self.event_monitoring_config: Dict[str, bool] = _normalize_events(event_monitoring_config)
+        self.edge_types: List[str] = list(permission_rules.keys())
+        self._edge_type_indices: Dict[str, int] = {edge_type: i for i, edge_type in enumerate(self.edge_types)}
+        self._tables = build_lookup_tables(self.edge_types, permission_rules, self.event_monitoring_config)
+        # Node ids, names are not unique across object types
+        self.principals: List[str] = []
+        self.principal_names: Dict[str, str] = {}
+        self._principal_indices: Dict[str, int] = {}
+        self._principal_index: List[int] = []
+        self._edge_type_index: List[int] = []
+        self._threat_initiation: List[int] = []
+        self._impact: List[int] = []
+        self._edge_ids: List[Tuple[str, ...]] = []  # per row, the relationship ids the path depends on
+        self._arrays: Optional[_BaselineArrays] = None
+
+    def __call__(self, assessment: PathAssessment) -> None:
+        self.add(assessment)
+
+    def __len__(self):
+        return len(self._edge_ids)
+
+    def add(self, assessment: PathAssessment) -> None:
+        path = assessment.path
+        principal = path.start_node.id
+        if principal not in self._principal_indices:
+            self._principal_indices[principal] = len(self.principals)
+            self.principals.append(principal)
+            self.principal_names[principal] = path.start_node.name
+        self._principal_index.append(self._principal_indices[principal])
+        self._edge_type_index.append(self._edge_type_indices[path.relationship.type])
+        self._threat_initiation.append(assessment.threat_initiation)
+        self._impact.append(assessment.impact)
+        self._edge_ids.append(_relationship_ids(path))
+        self._arrays = None
+
+    def evaluate_all(self, scenarios: Iterable[Scenario]) -> List[ScenarioResult]:
+        return [self.evaluate(scenario) for scenario in scenarios]
+
+    def evaluate(self, scenario: Scenario) -> ScenarioResult:
+        arrays = self._freeze()
+        baseline_domain_risk = int(arrays.principal_risk.max(initial=0))
+
+        event_monitoring_config = {**self.event_monitoring_config, **_normalize_events(scenario.event_monitoring)}
+        tables = build_lookup_tables(self.edge_types, self.permission_rules, event_monitoring_config)
+        changed_edge_types = np.flatnonzero(tables['predisposing_conditions'] != self._tables['predisposing_conditions'])
+
+        removed = np.zeros(len(self), dtype=bool)
+        for edge_id in scenario.removed_edges:
+            rows = arrays.edge_rows.get(edge_id)
+            if rows is None:
+                logger.warning(f"Scenario '{scenario.name}': edge {edge_id} is not part of the baseline")
+                continue
+            removed[rows] = True
+        rescored = np.isin(arrays.edge_type_index, changed_edge_types) & ~removed
+
+        risk = arrays.risk.copy()
+        edge_type_index = arrays.edge_type_index[rescored]
+        likelihood = arrays.threat_initiation[rescored] * tables['threat_occurrence'][edge_type_index] + \
+            tables['predisposing_conditions'][edge_type_index]
+        risk[rescored] = to_qualitative(to_qualitative(likelihood) * arrays.impact[rescored])
+
+        # Only the principals owning an affected path are reduced again
+        affected_principals = np.unique(arrays.principal_index[rescored | removed])
+        principal_risk = arrays.principal_risk.copy()
+        principal_risk[affected_principals] = 0
+        rows = np.isin(arrays.principal_index, affected_principals) & ~removed
+        np.maximum.at(principal_risk, arrays.principal_index[rows], risk[rows])
+
+        changed = np.flatnonzero(principal_risk != arrays.principal_risk)
+        result = ScenarioResult(
+            scenario=scenario.name,
+            baseline_domain_risk=baseline_domain_risk,
+            domain_risk=int(principal_risk.max(initial=0)),
+            changed_principals={self.principals[i]: (int(arrays.principal_risk[i]), int(principal_risk[i]))
+                                for i in changed},
+            rescored_paths=int(rescored.sum()),
+            removed_paths=int(removed.sum()))
+        logger.debug(f"Scenario {result}, rescored {result.rescored_paths} of {len(self)} paths")
+        return result
+
+    def _freeze(self) -> _BaselineArrays:
+        if self._arrays is not None:
+            return self._arrays
+        principal_index = np.array(self._principal_index, dtype=np.int64)
+        edge_type_index = np.array(self._edge_type_index, dtype=np.int64)
+        threat_initiation = np.array(self._threat_initiation, dtype=np.int64)
+        impact = np.array(self._impact, dtype=np.int64)
+
+        likelihood = threat_initiation * self._tables['threat_occurrence'][edge_type_index] + \
+            self._tables['predisposing_conditions'][edge_type_index]
+        risk = to_qualitative(to_qualitative(likelihood) * impact)
+        principal_risk = np.zeros(len(self.principals), dtype=np.int64)
+        np.maximum.at(principal_risk, principal_index, risk)
+
+        edge_rows: Dict[str, List[int]] = {}
+        for row, edge_ids in enumerate(self._edge_ids):
+            for edge_id in edge_ids:
+                edge_rows.setdefault(edge_id, []).append(row)
+
+        self._arrays = _BaselineArrays(
+            principal_index=principal_index,
+            edge_type_index=edge_type_index,
+            threat_initiation=threat_initiation,
+            impact=impact,
+            risk=risk,
+            principal_risk=principal_risk,
+            edge_rows={edge_id: np.array(rows, dtype=np.int64) for edge_id, rows in edge_rows.items()})
+        return self._arrays
+
+
+def _relationship_ids(path: Path) -> Tuple[str, ...]:
+    # A composite path depends on its own synthetic id and on every (nested) component edge
+    if not isinstance(path, CompositePath):
+        return (path.relationship.id,)
+    return (path.relationship.id,) + tuple(edge_id for component in path.components
+                                           for edge_id in _relationship_ids(component))
+
+
+def _normalize_events(event_monitoring_config: dict) -> Dict[str, bool]:
+    # Event ids are strings in the config, but callers may pass numbers
+    return {str(event): monitored for event, monitored in event_monitoring_config.items()}
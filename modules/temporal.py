@@ -0,0 +1,69 @@
+# Temporal predicates for the 'older_than' and 'newer_than' operators.
+#
+# Durations are parsed once when the rules are loaded and evaluated against a
+# single reference clock per run, so every node of a run is judged against the
+# same "now". BloodHound stores lastlogon, pwdlastset and whencreated as epoch
+# seconds, with values <= 0 meaning the event never happened. evaluate_many checks
+# a whole array of epochs at once, e.g. the lastlogon of every user of a batch.
+
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+from modules.converters import convert_to_timestamp
+from modules.logging_base import Logging
+
+logger = Logging().getLogger()
+
+TEMPORAL_OPERATORS = ['older_than', 'newer_than']
+
+
+class ReferenceClock:
+    def __init__(self, now: Optional[float] = None) -> None:
+        self.now: int = int(time.time() if now is None else now)
+
+    def __str__(self):
+        return f"ReferenceClock(now={self.now})"
+
+
+@dataclass(frozen=True)
+class TemporalPredicate:
+    operator: str
+    duration: int  # seconds
+
+    def cutoff(self, clock: ReferenceClock) -> int:
+        return clock.now - self.duration
+
+    def evaluate(self, epoch: Any, clock: ReferenceClock) -> bool:
+        if isinstance(epoch, bool) or not isinstance(epoch, (int, float)):
+            return False
+        cutoff = self.cutoff(clock)
+        if self.operator == 'older_than':
+            # An account that never logged on is older than any cutoff
+            return epoch <= 0 or epoch < cutoff
+        return epoch > 0 and epoch >= cutoff
+
+    def evaluate_many(self, epochs: np.ndarray, clock: ReferenceClock) -> np.ndarray:
+        # Element-wise evaluate, values that are not epochs are expected as NaN and never match
+        epochs = np.asarray(epochs, dtype=np.float64)
+        cutoff = self.cutoff(clock)
+        if self.operator == 'older_than':
+            return (epochs <= 0) | (epochs < cutoff)
+        return (epochs > 0) & (epochs >= cutoff)
+
+
+def compile_temporal_predicate(operator: str, value: str) -> TemporalPredicate:
+    if operator not in TEMPORAL_OPERATORS:
+        raise ValueError(f"Invalid temporal operator: {operator}")
+    duration = convert_to_timestamp(str(value))
+    if duration == 0 and not str(value).strip().startswith('0'):
+        raise ValueError(f"Cannot parse duration '{value}'")
+    return TemporalPredicate(operator=operator, duration=duration)
+
+
+def epoch_array(values: Iterable[Any]) -> np.ndarray:
+    # Input of evaluate_many, NaN for everything evaluate would not compare, like None, bools or strings
+    return np.array([value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+                     for value in values], dtype=np.float64)
@@ -1,9 +1,10 @@
-from typing import List, Dict, Any
+from typing import Any, Dict, Iterable, Iterator, List
 
 from modules.logging_base import Logging
 from models.neo4j import User, Edge, Node
 from models.bloodhound import EdgeType
-from modules.converters import normalize_operator_values, convert_to_timestamp
+from modules.converters import normalize_operator_values
+from modules.temporal import ReferenceClock, compile_temporal_predicate
 
 logger = Logging().getLogger()
 
@@ -43,12 +44,9 @@ def compare(operator: str, value1: Any, value2: Any) -> bool:
                 return not _in_any(value1, value2)
             case 'any':
                 return _in_any(value1, value2)
-            case 'older_than':
-                timestamp = convert_to_timestamp(value2)
-                return value1 > timestamp
-            case 'newer_than':
-                timestamp = convert_to_timestamp(value2)
-                return value1 < timestamp
+            case 'older_than' | 'newer_than':
+                # Uncompiled fallback, the RuleEngine uses predicates precompiled at rule load
+                return compile_temporal_predicate(operator, value2).evaluate(value1, ReferenceClock())
             case 'set':
                 if isinstance(value1, list):
                     return value1 != []
@@ -90,3 +88,47 @@ def _in_all(value1: Any, value2: Any) -> bool:
         return value2 in value1
     else:
         raise ValueError(f"Invalid types for 'all' operator: {type(value1)}, {type(value2)}")
+
+
+def strongly_connected_components(nodes: Iterable[str], successors: Dict[str, List[str]]) -> Iterator[List[str]]:
+    # Iterative Tarjan, deep group nestings would exceed the recursion limit.
+    # Components are yielded in reverse topological order, successors before the nodes reaching them.
+    index_of: Dict[str, int] = {}
+    lowlink: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack = set()
+    counter = 0
+    for root in nodes:
+        if root in index_of:
+            continue
+        work = [(root, iter(successors.get(root, [])))]
+        index_of[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in index_of:
+                    index_of[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors.get(child, []))))
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index_of[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index_of[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                yield component
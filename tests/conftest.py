@@ -0,0 +1,34 @@
+import random
+
+import pytest
+
+from modules.rule_cache import load_rules
+from tests.fakes import FakeDomain, node
+
+EDGE_TYPES = ['GenericWrite', 'AddKeyCredentialLink', 'DCSync', 'GetChanges', 'GetChangesAll', 'MemberOf',
+              'Enroll', 'Unknown']
+
+
+@pytest.fixture(scope="session")
+def loaded_rules():
+    return load_rules("rules/attributes", "rules/permissions")
+
+
+@pytest.fixture
+def rules(loaded_rules):
+    # A fresh evaluation cache per test
+    attribute_rule_engine, permission_rules = loaded_rules
+    return attribute_rule_engine.fork(), permission_rules
+
+
+@pytest.fixture(scope="session")
+def domain():
+    rng = random.Random(1)
+    targets = [node("User", f"T{i}@CORP.LOCAL", admincount=bool(i % 2), enabled=True) for i in range(20)] + \
+        [node("Computer", f"C{i}.CORP.LOCAL") for i in range(5)] + [node("Domain", "CORP.LOCAL")]
+    fake_domain = FakeDomain()
+    for i in range(200):
+        edges = [(rng.choice(EDGE_TYPES), rng.choice(targets)) for _ in range(rng.randrange(0, 6))]
+        fake_domain.add_user(f"U{i}@CORP.LOCAL", edges, admincount=(i % 7 == 0), pwdneverexpires=(i % 3 == 0),
+                             serviceprincipalnames=["HTTP/web"] if i % 5 == 0 else [])
+    return fake_domain
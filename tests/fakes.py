@@ -0,0 +1,137 @@
+# In-memory stand-ins for the parts of the neo4j driver the modules use, so the
+# assessments can be tested without a Neo4j server.
+
+import itertools
+from typing import Any, Callable, Dict, List
+
+import neo4j
+from neo4j.graph import Graph, Node, Path
+
+_graph = Graph()
+_ids = itertools.count(1)
+
+
+def node(label: str, name: str, **properties) -> Node:
+    element_id = next(_ids)
+    properties.setdefault('name', name)
+    properties.setdefault('samaccountname', name.split('@')[0])
+    return Node(_graph, f"4:test:{element_id}", element_id, ["Base", label], properties)
+
+
+def relationship(start: Node, relationship_type: str, end: Node):
+    element_id = next(_ids)
+    rel = _graph.relationship_type(relationship_type)(_graph, f"5:test:{element_id}", element_id, {})
+    rel._start_node = start
+    rel._end_node = end
+    return rel
+
+
+def path(start: Node, relationship_type: str, end: Node) -> Path:
+    return Path(start, relationship(start, relationship_type, end))
+
+
+def record(**values) -> neo4j.Record:
+    return neo4j.Record(values)
+
+
+class FakeResult(list):
+    def single(self):
+        return self[0] if self else None
+
+    def consume(self):
+        return None
+
+
+class FakeSession:
+    # handler(query, parameters) returns the records of a query
+    def __init__(self, handler: Callable[[str, Dict[str, Any]], List[neo4j.Record]]) -> None:
+        self.handler = handler
+        self.queries: List[str] = []
+
+    def run(self, query: str, parameters: Dict[str, Any] = None, **kwargs) -> FakeResult:
+        self.queries.append(query)
+        return FakeResult(self.handler(query, {**(parameters or {}), **kwargs}))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+
+class FakeDriver:
+    def __init__(self, handler: Callable[[str, Dict[str, Any]], List[neo4j.Record]]) -> None:
+        self.handler = handler
+        self.sessions: List[FakeSession] = []
+        self.closed = False
+
+    def session(self, database: str = None, fetch_size: int = None) -> FakeSession:
+        session = FakeSession(self.handler)
+        self.sessions.append(session)
+        return session
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeDomain:
+    # Users (and other nodes) with their direct edges, answering the user summary, direct path,
+    # node lookup and reverse adjacency queries of neo4j_utils. Group names are not resolved,
+    # memberof is always empty.
+    def __init__(self) -> None:
+        self.users: Dict[str, Node] = {}
+        self.nodes: Dict[str, Node] = {}  # element id -> every node with or at the end of an edge
+        self.edges: Dict[str, List[tuple]] = {}  # start element id -> [(edge id, edge type, end node)]
+
+    def add_user(self, name: str, edges: List[tuple] = (), **properties) -> Node:
+        user = self.add_node("User", name, edges, enabled=True, **properties)
+        self.users[name] = user
+        return user
+
+    def add_node(self, label: str, name: str, edges: List[tuple] = (), **properties) -> Node:
+        start = node(label, name, **properties)
+        self.nodes[start.element_id] = start
+        self.edges[start.element_id] = [(f"{name}-{i}", edge_type, end) for i, (edge_type, end) in enumerate(edges)]
+        for _, end in edges:
+            self.nodes.setdefault(end.element_id, end)
+        return start
+
+    def paths(self, name: str) -> List[Path]:
+        user = self.users[name]
+        return [path(user, edge_type, end) for _, edge_type, end in self.edges[user.element_id]]
+
+    def _summary(self, user: Node) -> neo4j.Record:
+        edge_types = sorted({edge_type for _, edge_type, _ in self.edges[user.element_id]})
+        return record(n=user, memberof=[], group_ids=[], edges=edge_types)
+
+    def handler(self, query: str, parameters: Dict[str, Any]) -> List[neo4j.Record]:
+        if "AS source" in query:
+            return [record(source=start_id, type=edge_type, target=end.element_id)
+                    for start_id, edges in self.edges.items() for _, edge_type, end in edges
+                    if edge_type in parameters["edge_types"]]
+        if "{name: $name}" in query:
+            return [record(n=found, memberof=[]) for found in self.nodes.values()
+                    if found["name"] == parameters["name"]][:1]
+        if "IN $element_ids RETURN n," in query:
+            return [record(n=self.nodes[element_id], memberof=[]) for element_id in parameters["element_ids"]
+                    if element_id in self.nodes]
+        if "UNWIND $usernames" in query:
+            return [self._summary(self.users[name]) for name in parameters["usernames"] if name in self.users]
+        if "RETURN n.name AS name" in query:
+            return [record(name=name) for name in self.users]
+        if "LIMIT 1" in query:
+            user = self.users.get(parameters.get("username"))
+            return [self._summary(user)] if user is not None else []
+        if "WITH DISTINCT m RETURN m" in query:
+            end_nodes = {end.element_id: end for edges in self.edges.values() for _, edge_type, end in edges
+                         if edge_type in parameters["edge_types"]}
+            return [record(m=end) for end in end_nodes.values()]
+        if "start_id" in query:
+            return [record(start_id=start_id, id=edge_id, type=edge_type, end_id=end.element_id,
+                           end_labels=list(end.labels), end_properties=dict(end))
+                    for start_id in parameters["element_ids"] for edge_id, edge_type, end in self.edges[start_id]]
+        if "end_id" in query:
+            return [record(id=edge_id, type=edge_type, end_id=end.element_id, end_labels=list(end.labels),
+                           end_properties=dict(end))
+                    for edge_id, edge_type, end in self.edges[parameters["element_id"]]]
+        raise NotImplementedError(query)
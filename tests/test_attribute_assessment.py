@@ -0,0 +1,80 @@
+from typing import Dict
+
+from models.neo4j import node_from_record
+from modules.adass import ADASS
+from modules.attribute_assessment import assess_user_attributes
+from modules.rule_engine import RuleEngine
+from tests.fakes import node
+
+
+def _reference_score(user, rule_engine):
+    # Every rule evaluated, the last matching rule of a metric wins
+    metrics: Dict[str, str] = {}
+    matching_rule_names = []
+    for rule in rule_engine.rules:
+        if rule_engine.evaluate_rule(rule, user)['matches']:
+            metrics[rule['Metric']] = rule['Value']
+            matching_rule_names.append(rule['Name'])
+    parts = [f"{metric}:{value}" for metric, value in metrics.items()]
+    for metric, default_value in [("C", "L"), ("I", "L"), ("A", "N")]:
+        if 'Tier Zero Object' in matching_rule_names:
+            parts.append(f"{metric}:H")
+        elif 'Service Account' in matching_rule_names:
+            parts.append(f"{metric}:L")
+        else:
+            parts.append(f"{metric}:{default_value}")
+    return ADASS("/".join(parts)).calculate_score()
+
+
+def test_scores_match_a_full_evaluation(domain, rules):
+    engine, _ = rules
+    for user in domain.users.values():
+        model = node_from_record(user, [])
+        assert assess_user_attributes(model, engine) == _reference_score(model, engine)
+
+
+def _rule(name, metric, value, property_name):
+    return {"Name": name, "Metric": metric, "Value": value,
+            "Criteria": {"Flag": [{"Property": property_name, "Operator": "==", "Value": "True"}]}}
+
+
+def test_only_the_rules_up_to_the_last_match_of_a_metric_are_evaluated():
+    engine = RuleEngine()
+    engine.load_rules([_rule("Low", "AC", "L", "admincount"), _rule("High", "AC", "H", "hasspn"),
+                       _rule("Tier Zero Object", "S", "C", "admincount"),
+                       _rule("Service Account", "S", "U", "hasspn")])
+    user = node_from_record(node("User", "SVC@CORP.LOCAL", enabled=True, admincount=True, hasspn=True), [])
+
+    assert assess_user_attributes(user, engine) == _reference_score(user, engine)
+    evaluated = {engine.rules[i]['Name'] for i, rule in enumerate(engine.rules)
+                 if id(rule) in engine.partial_results.get(user.id, {})}
+    # "Low" precedes the matching "High" rule of AC and is never evaluated
+    assert evaluated == {"High", "Service Account", "Tier Zero Object"}
+    assert not engine.evaluated_rules.get(user.id)
+
+
+def test_equivalent_nodes_share_the_score_without_evaluating_rules():
+    engine = RuleEngine()
+    engine.load_rules([_rule("Tier Zero Object", "S", "C", "admincount")])
+    first = node_from_record(node("User", "A@CORP.LOCAL", admincount=True), [])
+    second = node_from_record(node("User", "B@CORP.LOCAL", admincount=True), [])
+    assert assess_user_attributes(first, engine) == assess_user_attributes(second, engine)
+    assert second.id not in engine.partial_results
+
+
+def test_on_demand_caches_keep_only_the_most_recently_used_nodes():
+    engine = RuleEngine(node_cache_size=3)
+    engine.load_rules([_rule("Tier Zero Object", "S", "C", "admincount")])
+    users = [node_from_record(node("User", f"U{i}@CORP.LOCAL", admincount=i % 2 == 0), []) for i in range(10)]
+    for user in users:
+        engine.rule_matches(users[0], "Tier Zero Object")
+        engine.rule_matches(user, "Tier Zero Object")
+        engine.get_shared_result(user, "score", lambda: 0)
+    assert len(engine.partial_results) == 3
+    assert len(engine._criteria_results) == 3
+    assert len(engine._node_fingerprints) == 3
+    # The first user was used throughout and is kept, next to the two last ones
+    assert list(engine.partial_results) == [users[8].id, users[0].id, users[9].id]
+    # An evicted node is evaluated again, with the same result
+    assert engine.rule_matches(users[2], "Tier Zero Object")
+    assert not engine.rule_matches(users[3], "Tier Zero Object")
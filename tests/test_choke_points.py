@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from modules.choke_points import analyze_choke_points, compute_choke_point_flows
+from modules.impact_index import ImpactIndex
+from modules.permission_assessment import ImpactClass, _assess_edge_likelihood, _impact_from_class, _qualitative_risk
+from modules.reverse_reachability import ReverseAdjacencyIndex
+from tests.fakes import FakeSession, node, record
+
+#   A -GenericWrite-> B -GenericWrite-> T (Tier Zero)
+#   A -GenericWrite-> C -GenericWrite-> T
+#   D -GetChanges-> T, D -GenericWrite-> P (privileged account)
+EDGES = [("A", "GenericWrite", "B"), ("A", "GenericWrite", "C"), ("B", "GenericWrite", "T"),
+         ("C", "GenericWrite", "T"), ("D", "GetChanges", "T"), ("D", "GenericWrite", "P")]
+
+
+def _graph(ids):
+    index = ReverseAdjacencyIndex()
+    for source, edge_type, target in EDGES:
+        index.add_edge(ids[source], edge_type, ids[target])
+    impact_index = ImpactIndex([ids[node_id] for node_id in "BCTP"], np.array([
+        ImpactClass.NONE, ImpactClass.NONE, ImpactClass.TIER_ZERO, ImpactClass.PRIVILEGED_OR_SERVICE_ACCOUNT]))
+    return index, impact_index
+
+
+@pytest.fixture
+def graph():
+    return _graph({node_id: node_id for node_id in "ABCDPT"})
+
+
+def _risk(edge_type, impact_class, traversable, permission_rules):
+    return _qualitative_risk(_assess_edge_likelihood(edge_type, permission_rules, 0.0, {}),
+                             _impact_from_class(impact_class, traversable))
+
+
+def test_flows_split_over_equal_shortest_paths(graph, rules):
+    _, permission_rules = rules
+    index, impact_index = graph
+    flows = compute_choke_point_flows(index, impact_index, permission_rules, {}, {})
+
+    tier_zero_risk = _risk("GenericWrite", ImpactClass.TIER_ZERO, True, permission_rules)
+    privileged_risk = _risk("GenericWrite", ImpactClass.PRIVILEGED_OR_SERVICE_ACCOUNT, True, permission_rules)
+    # D reaches Tier Zero only over a non traversable edge, its highest risk is the privileged account
+    assert privileged_risk > _risk("GetChanges", ImpactClass.TIER_ZERO, False, permission_rules)
+    assert flows.principal_risk == {"A": tier_zero_risk, "B": tier_zero_risk, "C": tier_zero_risk,
+                                    "D": privileged_risk}
+
+    # A has two shortest paths to T, half of it passes through B and half through C
+    assert flows.node_principals == {"B": 0.5, "C": 0.5}
+    assert flows.node_weighted_risk == {"B": 0.5 * tier_zero_risk, "C": 0.5 * tier_zero_risk}
+    assert flows.edge_principals == {
+        ("A", "GenericWrite", "B"): 0.5, ("A", "GenericWrite", "C"): 0.5,
+        ("B", "GenericWrite", "T"): 1.5, ("C", "GenericWrite", "T"): 1.5,
+        ("D", "GenericWrite", "P"): 1.0}
+    assert flows.edge_weighted_risk == {
+        ("A", "GenericWrite", "B"): 0.5 * tier_zero_risk, ("A", "GenericWrite", "C"): 0.5 * tier_zero_risk,
+        ("B", "GenericWrite", "T"): 1.5 * tier_zero_risk, ("C", "GenericWrite", "T"): 1.5 * tier_zero_risk,
+        ("D", "GenericWrite", "P"): float(privileged_risk)}
+
+
+def test_report_names_the_top_choke_points(rules):
+    engine, permission_rules = rules
+    nodes = {node_id: node("User", f"{node_id}@CORP.LOCAL") for node_id in "ABCDPT"}
+    index, impact_index = _graph({node_id: test_node.element_id for node_id, test_node in nodes.items()})
+    by_id = {test_node.element_id: test_node for test_node in nodes.values()}
+    session = FakeSession(lambda query, parameters: [record(n=by_id[element_id], memberof=[])
+                                                     for element_id in parameters["element_ids"]])
+    report = analyze_choke_points(session, permission_rules, engine, {}, limit=2, index=index,
+                                  impact_index=impact_index,
+                                  adass_scores={nodes[node_id].element_id: 0.0 for node_id in "ABCD"})
+    assert report.principal_count == 4
+    # B and C tie, in any order
+    assert sorted((edge.source_name, edge.target_name, edge.principals) for edge in report.edges) == \
+        [("B@CORP.LOCAL", "T@CORP.LOCAL", 1.5), ("C@CORP.LOCAL", "T@CORP.LOCAL", 1.5)]
+    assert sorted((choke_point.name, choke_point.principals) for choke_point in report.nodes) == \
+        [("B@CORP.LOCAL", 0.5), ("C@CORP.LOCAL", 0.5)]
@@ -0,0 +1,60 @@
+import itertools
+
+import pytest
+
+from models.neo4j import CompositePath, iter_user_paths, node_from_record
+from modules.composite_rules import get_composite_rules, join_composite_paths
+from modules.permission_assessment import assess_permissions
+from tests.fakes import node, path
+
+USER = node("User", "ALICE@CORP.LOCAL", enabled=True)
+DOMAIN = node("Domain", "CORP.LOCAL")
+OTHER_DOMAIN = node("Domain", "CHILD.CORP.LOCAL")
+
+
+def _paths(edges):
+    return list(iter_user_paths([path(USER, edge_type, end) for edge_type, end in edges],
+                                node_from_record(USER, [])))
+
+
+def _joined_types(paths, permission_rules):
+    return sorted((joined.relationship.type, joined.end_node.name)
+                  for joined in join_composite_paths(paths, permission_rules))
+
+
+def test_composite_rules_are_read_from_the_rules(rules):
+    _, permission_rules = rules
+    assert get_composite_rules(permission_rules)["DCSync"] == {"GetChanges", "GetChangesAll"}
+
+
+@pytest.mark.parametrize("edges", [
+    [("GetChanges", DOMAIN), ("GetChangesAll", DOMAIN)],
+    [("GetChanges", DOMAIN), ("GetChangesAll", DOMAIN), ("DCSync", DOMAIN)],
+    [("GetChanges", DOMAIN), ("GetChangesAll", DOMAIN), ("GetChanges", DOMAIN), ("DCSync", DOMAIN)],
+], ids=["components", "components and edge", "repeated component"])
+def test_join_does_not_depend_on_stream_order(rules, edges):
+    engine, permission_rules = rules
+    expected = None
+    for order in itertools.permutations(edges):
+        paths = _paths(order)
+        joined = list(join_composite_paths(paths, permission_rules))
+        assert [p.relationship.type for p in joined].count("DCSync") == 1, order
+        types = _joined_types(paths, permission_rules)
+        score = assess_permissions(paths, permission_rules, engine.fork(), 5.0, {})
+        if expected is None:
+            expected = (types, score)
+        assert (types, score) == expected, order
+
+
+def test_edge_wins_when_it_arrives_first(rules):
+    _, permission_rules = rules
+    joined = list(join_composite_paths(
+        _paths([("DCSync", DOMAIN), ("GetChanges", DOMAIN), ("GetChangesAll", DOMAIN)]), permission_rules))
+    assert not any(isinstance(p, CompositePath) for p in joined)
+
+
+def test_components_on_different_targets_are_not_joined(rules):
+    _, permission_rules = rules
+    paths = _paths([("GetChanges", DOMAIN), ("GenericWrite", OTHER_DOMAIN), ("GetChangesAll", OTHER_DOMAIN)])
+    assert _joined_types(paths, permission_rules) == [
+        ("GenericWrite", "CHILD.CORP.LOCAL"), ("GetChanges", "CORP.LOCAL"), ("GetChangesAll", "CHILD.CORP.LOCAL")]
@@ -0,0 +1,148 @@
+import os
+import uuid
+
+import neo4j
+import pytest
+
+from modules.cypher_compiler import compile_rule, get_matching_node_ids
+from modules.rule_engine import RuleEngine
+from modules.temporal import ReferenceClock
+from models.neo4j import node_from_record
+from tests.fakes import FakeSession, node, record
+
+NOW = 1_700_000_000
+DAY = 24 * 3600
+
+
+def _rule(*criterias, prerequisites=()):
+    rule = {"Name": "Test Rule", "Metric": "AC", "Value": "L", "Criteria": {"Criteria": list(criterias)}}
+    if prerequisites:
+        rule["Prerequisite Criteria"] = {"Prerequisites": list(prerequisites)}
+    return rule
+
+
+def _engine(rule):
+    engine = RuleEngine(ReferenceClock(NOW))
+    engine.load_rules([rule])
+    return engine
+
+
+def _python_matches(engine, rule, nodes):
+    return [n.element_id for n in nodes if engine.evaluate_rule(rule, node_from_record(n, []))['matches']]
+
+
+USERS = [
+    node("User", "ALICE@CORP.LOCAL", enabled=True, admincount=True, serviceprincipalnames=["HTTP/web"],
+         lastlogon=NOW - 400 * DAY, pwdlastset=NOW - 10 * DAY, description="Tier 0 admin"),
+    node("User", "BOB@CORP.LOCAL", enabled=False, admincount=False, serviceprincipalnames=[],
+         lastlogon=0, pwdlastset=NOW - 800 * DAY, pwdneverexpires=True),
+    node("User", "SVC_SQL@CORP.LOCAL", enabled=True, serviceprincipalnames=["MSSQL/db"],
+         lastlogon=NOW - DAY, dontreqpreauth=True, description="SQL service"),
+    node("Computer", "DC01.CORP.LOCAL", enabled=True, unconstraineddelegation=True),
+]
+
+
+def test_exact_rule_runs_a_single_query():
+    rule = _rule({"Property": "type", "Operator": "==", "Value": "User"},
+                 prerequisites=[{"Property": "enabled", "Operator": "==", "Value": "True"}])
+    compiled = compile_rule(rule, ReferenceClock(NOW))
+    assert compiled.exact
+    assert "n:User" in compiled.where
+
+    session = FakeSession(lambda query, parameters: [record(id="4:test:1")])
+    assert get_matching_node_ids(session, _engine(rule), "Test Rule") == ["4:test:1"]
+    assert len(session.queries) == 1
+
+
+def test_rejected_query_falls_back_to_python():
+    rule = _rule({"Property": "serviceprincipalnames", "Operator": "set", "Value": ""},
+                 prerequisites=[{"Property": "ACCOUNTDISABLE", "Operator": "==", "Value": "False"}])
+    engine = _engine(rule)
+
+    def handler(query, parameters):
+        if "valueType" in query:
+            raise neo4j.exceptions.ClientError("Unknown function 'valueType'")
+        return [record(n=user, memberof=[]) for user in USERS]
+
+    assert get_matching_node_ids(FakeSession(handler), engine, "Test Rule") == \
+        _python_matches(engine, rule, USERS)
+
+
+def test_partial_pushdown_reevaluates_candidates():
+    # uac_flags is not a node property, so the group becomes a pre-filter
+    rule = _rule({"Property": "uac_flags", "Operator": "any", "Value": ["DONT_REQUIRE_PREAUTH"]},
+                 prerequisites=[{"Property": "type", "Operator": "==", "Value": "User"}])
+    compiled = compile_rule(rule, ReferenceClock(NOW))
+    assert not compiled.exact
+
+    engine = _engine(rule)
+    candidates = [user for user in USERS if "User" in user.labels]
+    session = FakeSession(lambda query, parameters: [record(n=user, memberof=[]) for user in candidates])
+    matching = get_matching_node_ids(session, engine, "Test Rule")
+    assert matching == _python_matches(engine, rule, candidates)
+    assert matching == [USERS[2].element_id]
+
+
+def test_unknown_rule_raises():
+    with pytest.raises(KeyError):
+        get_matching_node_ids(FakeSession(lambda query, parameters: []), _engine(_rule()), "Missing")
+
+
+# Agreement of the compiled Cypher with the RuleEngine needs a Neo4j 5.13+ server, e.g.
+# CADRA_TEST_NEO4J_URI=bolt://localhost:7687 CADRA_TEST_NEO4J_PASSWORD=... pytest tests
+LIVE_URI = os.environ.get("CADRA_TEST_NEO4J_URI")
+
+OPERATOR_CRITERIAS = [
+    {"Property": "enabled", "Operator": "==", "Value": "True"},
+    {"Property": "admincount", "Operator": "!=", "Value": "True"},
+    {"Property": "pwdlastset", "Operator": "<", "Value": NOW - 100 * DAY},
+    {"Property": "pwdlastset", "Operator": ">", "Value": NOW - 100 * DAY},
+    {"Property": "lastlogon", "Operator": "<=", "Value": 0},
+    {"Property": "lastlogon", "Operator": ">=", "Value": NOW - DAY},
+    {"Property": "name", "Operator": "in", "Value": ["ALICE@CORP.LOCAL", "BOB@CORP.LOCAL"]},
+    {"Property": "name", "Operator": "not in", "Value": ["ALICE@CORP.LOCAL"]},
+    {"Property": "serviceprincipalnames", "Operator": "any", "Value": ["MSSQL/db", "LDAP/dc"]},
+    {"Property": "serviceprincipalnames", "Operator": "set", "Value": ""},
+    {"Property": "description", "Operator": "notset", "Value": "x"},
+    {"Property": "name", "Operator": "startswith", "Value": "SVC_"},
+    {"Property": "name", "Operator": "endswith", "Value": ".LOCAL"},
+    {"Property": "lastlogon", "Operator": "older_than", "Value": "1 year"},
+    {"Property": "lastlogon", "Operator": "newer_than", "Value": "7 days"},
+    {"Property": "ACCOUNTDISABLE", "Operator": "==", "Value": "False"},
+    {"Property": "DONT_EXPIRE_PASSWD", "Operator": "==", "Value": "True"},
+    {"Property": "DONT_REQUIRE_PREAUTH", "Operator": "==", "Value": "True"},
+    {"Property": "TRUSTED_FOR_DELEGATION", "Operator": "==", "Value": "True"},
+    {"Property": "type", "Operator": "==", "Value": "Computer"},
+]
+
+
+@pytest.fixture(scope="module")
+def live_session():
+    driver = neo4j.GraphDatabase.driver(
+        LIVE_URI, auth=(os.environ.get("CADRA_TEST_NEO4J_USER", "neo4j"), os.environ.get("CADRA_TEST_NEO4J_PASSWORD")))
+    tag = f"cadra_test_{uuid.uuid4().hex}"
+    with driver.session() as session:
+        for test_node in USERS:
+            session.run(f"CREATE (n:Base:{next(iter(test_node.labels - {'Base'}))}) SET n = $properties, "
+                        "n.cadra_test = $tag", properties=dict(test_node), tag=tag).consume()
+        yield session, tag
+        session.run("MATCH (n {cadra_test: $tag}) DETACH DELETE n", tag=tag).consume()
+    driver.close()
+
+
+@pytest.mark.skipif(LIVE_URI is None, reason="CADRA_TEST_NEO4J_URI is not set")
+@pytest.mark.parametrize("criteria", OPERATOR_CRITERIAS, ids=lambda c: f"{c['Property']} {c['Operator']}")
+def test_compiled_cypher_agrees_with_rule_engine(live_session, criteria):
+    session, tag = live_session
+    rule = _rule(criteria)
+    engine = _engine(rule)
+    assert compile_rule(rule, engine.clock).exact
+
+    matching = set(get_matching_node_ids(session, engine, "Test Rule"))
+    expected = set()
+    for result in session.run("MATCH (n {cadra_test: $tag}) RETURN n", tag=tag):
+        if engine.evaluate_rule(rule, node_from_record(result["n"], []))['matches']:
+            expected.add(result["n"].element_id)
+    tagged = {result["id"] for result in session.run(
+        "MATCH (n {cadra_test: $tag}) RETURN elementId(n) AS id", tag=tag)}
+    assert matching & tagged == expected
@@ -0,0 +1,42 @@
+import pytest
+
+from modules.assessment import assess_user
+from modules.detail_sink import ColumnarDetailSink
+from tests.fakes import FakeDomain, FakeSession, node
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.ipc  # noqa: E402
+import pyarrow.parquet  # noqa: E402
+
+
+def _read(path):
+    return pyarrow.parquet.read_table(path) if path.endswith(".parquet") else pyarrow.ipc.open_file(path).read_all()
+
+
+@pytest.mark.parametrize("file_name", ["details.parquet", "details.arrow"])
+def test_rows_are_tagged_with_their_source(tmp_path, rules, file_name):
+    engine, permission_rules = rules
+    domain = FakeDomain()
+    targets = [node("Group", f"G{i % 5}@CORP.LOCAL") for i in range(40)]
+    domain.add_user("ALICE@CORP.LOCAL", [(["GenericWrite", "AddKeyCredentialLink"][i % 2], target)
+                                         for i, target in enumerate(targets)])
+    path = str(tmp_path / file_name)
+    with ColumnarDetailSink(path, batch_size=16) as sink:
+        for source in ["corp", "lab"]:
+            assess_user(FakeSession(domain.handler), "ALICE@CORP.LOCAL", engine.fork(), permission_rules, {},
+                        sink.for_source(source))
+
+    table = _read(path)
+    assert table.num_rows == 80
+    assert table.schema.field("source").type == pa.dictionary(pa.int32(), pa.string())
+    assert table.column("source").to_pylist() == ["corp"] * 40 + ["lab"] * 40
+    assert set(table.column("target").to_pylist()) == {target["name"] for target in targets}
+
+
+def test_empty_sink_writes_the_schema(tmp_path):
+    path = str(tmp_path / "empty.arrow")
+    with ColumnarDetailSink(path):
+        pass
+    table = _read(path)
+    assert table.num_rows == 0
+    assert "source" in table.schema.names
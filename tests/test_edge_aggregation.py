@@ -0,0 +1,52 @@
+from models.neo4j import node_from_record
+from modules.edge_aggregation import UNKNOWN_TARGET_TYPE, expand_aggregate, fetch_edge_aggregates
+from modules.permission_assessment import ImpactClass
+from tests.fakes import FakeSession, node, record
+
+USER = node("User", "HELPDESK@CORP.LOCAL", enabled=True)
+TARGETS = [node("Computer", f"WS{i:02}.CORP.LOCAL") for i in range(10)] + \
+    [node("AZTenant", f"TENANT{i}") for i in range(4)]  # no known node type
+
+
+def _target_type(target, node_types):
+    return next((label for label in target.labels if label in node_types and label != "Base"), UNKNOWN_TARGET_TYPE)
+
+
+def _handler(query, parameters):
+    # Every target is of impact class NONE, grouped like the Cypher of edge_aggregation
+    node_types = parameters["node_types"]
+    if "count(*)" in query:
+        groups = {}
+        for target in TARGETS:
+            groups.setdefault(_target_type(target, node_types), []).append(target.get("name"))
+        return [record(edge_type="GenericWrite", target_type=target_type, impact_class=int(ImpactClass.NONE),
+                       count=len(names), samples=names[:parameters["sample_size"]], undecided=[])
+                for target_type, names in groups.items()]
+    return [record(id=f"5:test:{target.element_id}", end_id=target.element_id, end_labels=list(target.labels),
+                   end_properties=dict(target), impact_class=int(ImpactClass.NONE), memberof=[])
+            for target in TARGETS if _target_type(target, node_types) == parameters["target_type"]]
+
+
+def test_samples_are_limited_in_cypher(rules):
+    engine, _ = rules
+    session = FakeSession(_handler)
+    aggregates = fetch_edge_aggregates(session, USER, engine, ["GenericWrite"], sample_size=2)
+    assert "LIMIT $sample_size" in session.queries[0]
+    assert "collect(n.name)" not in session.queries[0]
+    assert all(len(aggregate.samples) == 2 for aggregate in aggregates)
+
+
+def test_every_aggregate_expands_to_its_count(rules):
+    engine, _ = rules
+    session = FakeSession(_handler)
+    aggregates = fetch_edge_aggregates(session, USER, engine, ["GenericWrite"])
+    assert {aggregate.target_type: aggregate.count for aggregate in aggregates} == \
+        {"Computer": 10, UNKNOWN_TARGET_TYPE: 4}
+
+    principal = node_from_record(USER, [])
+    for aggregate in aggregates:
+        paths = list(expand_aggregate(session, principal, USER, aggregate, engine))
+        assert len(paths) == aggregate.count
+    # Both queries classify targets with the same expression
+    target_type = "head([label IN labels(n) WHERE label IN $node_types] + ['Unknown'])"
+    assert all(target_type in query for query in session.queries)
@@ -0,0 +1,35 @@
+import json
+
+from modules.event_ingestion import ingest_event_logs
+
+NOW = 1_700_000_000
+DAY = 24 * 3600
+
+
+def _write_log(path, events):
+    path.write_text("".join(json.dumps({"EventID": event_id, "Computer": host, "TimeCreated": timestamp}) + "\n"
+                            for event_id, host, timestamp in events))
+    return str(path)
+
+
+def test_window_decides_the_covering_hosts(tmp_path):
+    log = _write_log(tmp_path / "dc.jsonl", [
+        (4662, "DC01", NOW - 30 * DAY),
+        (4662, "DC01", NOW),
+        (4662, "DC02", NOW - 30 * DAY),
+        (5136, "DC02", NOW - DAY),
+    ])
+    coverage = ingest_event_logs([log], ["4662", "5136"], window_seconds=7 * DAY, max_workers=1)
+    assert coverage.hosts == ["dc01", "dc02"]
+    assert list(coverage.events["4662"].hosts) == ["dc01"]
+    assert coverage.missing_hosts("4662") == ["dc02"]
+    assert coverage.monitoring_config(0.5) == {"4662": True, "5136": True}
+    assert coverage.monitoring_config() == {"4662": False, "5136": False}
+
+
+def test_count_is_labelled_as_all_time(tmp_path):
+    log = _write_log(tmp_path / "dc.jsonl", [(4662, "DC01", NOW - 30 * DAY), (4662, "DC01", NOW)])
+    coverage = ingest_event_logs([log], ["4662"], window_seconds=7 * DAY, max_workers=1).events["4662"]
+    # The event before the window is counted as well, and the report says so
+    assert coverage.count == 2
+    assert str(coverage).endswith("2 event(s) logged in total")
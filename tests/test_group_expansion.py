@@ -0,0 +1,100 @@
+import random
+
+from modules.adcs_index import AdcsEscalation, map_principals
+from modules.assessment import assess_user
+from modules.group_expansion import GroupPermissionIndex
+from modules.neo4j_utils import DetachedNode, DetachedRelationship
+from tests.fakes import FakeSession, node, record
+
+
+def _ancestors(parents, start):
+    seen, stack = {start}, [start]
+    while stack:
+        for parent in parents.get(stack.pop(), []):
+            if parent not in seen:
+                seen.add(parent)
+                stack.append(parent)
+    return seen
+
+
+def _random_membership(seed, count=150, max_parents=2):
+    rng = random.Random(seed)
+    groups = [f"G{i}" for i in range(count)]
+    parents = {group: rng.sample(groups, rng.randrange(0, max_parents + 1)) for group in groups}
+    return rng, groups, parents
+
+
+def test_effective_edges_are_the_edges_of_all_nested_groups():
+    rng, groups, parents = _random_membership(7)
+    index = GroupPermissionIndex()
+    for group in groups:
+        index.add_group(DetachedNode(group, ["Group"], {"name": group}))
+    for group, group_parents in parents.items():
+        for parent in group_parents:
+            index.add_membership(group, parent)
+    target = DetachedNode("T", ["User"], {"name": "T"})
+    for i, group in enumerate(rng.sample(groups, 40)):
+        index.add_edge(DetachedRelationship(f"r{i}", "GenericWrite", index.groups[group], target))
+
+    for group in groups:
+        expected = {relationship.element_id for ancestor in _ancestors(parents, group)
+                    for relationship in index.direct_edges.get(ancestor, [])}
+        effective = [relationship.element_id for relationship in index.effective_edges(group)]
+        assert sorted(effective) == sorted(expected)
+
+
+def test_inherited_paths_through_a_membership_cycle(rules):
+    engine, permission_rules = rules
+    user = node("User", "ALICE@CORP.LOCAL", enabled=True)
+    groups = {name: node("Group", name) for name in "ABCDE"}
+    targets = {name: node("User", name, admincount=True) for name in ["T1", "T2", "T3"]}
+    memberships = [("A", "B"), ("B", "C"), ("C", "B"), ("C", "D")]
+    group_edges = [("B", "GenericWrite", "T1"), ("D", "AddKeyCredentialLink", "T2"), ("E", "GenericWrite", "T3"),
+                   ("C", "GenericWrite", "T1")]
+
+    def handler(query, parameters):
+        if "LIMIT 1" in query:
+            return [record(n=user, memberof=["A"], group_ids=[groups["A"].element_id], edges=["MemberOf"])]
+        if "end_id" in query and "element_id" in parameters:
+            return [record(id="member-a", type="MemberOf", end_id=groups["A"].element_id, end_labels=["Group"],
+                           end_properties=dict(groups["A"]))]
+        if "properties(g)" in query:
+            return [record(id=group.element_id, labels=list(group.labels), properties=dict(group))
+                    for group in groups.values()]
+        if "parent_id" in query:
+            return [record(group_id=groups[a].element_id, parent_id=groups[b].element_id) for a, b in memberships]
+        if "edge_types" in parameters:
+            return [record(group_id=groups[a].element_id, id=f"{a}-{t}-{b}", type=t, end_id=targets[b].element_id,
+                           end_labels=list(targets[b].labels), end_properties=dict(targets[b]))
+                    for a, t, b in group_edges]
+        raise NotImplementedError(query)
+
+    session = FakeSession(handler)
+    index = GroupPermissionIndex.from_session(session, list(permission_rules))
+    assert {relationship.element_id for relationship in index.effective_edges(groups["B"].element_id)} == \
+        {"B-GenericWrite-T1", "C-GenericWrite-T1", "D-AddKeyCredentialLink-T2"}
+
+    assessed = []
+    assess_user(session, "ALICE@CORP.LOCAL", engine, permission_rules, {}, assessed.append, group_index=index)
+    inherited = sorted((assessment.path.relationship.type, assessment.path.end_node.name)
+                       for assessment in assessed if assessment.path.relationship.type != "MemberOf")
+    assert inherited == [("AddKeyCredentialLink", "T2"), ("GenericWrite", "T1"), ("GenericWrite", "T1")]
+    assert all(assessment.path.start_node.name == "ALICE@CORP.LOCAL" for assessment in assessed)
+
+
+def test_adcs_rights_are_inherited_through_nested_groups():
+    _, groups, parents = _random_membership(11, 80, max_parents=3)
+    members = {f"U{i}": [groups[i], groups[(i * 7) % 80]] for i in range(30)}
+    all_parents = {**parents, **members}
+    rights = {"G3": ({"template"}, set()), "G50": (set(), {"ca"}), "G61": ({"template"}, set()),
+              "U4": ({"template"}, {"ca"})}
+    escalation = AdcsEscalation("ADCSESC1", "domain", ("template",), ("ca",))
+
+    principal_escalations = map_principals([escalation], rights, all_parents)
+    assert len(principal_escalations) > 10
+    for principal in list(groups) + list(members):
+        ancestors = _ancestors(all_parents, principal)
+        templates = set().union(*(rights.get(ancestor, (set(), set()))[0] for ancestor in ancestors))
+        cas = set().union(*(rights.get(ancestor, (set(), set()))[1] for ancestor in ancestors))
+        expected = (escalation,) if templates and cas else ()
+        assert principal_escalations.get(principal, ()) == expected
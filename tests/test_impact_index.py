@@ -0,0 +1,34 @@
+import numpy as np
+
+from modules.assessment import assess_user
+from modules.impact_index import UNKNOWN_IMPACT_CLASS, ImpactIndex, build_impact_index
+from modules.permission_assessment import ImpactClass
+from tests.fakes import FakeSession
+
+
+def test_lookup_on_an_empty_index():
+    index = ImpactIndex([], np.array([], dtype=np.int8))
+    assert index.lookup(["4:test:1", "4:test:2"]).tolist() == [UNKNOWN_IMPACT_CLASS] * 2
+    assert index.lookup([]).tolist() == []
+    assert index.get("4:test:1") is None
+
+
+def test_lookup_reports_unknown_nodes():
+    index = ImpactIndex(["a", "b"], np.array([ImpactClass.TIER_ZERO, ImpactClass.NONE], dtype=np.int8))
+    assert index.lookup(["b", "x", "a"]).tolist() == [ImpactClass.NONE, UNKNOWN_IMPACT_CLASS, ImpactClass.TIER_ZERO]
+    assert index.node_ids_with_class(ImpactClass.TIER_ZERO) == ["a"]
+
+
+def test_index_classifies_like_the_per_path_assessment(domain, rules):
+    engine, permission_rules = rules
+    session = FakeSession(domain.handler)
+    index = build_impact_index(session, engine, list(permission_rules))
+    assert len(index) == len({end.element_id for edges in domain.edges.values() for _, edge_type, end in edges
+                              if edge_type in permission_rules})
+
+    for name in list(domain.users)[:50]:
+        with_index, without_index = [], []
+        assert assess_user(session, name, engine, permission_rules, {}, with_index.append, index) == \
+            assess_user(session, name, engine.fork(), permission_rules, {}, without_index.append)
+        assert [path.impact for path in with_index] == [path.impact for path in without_index]
+
@@ -0,0 +1,23 @@
+import pytest
+
+from modules.multi_source import parse_graph_sources
+
+
+def test_single_source_config():
+    sources = parse_graph_sources({"uri": "bolt://localhost:7687", "user": "neo4j", "password": "secret"})
+    assert [source.name for source in sources] == ["source-0"]
+
+
+def test_source_names_default_to_the_database():
+    sources = parse_graph_sources([{"uri": "bolt://a", "database": "corp"}, {"uri": "bolt://b", "name": "lab"}])
+    assert [source.name for source in sources] == ["corp", "lab"]
+
+
+def test_empty_source_list_is_rejected():
+    with pytest.raises(ValueError, match="at least one graph source"):
+        parse_graph_sources([])
+
+
+def test_duplicate_source_names_are_rejected():
+    with pytest.raises(ValueError, match="unique"):
+        parse_graph_sources([{"uri": "bolt://a", "name": "corp"}, {"uri": "bolt://b", "name": "corp"}])
@@ -0,0 +1,11 @@
+from modules.neo4j_utils import get_node_by_name
+from tests.fakes import FakeSession, node, record
+
+
+def test_get_node_by_name_matches_on_the_base_label():
+    target = node("Computer", "DC01.CORP.LOCAL")
+    session = FakeSession(lambda query, parameters: [record(n=target, memberof=[])]
+                          if parameters["name"] == target["name"] else [])
+    assert get_node_by_name(session, "DC01.CORP.LOCAL")["n"] is target
+    assert get_node_by_name(session, "MISSING") is None
+    assert all("(n:Base {name: $name})" in query for query in session.queries)
@@ -0,0 +1,33 @@
+import itertools
+
+from models.neo4j import iter_user_paths, node_from_record
+from modules.permission_assessment import _qualitative_risk, assess_permissions
+from tests.fakes import node, path
+
+USER = node("User", "ALICE@CORP.LOCAL", enabled=True)
+# A likely right on a plain computer and a less likely one on a Tier Zero object
+EDGES = [("AddKeyCredentialLink", node("Computer", "WS01.CORP.LOCAL")),
+         ("GenericWrite", node("User", "ADMIN@CORP.LOCAL", iscriticalsystemobject=True))]
+
+
+def _dominance_pick(assessments):
+    # The selection before the batch scorers: a path only replaced the pick if it had a strictly
+    # higher likelihood and no lower impact
+    pick = None
+    for assessment in assessments:
+        if pick is None or assessment.likelihood > pick.likelihood and assessment.impact >= pick.impact:
+            pick = assessment
+    return _qualitative_risk(pick.likelihood, pick.impact)
+
+
+def test_highest_risk_path_wins_in_any_order(rules):
+    engine, permission_rules = rules
+    for order in itertools.permutations(EDGES):
+        paths = list(iter_user_paths([path(USER, edge_type, end) for edge_type, end in order],
+                                     node_from_record(USER, [])))
+        assessments = []
+        score = assess_permissions(paths, permission_rules, engine.fork(), 0.0, {}, assessments.append)
+        assert score == max(assessment.risk for assessment in assessments)
+        if order == tuple(EDGES):
+            # The likelier path came first and hid the Tier Zero path
+            assert _dominance_pick(assessments) < score
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from modules.assessment import assess_user
+from modules.pipeline import AssessmentPipeline
+from modules.risk_ranking import TopRiskReport
+from tests.fakes import FakeSession
+
+
+def _pipeline_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-")]
+
+
+def test_results_match_single_assessments_in_order(domain, rules):
+    engine, permission_rules = rules
+    session = FakeSession(domain.handler)
+    names = list(domain.users) + ["MISSING@CORP.LOCAL"]
+    expected = [assess_user(session, name, engine.fork(), permission_rules, {}) for name in names]
+
+    pipeline = AssessmentPipeline(session, engine, permission_rules, {}, report=TopRiskReport(5, 2),
+                                  batch_size=16, queue_size=2)
+    assert list(pipeline.run(names)) == [assessment for assessment in expected if assessment is not None]
+    assert [stage.name for stage in pipeline.stats.stages] == ["fetch", "model", "score"]
+    assert pipeline.stats.stages[-1].items == len(domain.users)
+
+
+def test_closing_early_stops_every_stage(domain, rules):
+    engine, permission_rules = rules
+    session = FakeSession(domain.handler)
+    pipeline = AssessmentPipeline(session, engine, permission_rules, {}, batch_size=4, queue_size=1)
+    results = pipeline.run(list(domain.users))
+    assert [next(results).name for _ in range(3)] == list(domain.users)[:3]
+    results.close()
+
+    assert not _pipeline_threads()
+    # The fetcher was held back by the bounded queues instead of reading every batch
+    summary_queries = [query for query in session.queries if "UNWIND $usernames" in query]
+    assert len(summary_queries) < len(domain.users) // 4
+
+
+@pytest.mark.parametrize("failing_query", ["start_id", "UNWIND $usernames"])
+def test_fetch_errors_are_raised_to_the_consumer(domain, rules, failing_query):
+    engine, permission_rules = rules
+
+    def handler(query, parameters):
+        if failing_query in query:
+            raise RuntimeError("connection lost")
+        return domain.handler(query, parameters)
+
+    pipeline = AssessmentPipeline(FakeSession(handler), engine, permission_rules, {}, batch_size=8)
+    with pytest.raises(RuntimeError, match="connection lost"):
+        list(pipeline.run(list(domain.users)))
+    assert not _pipeline_threads()
+
+
+def test_score_errors_are_raised_to_the_consumer(domain, rules):
+    engine, permission_rules = rules
+
+    def path_sink(assessment):
+        raise ValueError("sink full")
+
+    pipeline = AssessmentPipeline(FakeSession(domain.handler), engine, permission_rules, {}, path_sink,
+                                  batch_size=8, queue_size=1)
+    with pytest.raises(ValueError, match="sink full"):
+        list(pipeline.run(list(domain.users)))
+    assert not _pipeline_threads()
+
+
+def test_invalid_sizes_are_rejected(domain, rules):
+    engine, permission_rules = rules
+    with pytest.raises(ValueError):
+        AssessmentPipeline(FakeSession(domain.handler), engine, permission_rules, {}, batch_size=0)
@@ -0,0 +1,65 @@
+import pstats
+import threading
+
+import pytest
+
+from modules.profiling import StageProfiler, is_profiling, profile_iter, profile_stage, profiling
+
+
+def _outer_work():
+    return sum(i * i for i in range(20000))
+
+
+def _inner_work():
+    return sorted(str(i) for i in range(20000))
+
+
+def _functions(path):
+    return {name for _, _, name in pstats.Stats(str(path)).stats}
+
+
+def test_nested_stages_write_their_own_profiles(tmp_path):
+    with profiling(str(tmp_path)):
+        assert is_profiling()
+        with profile_stage("outer"):
+            _outer_work()
+            with profile_stage("inner", snapshot=True):
+                _inner_work()
+            items = list(profile_iter("inner", iter([1, 2, 3])))
+    assert items == [1, 2, 3]
+    assert not is_profiling()
+
+    for name in ["outer.pstats", "outer.collapsed", "inner.pstats", "inner.collapsed", "all.collapsed"]:
+        assert (tmp_path / name).stat().st_size > 0, name
+    # Entering the inner stage paused the outer one
+    assert "_outer_work" in _functions(tmp_path / "outer.pstats")
+    assert "_inner_work" not in _functions(tmp_path / "outer.pstats")
+    assert "_inner_work" in _functions(tmp_path / "inner.pstats")
+    collapsed = (tmp_path / "all.collapsed").read_text().splitlines()
+    assert any(line.startswith("inner;") and "_inner_work" in line for line in collapsed)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed)
+
+
+def test_stages_of_other_threads_are_ignored(tmp_path):
+    with profiling(str(tmp_path)):
+        with profile_stage("main"):
+            pass
+        thread = threading.Thread(target=lambda: profile_stage("worker").__enter__())
+        thread.start()
+        thread.join()
+    assert (tmp_path / "main.pstats").exists()
+    assert not (tmp_path / "worker.pstats").exists()
+
+
+def test_only_one_profiler_can_be_active(tmp_path):
+    active = StageProfiler(str(tmp_path / "active"))
+    active.start()
+    try:
+        with pytest.raises(RuntimeError):
+            StageProfiler(str(tmp_path / "other")).start()
+    finally:
+        active.stop()
+    # Once stopped another profiler can start
+    other = StageProfiler(str(tmp_path / "other"))
+    other.start()
+    other.stop()
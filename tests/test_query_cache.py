@@ -0,0 +1,98 @@
+import pytest
+
+from modules import query_cache as query_cache_module
+from modules.context import AssessmentContext
+from modules.query_cache import CachingSession, QueryCache
+from tests.fakes import FakeDriver, FakeSession, record
+
+QUERY = "MATCH (n:User {name: $name}) RETURN n.name AS name"
+VERSION_QUERY = "RETURN $version AS version"
+
+
+class _Graph:
+    # Answers QUERY with the current answer and VERSION_QUERY with the current version
+    def __init__(self):
+        self.answer = "OLD"
+        self.version = 1
+
+    def handler(self, query, parameters):
+        if query == VERSION_QUERY:
+            return [record(version=self.version)]
+        return [record(name=f"{parameters['name']}-{self.answer}")]
+
+
+def _name(cache, session, name="ALICE", namespace=""):
+    return cache.run(session, namespace, QUERY, {"name": name}).single()["name"]
+
+
+def test_least_recently_used_results_are_evicted():
+    graph = _Graph()
+    session = FakeSession(graph.handler)
+    cache = QueryCache(max_records=2, version_query=None)
+    _name(cache, session, "A")
+    _name(cache, session, "B")
+    _name(cache, session, "A")
+    _name(cache, session, "C")  # evicts B
+    assert len(cache) == 2 and cache.stats.evictions == 1
+    _name(cache, session, "A")
+    _name(cache, session, "B")
+    assert (cache.stats.hits, cache.stats.misses) == (2, 4)
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(query_cache_module.time, "time", lambda: now[0])
+    graph = _Graph()
+    session = FakeSession(graph.handler)
+    cache = QueryCache(ttl_seconds=10, version_query=None)
+    _name(cache, session)
+    graph.answer = "NEW"
+    now[0] += 5
+    assert _name(cache, session) == "ALICE-OLD"
+    now[0] += 10
+    assert _name(cache, session) == "ALICE-NEW"
+
+
+def test_a_new_graph_version_drops_the_results(tmp_path):
+    graph = _Graph()
+    session = FakeSession(graph.handler)
+    cache = QueryCache(disk_dir=str(tmp_path), version_query=VERSION_QUERY, version_interval_seconds=0)
+    assert _name(cache, session) == "ALICE-OLD"
+    graph.answer, graph.version = "NEW", 2
+    assert _name(cache, session) == "ALICE-NEW"
+    assert cache.stats.invalidations == 1
+
+
+@pytest.mark.parametrize("disk_dir", [False, True], ids=["memory", "disk"])
+def test_clear_drops_one_namespace(tmp_path, disk_dir):
+    graph = _Graph()
+    session = FakeSession(graph.handler)
+    cache = QueryCache(disk_dir=str(tmp_path) if disk_dir else None, version_query=None)
+    _name(cache, session, namespace="a")
+    _name(cache, session, namespace="b")
+    graph.answer = "NEW"
+    cache.clear("a")
+    assert _name(cache, session, namespace="a") == "ALICE-NEW"
+    assert _name(cache, session, namespace="b") == "ALICE-OLD"
+    if disk_dir:
+        # Another process sharing the directory sees the cleared namespace as well
+        shared = QueryCache(disk_dir=str(tmp_path), version_query=None)
+        assert _name(shared, session, namespace="a") == "ALICE-NEW"
+        assert _name(shared, session, namespace="b") == "ALICE-OLD"
+        assert shared.stats.disk_hits == 2
+
+
+def test_invalidate_drops_the_results_on_disk(tmp_path, rules):
+    engine, permission_rules = rules
+    graph = _Graph()
+    cache = QueryCache(disk_dir=str(tmp_path), version_query=None)
+    context = AssessmentContext(FakeDriver(graph.handler), engine, permission_rules, query_cache=cache,
+                                cache_namespace="source")
+    with context.session() as session:
+        assert isinstance(session, CachingSession)
+        assert session.run(QUERY, name="ALICE").single()["name"] == "ALICE-OLD"
+    graph.answer = "NEW"
+    context.invalidate()
+    with context.session() as session:
+        assert session.run(QUERY, name="ALICE").single()["name"] == "ALICE-NEW"
+    assert cache.stats.disk_hits == 0
@@ -0,0 +1,100 @@
+from typing import Dict, List
+
+import pytest
+
+from modules.assessment import assess_target, assess_user
+from modules.reverse_reachability import ReverseAdjacencyIndex, _is_expandable
+from tests.fakes import FakeDomain, FakeSession, node
+
+#   A -GenericWrite, GetChanges-> T (Tier Zero), B -DCSync-> T, G (group) -GenericWrite-> T
+#   M -AddKeyCredentialLink-> A, N -GenericWrite-> M, C -MemberOf-> G
+#   W -GetChanges-> T, Z -GenericWrite-> W
+#   X -GetChanges-> A, Y -GenericWrite-> X: the right of X on A is not traversable, X and Y cannot reach T
+
+
+@pytest.fixture
+def target_domain():
+    domain = FakeDomain()
+    target = node("User", "T@CORP.LOCAL", enabled=True, iscriticalsystemobject=True)
+    group = domain.add_node("Group", "G@CORP.LOCAL", [("GenericWrite", target)])
+    a = domain.add_user("A@CORP.LOCAL", [("GenericWrite", target), ("GetChanges", target)])
+    domain.add_user("B@CORP.LOCAL", [("DCSync", target)], admincount=True)
+    m = domain.add_user("M@CORP.LOCAL", [("AddKeyCredentialLink", a)])
+    domain.add_user("N@CORP.LOCAL", [("GenericWrite", m)], pwdneverexpires=True)
+    domain.add_user("C@CORP.LOCAL", [("MemberOf", group)])
+    w = domain.add_user("W@CORP.LOCAL", [("GetChanges", target)])
+    domain.add_user("Z@CORP.LOCAL", [("GenericWrite", w)])
+    x = domain.add_user("X@CORP.LOCAL", [("GetChanges", a)])
+    domain.add_user("Y@CORP.LOCAL", [("GenericWrite", x)])
+    return domain, target
+
+
+def _forward_depths(domain: FakeDomain, target_id: str, permission_rules: Dict[str, Dict]) -> Dict[str, int]:
+    # Fewest edges from every node to the target, following its own rights forward: any right on the
+    # target reaches it, a right on another principal only if it grants control over that principal
+    depths: Dict[str, int] = {}
+    changed = True
+    while changed:
+        changed = False
+        for start_id, edges in domain.edges.items():
+            for _, edge_type, end in edges:
+                if edge_type not in permission_rules:
+                    continue
+                if end.element_id == target_id:
+                    depth = 1
+                elif end.element_id in depths and _is_expandable(edge_type, permission_rules):
+                    depth = depths[end.element_id] + 1
+                else:
+                    continue
+                if start_id != target_id and depth < depths.get(start_id, depth + 1):
+                    depths[start_id] = depth
+                    changed = True
+    return depths
+
+
+def test_inbound_principals_match_a_forward_rerun_per_user(target_domain, rules):
+    engine, permission_rules = rules
+    domain, target = target_domain
+    session = FakeSession(domain.handler)
+
+    inbound = assess_target(session, target["name"], engine, permission_rules, {})
+    reached = {principal.principal.id: principal for principal in inbound}
+
+    depths = _forward_depths(domain, target.element_id, permission_rules)
+    assert {principal_id: principal.reaching_edge.depth for principal_id, principal in reached.items()} == depths
+    names = {domain.nodes[principal_id]["name"] for principal_id in reached}
+    assert names == {"A@CORP.LOCAL", "B@CORP.LOCAL", "G@CORP.LOCAL", "M@CORP.LOCAL", "N@CORP.LOCAL",
+                     "C@CORP.LOCAL", "W@CORP.LOCAL", "Z@CORP.LOCAL"}
+
+    # Every user scored by the reverse traversal is scored the same by its own forward assessment
+    for name, user in domain.users.items():
+        assessments: List = []
+        assess_user(session, name, engine, permission_rules, {}, path_sink=assessments.append)
+        principal = reached.get(user.element_id)
+        if principal is None:
+            continue
+        reaching_edge = principal.reaching_edge
+        first_hop = [assessment for assessment in assessments
+                     if assessment.path.end_node.id == reaching_edge.next_hop_id
+                     and assessment.path.relationship.type == reaching_edge.edge_type]
+        assert first_hop, name
+        assert principal.likelihood == first_hop[0].likelihood
+        if reaching_edge.depth == 1:
+            assert (principal.impact, principal.risk) == (first_hop[0].impact, first_hop[0].risk)
+
+
+def test_a_non_traversable_right_does_not_pass_on_the_rights_of_its_end(target_domain, rules):
+    _, permission_rules = rules
+    domain, target = target_domain
+    index = ReverseAdjacencyIndex.from_session(FakeSession(domain.handler), list(permission_rules))
+    ids = {found["name"]: element_id for element_id, found in domain.nodes.items()}
+
+    reached = index.traverse(target.element_id, permission_rules)
+    assert ids["X@CORP.LOCAL"] not in reached and ids["Y@CORP.LOCAL"] not in reached
+    # Rated non traversable itself, but it is the last edge: W reaches T and Z controls W
+    assert reached[ids["W@CORP.LOCAL"]].edge_type == "GetChanges"
+    assert reached[ids["Z@CORP.LOCAL"]].target_edge_type == "GetChanges"
+    # MemberOf is not traversable, yet members inherit the rights of their group
+    assert reached[ids["C@CORP.LOCAL"]].next_hop_id == ids["G@CORP.LOCAL"]
+    # X still holds its right on A directly
+    assert ids["X@CORP.LOCAL"] in index.traverse(ids["A@CORP.LOCAL"], permission_rules)
@@ -0,0 +1,63 @@
+import numpy as np
+
+from models.neo4j import iter_user_paths, node_from_record
+from modules.attribute_assessment import assess_user_attributes
+from modules.impact_index import build_impact_index_from_nodes
+from modules.permission_assessment import assess_permissions
+from modules.risk_matrix import assess_domain, encode_paths, score_paths
+from tests.fakes import FakeSession
+
+
+def _reference_scores(domain, engine, permission_rules):
+    scores = {}
+    for name, user in domain.users.items():
+        model = node_from_record(user, [])
+        adass_score = assess_user_attributes(model, engine)
+        paths = list(iter_user_paths(domain.paths(name), model))
+        scores[name] = assess_permissions(paths, permission_rules, engine, adass_score, {}) if paths else 0
+    return scores
+
+
+def test_score_paths_matches_assess_permissions(domain, rules):
+    engine, permission_rules = rules
+    paths = [path for name, user in domain.users.items()
+             for path in iter_user_paths(domain.paths(name), node_from_record(user, []))]
+    encoded = encode_paths(paths, permission_rules, engine)
+    adass_scores = np.array([assess_user_attributes(node_from_record(domain.users[path.start_node.name], []), engine)
+                             for path in _first_paths(paths, encoded.principal_ids)])
+    matrix = score_paths(encoded, adass_scores, permission_rules, {})
+
+    reference = _reference_scores(domain, engine, permission_rules)
+    names = {user.element_id: name for name, user in domain.users.items()}
+    for principal_id, risk in zip(encoded.principal_ids, matrix.principal_risk):
+        assert risk == reference[names[principal_id]]
+
+
+def _first_paths(paths, principal_ids):
+    first = {}
+    for path in paths:
+        first.setdefault(path.start_node.id, path)
+    return [first[principal_id] for principal_id in principal_ids]
+
+
+def test_assess_domain_matches_assess_permissions(domain, rules):
+    engine, permission_rules = rules
+    result = assess_domain(FakeSession(domain.handler), engine, permission_rules, {}, batch_size=16)
+    assert result.principal_names == list(domain.users)
+    assert result.cadra_scores == _reference_scores(domain, engine, permission_rules)
+
+
+def test_assess_domain_uses_the_impact_index(domain, rules):
+    engine, permission_rules = rules
+    end_nodes = {end.element_id: end for edges in domain.edges.values() for _, _, end in edges}
+    impact_index = build_impact_index_from_nodes((node_from_record(end, []) for end in end_nodes.values()), engine)
+    with_index = assess_domain(FakeSession(domain.handler), engine, permission_rules, {}, impact_index=impact_index)
+    without_index = assess_domain(FakeSession(domain.handler), engine, permission_rules, {})
+    assert with_index.cadra_scores == without_index.cadra_scores
+
+
+def test_assess_domain_skips_unknown_and_duplicate_names(domain, rules):
+    engine, permission_rules = rules
+    names = ["U1@CORP.LOCAL", "MISSING@CORP.LOCAL", "U1@CORP.LOCAL", "U2@CORP.LOCAL"]
+    result = assess_domain(FakeSession(domain.handler), engine, permission_rules, {}, names, batch_size=2)
+    assert result.principal_names == ["U1@CORP.LOCAL", "U2@CORP.LOCAL"]
@@ -0,0 +1,67 @@
+import pytest
+
+from modules.permission_assessment import PathAssessment
+from modules.risk_ranking import TopRiskReport
+
+
+def _assessment(risk, likelihood, impact=1):
+    return PathAssessment(path=None, threat_initiation=0, threat_occurrence=0, predisposing_conditions=0,
+                          likelihood=likelihood, impact=impact, risk=risk)
+
+
+def _assess(report, principal, *assessments):
+    ranking = report.start(principal)
+    for assessment in assessments:
+        ranking(assessment)
+    report.finish(ranking)
+    return ranking
+
+
+def _ranked(report):
+    return [(ranked.principal, ranked.risk, ranked.score) for ranked in report.report()]
+
+
+def test_more_room_than_principals_keeps_all_with_a_path():
+    report = TopRiskReport(principal_limit=10, path_limit=5)
+    _assess(report, "LOW", _assessment(1, 2))
+    _assess(report, "NONE")
+    _assess(report, "HIGH", _assessment(3, 4), _assessment(1, 9))
+    assert _ranked(report) == [("HIGH", 3, 4), ("LOW", 1, 2)]
+    assert report.principals_seen == 3
+    # Fewer paths than the path limit, highest risk first even with a lower score
+    assert [assessment.risk for assessment in report.report()[0].paths] == [3, 1]
+
+
+def test_risk_ranks_before_score():
+    report = TopRiskReport(principal_limit=2)
+    _assess(report, "LIKELY", _assessment(2, 10))
+    _assess(report, "RISKY", _assessment(3, 1))
+    _assess(report, "MEDIUM", _assessment(2, 5))
+    assert _ranked(report) == [("RISKY", 3, 1), ("LIKELY", 2, 10)]
+
+
+def test_the_lowest_ranked_principal_is_evicted_first():
+    report = TopRiskReport(principal_limit=3)
+    for principal, risk, score in [("A", 2, 3), ("B", 1, 5), ("C", 2, 1), ("D", 3, 1), ("E", 1, 9), ("F", 2, 2)]:
+        _assess(report, principal, _assessment(risk, score))
+    # B (1, 5) is dropped for D, then C (2, 1) for F, E (1, 9) never enters
+    assert _ranked(report) == [("D", 3, 1), ("A", 2, 3), ("F", 2, 2)]
+    assert report.principals_seen == 6
+
+
+def test_full_ties_keep_the_principals_and_paths_assessed_first():
+    report = TopRiskReport(principal_limit=2, path_limit=2)
+    first = _assessment(2, 3)
+    _assess(report, "FIRST", first, _assessment(2, 3), _assessment(2, 3))
+    _assess(report, "SECOND", _assessment(2, 3))
+    _assess(report, "THIRD", _assessment(2, 3))
+    assert [ranked.principal for ranked in report.report()] == ["FIRST", "SECOND"]
+    assert report.report()[0].paths[0] is first
+    assert len(report.report()[0].paths) == 2
+
+
+def test_limits_must_be_positive():
+    with pytest.raises(ValueError):
+        TopRiskReport(principal_limit=0)
+    with pytest.raises(ValueError):
+        TopRiskReport(path_limit=0)
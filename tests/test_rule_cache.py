@@ -0,0 +1,55 @@
+import json
+import shutil
+
+import neo4j
+import pytest
+
+from modules.context import AssessmentContext
+from modules.rule_cache import load_rules
+from tests.fakes import FakeDriver, record
+
+
+@pytest.fixture
+def rule_packs(tmp_path):
+    packs = {}
+    for pack in ("baseline", "strict"):
+        packs[pack] = str(tmp_path / pack)
+        shutil.copytree("rules/attributes", packs[pack])
+    return packs
+
+
+def _pack_of_rules(engine):
+    return {rule['Pack'] for rule in engine.rules}
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["parsed", "bundled"])
+def test_rule_packs_replace_the_attribute_rules(tmp_path, rule_packs, cached):
+    cache_dir = str(tmp_path / "cache") if cached else None
+    plain, _ = load_rules("rules/attributes", "rules/permissions")
+    engine, permission_rules = load_rules("rules/attributes", "rules/permissions", cache_dir, rule_packs=rule_packs)
+    assert engine.rule_packs == ["baseline", "strict"]
+    assert len(engine.rules) == 2 * len(plain.rules)
+    assert "DCSync" in permission_rules
+
+
+def test_bundle_is_rebuilt_when_the_packs_change(tmp_path, rule_packs):
+    cache_dir = str(tmp_path / "cache")
+    engine, _ = load_rules("rules/attributes", "rules/permissions", cache_dir)
+    assert engine.rule_packs == []
+    engine, _ = load_rules("rules/attributes", "rules/permissions", cache_dir, rule_packs=rule_packs)
+    assert engine.rule_packs == ["baseline", "strict"]
+    engine, _ = load_rules("rules/attributes", "rules/permissions", cache_dir,
+                           rule_packs={"renamed": rule_packs["baseline"]})
+    assert _pack_of_rules(engine) == {"renamed"}
+
+
+def test_context_from_config_loads_the_rule_packs(tmp_path, rule_packs, monkeypatch):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({
+        "Neo4jConfig": {"uri": "bolt://localhost:7687", "user": "neo4j", "password": "secret"},
+        "RulesConfig": {"permissions_rules_dir_path": "rules/permissions", "cache_dir": str(tmp_path / "cache"),
+                        "rule_packs": rule_packs}}))
+    monkeypatch.setattr(neo4j.GraphDatabase, "driver",
+                        lambda uri, auth: FakeDriver(lambda query, parameters: [record(number=1)]))
+    with AssessmentContext.from_config(str(config_path)) as context:
+        assert context.attribute_rule_engine.rule_packs == ["baseline", "strict"]
@@ -0,0 +1,87 @@
+import pytest
+
+from models.neo4j import node_from_record
+from modules.rule_engine import RuleEngine
+from tests.fakes import node
+
+
+@pytest.fixture
+def engine(loaded_rules):
+    # Forks share the equivalence classes, this engine starts without any
+    attribute_rule_engine, _ = loaded_rules
+    engine = RuleEngine(attribute_rule_engine.clock)
+    engine.load_rules(attribute_rule_engine.rules, attribute_rule_engine.temporal_predicates)
+    return engine
+
+
+def _user(name, memberof=(), **properties):
+    return node_from_record(node("User", name, enabled=True, **properties), list(memberof))
+
+
+def _count_evaluations(engine):
+    evaluated = []
+    evaluate_rule = engine.evaluate_rule
+
+    def counting(rule, evaluated_node, criteria_results=None):
+        evaluated.append(evaluated_node.id)
+        return evaluate_rule(rule, evaluated_node, criteria_results)
+    engine.evaluate_rule = counting
+    return evaluated
+
+
+def test_nodes_with_equal_rule_properties_share_one_evaluation(engine):
+    evaluated = _count_evaluations(engine)
+    # Only unreferenced properties differ, samaccountname matches neither 'svc-' nor '-svc'
+    first = _user("ALICE@CORP.LOCAL", iscriticalsystemobject=True, description="first", objectid="S-1-5-1")
+    second = _user("BOB@CORP.LOCAL", iscriticalsystemobject=True, description="second", objectid="S-1-5-2")
+    assert engine.fingerprint(first) == engine.fingerprint(second)
+
+    matching = engine.get_matching_rules(first)
+    assert engine.get_matching_rules(second) == matching
+    assert [rule['rule_name'] for rule in matching] == ["Tier Zero Object"]
+    assert set(evaluated) == {first.id}
+    assert engine.evaluated_rules[second.id] is engine.evaluated_rules[first.id]
+    assert engine.equivalence_classes[engine.fingerprint(first)].members == 2
+
+
+def test_a_different_rule_property_gets_its_own_evaluation(engine):
+    evaluated = _count_evaluations(engine)
+    tier_zero = _user("ALICE@CORP.LOCAL", iscriticalsystemobject=True)
+    regular = _user("BOB@CORP.LOCAL", iscriticalsystemobject=False)
+    service = _user("svc-web@corp.local", iscriticalsystemobject=True)
+    fingerprints = {engine.fingerprint(user) for user in (tier_zero, regular, service)}
+    assert len(fingerprints) == 3
+
+    assert [rule['rule_name'] for rule in engine.get_matching_rules(tier_zero)] == ["Tier Zero Object"]
+    assert engine.get_matching_rules(regular) == []
+    assert "Service Account" in [rule['rule_name'] for rule in engine.get_matching_rules(service)]
+    assert set(evaluated) == {tier_zero.id, regular.id, service.id}
+
+
+def test_memberof_is_compared_as_a_set_of_groups(engine):
+    evaluated = _count_evaluations(engine)
+    admin = _user("ALICE@CORP.LOCAL", ["Domain Admins", "Users"])
+    same_groups = _user("BOB@CORP.LOCAL", ["Users", "Domain Admins"])
+    fewer_groups = _user("CAROL@CORP.LOCAL", ["Users"])
+    assert engine.fingerprint(admin) == engine.fingerprint(same_groups)
+    assert engine.fingerprint(admin) != engine.fingerprint(fewer_groups)
+
+    assert [rule['rule_name'] for rule in engine.get_matching_rules(admin)] == ["Tier Zero Object"]
+    assert engine.get_matching_rules(same_groups) == engine.get_matching_rules(admin)
+    assert engine.get_matching_rules(fewer_groups) == []
+    assert set(evaluated) == {admin.id, fewer_groups.id}
+
+
+def test_shared_results_hold_no_values_of_the_evaluated_node(engine):
+    first = _user("svc-web@corp.local", iscriticalsystemobject=True)
+    second = _user("svc-sql@corp.local", iscriticalsystemobject=True)
+    assert engine.fingerprint(first) == engine.fingerprint(second)
+    engine.get_matching_rules(first)
+    engine.get_matching_rules(second)
+
+    # A shared result describes the rule outcome only, the compared values ('actual') of the first
+    # node are never handed to the other members of its class
+    for result in engine.equivalence_classes[engine.fingerprint(first)].results:
+        assert 'actual' not in result
+        assert not any(first.samaccountname in str(value) for value in result.values())
+    assert first.id not in engine._criteria_results and second.id not in engine._criteria_results
@@ -0,0 +1,91 @@
+import random
+from collections import Counter
+
+import pytest
+
+from modules.sampling import RISK_LEVELS, _assess_sample, allocate_sample, estimate_risk_distribution, \
+    required_sample_size
+from tests.fakes import FakeSession, node, record
+
+
+@pytest.fixture(scope="module")
+def principals(loaded_rules):
+    _, permission_rules = loaded_rules
+    rng = random.Random(5)
+    nodes, edges = {}, {}
+    for i in range(600):
+        principal = node(rng.choice(["User", "User", "Computer"]), f"P{i}@CORP.LOCAL",
+                         enabled=rng.random() < 0.8, admincount=rng.random() < 0.1)
+        nodes[principal.element_id] = principal
+        edges[principal.element_id] = [rng.choice(list(permission_rules)) for _ in range(rng.choice([0, 0, 1, 2]))]
+    target = node("Group", "G@CORP.LOCAL")
+
+    def handler(query, parameters):
+        if "node_types" in parameters:
+            return [record(id=n.element_id, type=next(label for label in n.labels if label in parameters["node_types"]),
+                           enabled=n["enabled"], admincount=n["admincount"]) for n in nodes.values()]
+        if "element_ids" in parameters:
+            return [record(n=nodes[element_id], memberof=[]) for element_id in parameters["element_ids"]]
+        if "end_id" in query:
+            return [record(id=f"{parameters['element_id']}-{i}", type=edge_type, end_id=target.element_id,
+                           end_labels=list(target.labels), end_properties=dict(target))
+                    for i, edge_type in enumerate(edges[parameters["element_id"]])]
+        raise NotImplementedError(query)
+
+    return nodes, FakeSession(handler)
+
+
+def test_required_sample_size():
+    assert required_sample_size(3000, 0.05, 0.95) == 341
+    assert required_sample_size(100, 0.01, 0.99) <= 100
+    assert required_sample_size(0, 0.05, 0.95) == 0
+    with pytest.raises(ValueError):
+        required_sample_size(100, 0, 0.95)
+
+
+def test_allocation_is_proportional_with_two_per_stratum():
+    strata = {("User", True, False): 900, ("User", True, True): 90, ("Computer", False, False): 1}
+    assert allocate_sample(strata, 100) == {("User", True, False): 91, ("User", True, True): 9,
+                                            ("Computer", False, False): 1}
+
+
+def _true_distribution(principals, rules):
+    nodes, session = principals
+    engine, permission_rules = rules
+    return Counter(_assess_sample(session, list(nodes), engine, permission_rules, {}))
+
+
+def test_full_sample_is_exact(principals, rules):
+    nodes, session = principals
+    engine, permission_rules = rules
+    estimate = estimate_risk_distribution(session, engine, permission_rules, {}, sample_size=len(nodes), seed=1)
+    truth = _true_distribution(principals, rules)
+    assert estimate.population == estimate.sample_size == len(nodes)
+    for level in estimate.levels:
+        assert level.estimate == pytest.approx(truth.get(level.risk, 0))
+        assert level.lower == pytest.approx(level.estimate) and level.upper == pytest.approx(level.estimate)
+
+
+def test_confidence_intervals_cover_the_truth(principals, rules):
+    nodes, session = principals
+    engine, permission_rules = rules
+    truth = _true_distribution(principals, rules)
+    covered = intervals = 0
+    for seed in range(20):
+        estimate = estimate_risk_distribution(session, engine, permission_rules, {}, sample_size=150, seed=seed)
+        assert [level.risk for level in estimate.levels] == RISK_LEVELS
+        assert sum(level.estimate for level in estimate.levels) == pytest.approx(len(nodes))
+        assert sum(size for _, size in estimate.strata.values()) == estimate.sample_size
+        for level in estimate.levels:
+            covered += level.lower <= truth.get(level.risk, 0) <= level.upper
+            intervals += 1
+    # 95% intervals, with some slack for the normal approximation
+    assert covered / intervals >= 0.85
+
+
+def test_estimates_are_reproducible_with_a_seed(principals, rules):
+    _, session = principals
+    engine, permission_rules = rules
+    first = estimate_risk_distribution(session, engine, permission_rules, {}, error_bound=0.1, seed=7)
+    second = estimate_risk_distribution(session, engine.fork(), permission_rules, {}, error_bound=0.1, seed=7)
+    assert first == second
@@ -0,0 +1,90 @@
+import copy
+
+import pytest
+
+from modules.assessment import assess_user
+from modules.context import AssessmentContext
+from modules.scenarios import Scenario
+from tests.fakes import FakeDomain, FakeDriver, FakeSession, node
+
+EVENT_MONITORING_CONFIG = {"5136": False, "4768": False, "4887": False}
+
+
+@pytest.fixture
+def context(domain, rules):
+    engine, permission_rules = rules
+    return AssessmentContext(FakeDriver(domain.handler), engine, permission_rules, EVENT_MONITORING_CONFIG)
+
+
+def _full_run(domain, rules, event_monitoring_config, principals):
+    engine, permission_rules = rules
+    session = FakeSession(domain.handler)
+    return {user.element_id: assess_user(session, name, engine.fork(), permission_rules,
+                                         event_monitoring_config).cadra_score
+            for name, user in domain.users.items() if user.element_id in principals}
+
+
+def test_baseline_is_keyed_by_node_id(domain, context):
+    baseline = context.scenario_baseline()
+    ids = {user.element_id: name for name, user in domain.users.items()}
+    assert set(baseline.principals) <= set(ids)
+    assert all(baseline.principal_names[principal] == ids[principal] for principal in baseline.principals)
+
+
+@pytest.mark.parametrize("events", [{"5136": True}, {4887: True}, {"5136": True, "4768": True, "4887": True}])
+def test_monitoring_scenario_matches_a_full_rerun(domain, rules, context, events):
+    baseline = context.scenario_baseline()
+    before = _full_run(domain, rules, EVENT_MONITORING_CONFIG, baseline.principals)
+    after = _full_run(domain, rules, {**EVENT_MONITORING_CONFIG, **{str(e): m for e, m in events.items()}},
+                      baseline.principals)
+
+    result = baseline.evaluate(Scenario("monitor", event_monitoring=events))
+    assert result.rescored_paths > 0
+    assert result.changed_principals == {principal: (before[principal], after[principal])
+                                         for principal in baseline.principals if before[principal] != after[principal]}
+    assert result.domain_risk == max(after.values())
+
+
+def _without_edge(domain, principal, edge):
+    reduced = copy.copy(domain)
+    reduced.edges = {**domain.edges, principal: [other for other in domain.edges[principal] if other is not edge]}
+    return reduced
+
+
+def test_removed_edge_scenario_matches_a_full_rerun(domain, rules, context):
+    _, permission_rules = rules
+    baseline = context.scenario_baseline()
+    before = _full_run(domain, rules, EVENT_MONITORING_CONFIG, baseline.principals)
+    # The first edge whose removal lowers the risk of its principal
+    for principal in baseline.principals:
+        edge = next(edge for edge in domain.edges[principal] if edge[1] in permission_rules)
+        after = _full_run(_without_edge(domain, principal, edge), rules, EVENT_MONITORING_CONFIG, [principal])
+        if after[principal] != before[principal]:
+            break
+    else:
+        pytest.fail("No edge removal changes a risk")
+
+    result = baseline.evaluate(Scenario("drop edge", removed_edges={edge[0]}))
+    assert result.removed_paths == 1
+    assert result.changed_principals == {principal: (before[principal], after[principal])}
+
+
+def test_removing_a_component_drops_the_compound_right(rules):
+    engine, permission_rules = rules
+    corp = node("Domain", "CORP.LOCAL", iscriticalsystemobject=True)
+    domain = FakeDomain()
+    user = domain.add_user("SYNC@CORP.LOCAL", [("GetChanges", corp), ("GetChangesAll", corp)])
+    context = AssessmentContext(FakeDriver(domain.handler), engine, permission_rules, EVENT_MONITORING_CONFIG)
+    baseline = context.scenario_baseline()
+    principal = user.element_id
+    before = _full_run(domain, rules, EVENT_MONITORING_CONFIG, [principal])
+
+    edge = next(edge for edge in domain.edges[principal] if edge[1] == "GetChangesAll")
+    after = _full_run(_without_edge(domain, principal, edge), rules, EVENT_MONITORING_CONFIG, [principal])
+    assert after[principal] < before[principal]
+
+    result = baseline.evaluate(Scenario("drop component", removed_edges={edge[0]}))
+    # The component and the DCSync path joined from it
+    assert result.removed_paths == 2
+    assert result.changed_principals == {principal: (before[principal], after[principal])}
+    assert result.domain_risk == after[principal]
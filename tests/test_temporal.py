@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from models.neo4j import node_from_record
+from modules.rule_engine import RuleEngine
+from modules.temporal import ReferenceClock, compile_temporal_predicate, epoch_array
+from tests.fakes import node
+
+NOW = 1_700_000_000
+DAY = 24 * 3600
+
+
+def test_reference_clock_is_fixed():
+    clock = ReferenceClock(NOW + 0.9)
+    assert clock.now == NOW
+    assert compile_temporal_predicate('older_than', '30 days').cutoff(clock) == NOW - 30 * DAY
+
+
+@pytest.mark.parametrize("epoch, older, newer", [
+    (NOW - 400 * DAY, True, False),
+    (NOW - 10 * DAY, False, True),
+    (NOW - 30 * DAY, False, True),  # exactly at the cutoff
+    (0, True, False),  # never happened
+    (-1, True, False),
+    (None, False, False),
+    (True, False, False),
+    ("1690000000", False, False),
+])
+def test_older_and_newer_than_compare_against_the_cutoff(epoch, older, newer):
+    clock = ReferenceClock(NOW)
+    assert compile_temporal_predicate('older_than', '30 days').evaluate(epoch, clock) is older
+    assert compile_temporal_predicate('newer_than', '30 days').evaluate(epoch, clock) is newer
+
+
+@pytest.mark.parametrize("operator", ["older_than", "newer_than"])
+def test_evaluate_many_matches_evaluate(operator):
+    clock = ReferenceClock(NOW)
+    predicate = compile_temporal_predicate(operator, '30 days')
+    epochs = [NOW - 400 * DAY, NOW - 10 * DAY, NOW - 30 * DAY, NOW - 30 * DAY - 1, NOW, 0, -1, 0.5,
+              None, True, False, "1690000000", [NOW]]
+    expected = [predicate.evaluate(epoch, clock) for epoch in epochs]
+    assert predicate.evaluate_many(epoch_array(epochs), clock).tolist() == expected
+    assert predicate.evaluate_many(np.array([], dtype=np.float64), clock).tolist() == []
+
+
+def test_invalid_durations_are_rejected():
+    with pytest.raises(ValueError):
+        compile_temporal_predicate('older_than', 'a while')
+    with pytest.raises(ValueError):
+        compile_temporal_predicate('before', '30 days')
+
+
+def test_rule_engine_judges_every_node_against_one_clock():
+    rule = {"Name": "Stale Account", "Metric": "AC", "Value": "L",
+            "Criteria": {"Stale": [{"Property": "lastlogon", "Operator": "older_than", "Value": "90 days"}]}}
+    engine = RuleEngine(ReferenceClock(NOW))
+    engine.load_rules([rule])
+
+    stale = node_from_record(node("User", "STALE@CORP.LOCAL", lastlogon=NOW - 91 * DAY), [])
+    active = node_from_record(node("User", "ACTIVE@CORP.LOCAL", lastlogon=NOW - 89 * DAY), [])
+    # The bare duration as the cutoff would have made every real logon "newer"
+    assert engine.evaluate_rule(rule, stale)['matches']
+    assert not engine.evaluate_rule(rule, active)['matches']
+    assert engine.fork().clock is engine.clock
+
+
+def test_batch_evaluation_agrees_with_node_by_node_evaluation():
+    rules = [
+        {"Name": "Stale Account", "Metric": "AC", "Value": "L",
+         "Criteria": {"Stale": [{"Property": "lastlogon", "Operator": "older_than", "Value": "90 days"}]}},
+        {"Name": "Fresh Password", "Metric": "AC", "Value": "H",
+         "Prerequisite Criteria": {"Enabled": {"Property": "enabled", "Operator": "==", "Value": "True"}},
+         "Criteria": {"Fresh": [{"Property": "pwdlastset", "Operator": "newer_than", "Value": "30 days"},
+                                {"Property": "lastlogon", "Operator": "older_than", "Value": "90 days"}]}},
+    ]
+    engine = RuleEngine(ReferenceClock(NOW))
+    engine.load_rules(rules)
+    epochs = [NOW - 400 * DAY, NOW - DAY, 0, -1, None, "never", True]
+    nodes = [node_from_record(node("User", f"U{i}@CORP.LOCAL", enabled=True, lastlogon=epoch, pwdlastset=epoch), [])
+             for i, epoch in enumerate(epochs)]
+    nodes.append(node_from_record(node("User", "NOLOGON@CORP.LOCAL", enabled=True), []))
+    batched, single = engine.fork(), engine.fork()
+    batched.evaluate_temporal_criterias(nodes)
+    # Every node with the property was evaluated in the batch
+    assert all(test_node.id in batched._criteria_results
+               for test_node, epoch in zip(nodes, epochs) if epoch is not None)
+    for test_node in nodes:
+        assert batched.fingerprint(test_node) == single.fingerprint(test_node)
+        batched.evaluate_all_rules(test_node)
+        single.evaluate_all_rules(test_node)
+        assert [(result['matches'], result['criteria_met']) for result in batched.evaluated_rules[test_node.id]] == \
+            [(result['matches'], result['criteria_met']) for result in single.evaluated_rules[test_node.id]]
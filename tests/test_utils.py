@@ -0,0 +1,49 @@
+import random
+
+from modules.utils import compare, strongly_connected_components
+
+
+def _reachable(successors, start):
+    seen, stack = {start}, [start]
+    while stack:
+        for child in successors.get(stack.pop(), []):
+            if child not in seen:
+                seen.add(child)
+                stack.append(child)
+    return seen
+
+
+def test_components_of_a_cycle_and_a_chain():
+    successors = {"A": ["B"], "B": ["C"], "C": ["B", "D"]}
+    components = [sorted(component) for component in strongly_connected_components(["A", "B", "C", "D"], successors)]
+    assert components == [["D"], ["B", "C"], ["A"]]
+
+
+def test_components_match_mutual_reachability_in_reverse_topological_order():
+    rng = random.Random(3)
+    nodes = [str(i) for i in range(200)]
+    successors = {node: rng.sample(nodes, rng.randrange(0, 3)) for node in nodes}
+    reachable = {node: _reachable(successors, node) for node in nodes}
+
+    emitted = set()
+    covered = []
+    for component in strongly_connected_components(nodes, successors):
+        members = set(component)
+        for node in component:
+            assert {other for other in reachable[node] if node in reachable[other]} == members
+            # Everything a component reaches was emitted before it
+            assert reachable[node] - members <= emitted
+        emitted |= members
+        covered.extend(component)
+    assert sorted(covered) == sorted(nodes)
+
+
+def test_deep_chains_do_not_recurse():
+    successors = {str(i): [str(i + 1)] for i in range(100000)}
+    assert sum(1 for _ in strongly_connected_components(list(successors), successors)) == 100001
+
+
+def test_compare_membership_operators():
+    assert compare('in', ['Domain Admins', 'Users'], 'Domain Admins')
+    assert not compare('not in', ['Domain Admins'], ['Domain Admins', 'Users'])
+    assert compare('any', ['Users'], ['Domain Admins', 'Users'])